@@ -0,0 +1,211 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+
+def ratescanHash(thresholds, rates, counts=None, **config):
+    '''
+    Content hash of a summed ratescan and the fit configuration, used as key
+    of the FitCache. The points are sorted by threshold first, so the order
+    of the rows does not matter. The counts are only hashed if given, for
+    fits that are weighted with them.
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    rates = np.asarray(rates, dtype=np.float64)
+    order = np.argsort(thresholds, kind="stable")
+
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(thresholds[order]).tobytes())
+    h.update(np.ascontiguousarray(rates[order]).tobytes())
+    if counts is not None:
+        h.update(np.ascontiguousarray(np.asarray(counts, dtype=np.float64)[order]).tobytes())
+    h.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def _toBuiltin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{} is not json serializable".format(type(value)))
+
+
+class FitCache:
+    '''
+    On disk cache of ratescan fit results in a sqlite file.
+
+    Results are dicts of numbers (or None for a failed fit) stored as json
+    under a key from ratescanHash. Once the stored results are larger than
+    max_size bytes, the least recently used entries are removed.
+
+    Use it as a context manager:
+
+        with FitCache("fits.sqlite") as cache:
+            key = ratescanHash(thresholds, rates, max_threshold=5000)
+            if key in cache:
+                result = cache[key]
+    '''
+
+    def __init__(self, path, max_size=512 * 2**20, timeout=60):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connection = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self.connection = sqlite3.connect(self.path, timeout=self.timeout)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS fits ("
+            "key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_access REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS fits_last_access ON fits (last_access)"
+        )
+        self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __contains__(self, key):
+        row = self.connection.execute("SELECT 1 FROM fits WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        result = self.get_many([key])
+        if key not in result:
+            raise KeyError(key)
+        return result[key]
+
+    def __setitem__(self, key, value):
+        self.put_many({key: value})
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+
+    @property
+    def size(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM fits").fetchone()[0]
+
+    def get_many(self, keys):
+        '''
+        Look up many keys at once, returns a dict with the found entries
+        '''
+        keys = list(keys)
+        result = dict()
+        with self.connection:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.connection.execute(
+                    "SELECT key, value FROM fits WHERE key IN ({})".format(",".join("?" * len(chunk))),
+                    chunk,
+                ).fetchall()
+                for key, value in rows:
+                    result[key] = json.loads(value)
+                self.connection.executemany(
+                    "UPDATE fits SET last_access = ? WHERE key = ?",
+                    [(time.time(), key) for key, _ in rows],
+                )
+        log.debug("fit cache: {} of {} keys found".format(len(result), len(keys)))
+        return result
+
+    def put_many(self, results):
+        '''
+        Store a dict of key: result and evict old entries if needed
+        '''
+        rows = []
+        for key, value in results.items():
+            value = json.dumps(value, default=_toBuiltin)
+            rows.append((key, value, len(value), time.time()))
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fits (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache is below
+        max_size
+        '''
+        excess = self.size - self.max_size
+        if excess <= 0:
+            return
+
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM fits ORDER BY last_access"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        with self.connection:
+            self.connection.executemany("DELETE FROM fits WHERE key = ?", keys)
+        log.debug("fit cache: evicted {} entries".format(len(keys)))
+
+
+def cachedFits(
+        df,
+        fit,
+        cache,
+        group_keys=["night", "run_id"],
+        rate_key="ratescan_trigger_rate",
+        thresholds_key="ratescan_trigger_thresholds",
+        counts_key=None,
+        **config
+        ):
+    '''
+    Fit the summed ratescans in df with fit(df) -> data frame with one row
+    per successful run, only runs that are not in the cache yet are fitted.
+    config is the fit configuration and part of the key, e.g. max_threshold.
+    The counts are part of the key if counts_key is given.
+    Failed fits are cached as well and are missing in the result.
+    '''
+    keys = dict()
+    for run, group in df.groupby(group_keys):
+        counts = group[counts_key].values if counts_key is not None else None
+        keys[run] = ratescanHash(group[thresholds_key].values, group[rate_key].values, counts=counts, **config)
+
+    cached = cache.get_many(keys.values())
+    missing = [run for run, key in keys.items() if key not in cached]
+    log.info("fit cache: {} of {} runs cached".format(len(keys) - len(missing), len(keys)))
+
+    # the cached results do not contain the group keys, identical ratescans
+    # of different runs share one entry
+    rows = []
+    for run, key in keys.items():
+        if cached.get(key) is not None:
+            rows.append({**dict(zip(group_keys, run)), **cached[key]})
+    results = [pd.DataFrame(rows)]
+
+    if len(missing) > 0:
+        is_missing = pd.MultiIndex.from_frame(df[group_keys]).isin(missing)
+        df_fits = fit(df[is_missing])
+
+        new = {keys[run]: None for run in missing}
+        for row in df_fits.to_dict(orient="records"):
+            run = tuple(row.pop(k) for k in group_keys)
+            new[keys[run]] = row
+        cache.put_many(new)
+        results.append(df_fits)
+
+    results = [r for r in results if len(r) > 0]
+    if len(results) == 0:
+        return pd.DataFrame()
+    return pd.concat(results, ignore_index=True)
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+
+def integer_counts(counts):
+    '''
+    Trigger counts as int64, NaN counts, e.g. of keys missing in a json
+    line, count as zero like in a groupby sum.
+    '''
+    counts = np.asarray(counts)
+    if counts.dtype.kind in "iub":
+        return counts.astype(np.int64)
+    counts = np.asarray(counts, dtype=float)
+    return np.rint(np.where(np.isnan(counts), 0, counts)).astype(np.int64)
+
+
+def factorize_keys(columns):
+    '''
+    Factorize the rows of several key columns at once.
+
+    Returns the codes, numbered in order of first appearance, and the
+    index of the first row of each code. NaN keys get a code of their own.
+    '''
+    n_rows = len(columns[0])
+    codes = np.zeros(n_rows, dtype=np.int64)
+    n_combined = 1
+    for column in columns:
+        # factorize marks NaN with -1, shift it to a code of its own
+        key_codes, key_uniques = pd.factorize(column)
+        n_keys = len(key_uniques) + 1
+        if n_combined * n_keys >= 2**62:
+            codes, _ = pd.factorize(codes)
+            n_combined = codes.max() + 1
+        codes = codes * n_keys + key_codes + 1
+        n_combined *= n_keys
+    codes, _ = pd.factorize(codes)
+
+    n_uniques = codes.max() + 1 if n_rows > 0 else 0
+    first = np.empty(n_uniques, dtype=np.int64)
+    first[codes[::-1]] = np.arange(n_rows)[::-1]
+    return codes, first
+
+
+class Ratescan:
+    '''
+    Dense representation of the ratescans of many events.
+
+    thresholds: 1d array, the threshold axis shared by all events
+    counts:     2d array (events x thresholds) of trigger counts,
+                uint16 or uint32 depending on the largest count
+    events:     dict of 1d arrays with the per event metadata,
+                e.g. night, run_id and event_num
+    present:    2d bool array (events x thresholds) of the thresholds in
+                the scan of each event, None if all events have all
+
+    Thresholds that are missing in the scan of an event are stored with
+    zero counts, a scan stops once no patch triggers anymore.
+    '''
+
+    def __init__(
+            self,
+            thresholds,
+            counts,
+            events,
+            counts_key="ratescan_trigger_counts",
+            thresholds_key="ratescan_trigger_thresholds",
+            present=None,
+            ):
+        self.thresholds = np.asarray(thresholds)
+        self.counts = np.asarray(counts)
+        self.events = {k: np.asarray(v) for k, v in events.items()}
+        self.counts_key = counts_key
+        self.thresholds_key = thresholds_key
+        self.present = np.asarray(present, dtype=bool) if present is not None else None
+
+        if self.counts.shape != (self.n_events, len(self.thresholds)):
+            raise ValueError(
+                "counts has shape {}, expected ({}, {})".format(
+                    self.counts.shape, self.n_events, len(self.thresholds)
+                )
+            )
+        if self.present is not None and self.present.shape != self.counts.shape:
+            raise ValueError(
+                "present has shape {}, expected {}".format(self.present.shape, self.counts.shape)
+            )
+
+    @property
+    def n_events(self):
+        if len(self.events) == 0:
+            return self.counts.shape[0]
+        return len(next(iter(self.events.values())))
+
+    def __len__(self):
+        return self.n_events
+
+    @property
+    def nbytes(self):
+        nbytes = self.thresholds.nbytes + self.counts.nbytes + sum(v.nbytes for v in self.events.values())
+        return nbytes + (self.present.nbytes if self.present is not None else 0)
+
+    @classmethod
+    def from_dataframe(
+            cls,
+            df,
+            event_keys=["night", "run_id", "event_num"],
+            counts_key="ratescan_trigger_counts",
+            thresholds_key="ratescan_trigger_thresholds",
+            ):
+        '''
+        Build a Ratescan from a long format data frame (or dict of columns)
+        with one row per event and threshold.
+        '''
+        event_keys = [k for k in event_keys if k in df.keys()]
+        event_codes, first = factorize_keys([np.asarray(df[k]) for k in event_keys])
+
+        thresholds = np.asarray(df[thresholds_key])
+        threshold_codes, axis = pd.factorize(thresholds)
+        order = np.argsort(axis)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        threshold_codes, axis = rank[threshold_codes], axis[order]
+
+        counts = integer_counts(df[counts_key])
+        flat = event_codes * len(axis) + threshold_codes
+        matrix = np.zeros(len(first) * len(axis), dtype=np.int64)
+        np.add.at(matrix, flat, counts)
+        dtype = np.uint16 if len(matrix) == 0 or matrix.max() <= np.iinfo(np.uint16).max else np.uint32
+        matrix = matrix.reshape(len(first), len(axis)).astype(dtype)
+
+        # only keep the mask of the reported thresholds for ragged scans
+        present = np.bincount(flat, minlength=len(first) * len(axis)).reshape(len(first), len(axis)) > 0
+        if present.all():
+            present = None
+
+        events = {k: np.asarray(df[k])[first] for k in event_keys}
+
+        return cls(axis, matrix, events, counts_key=counts_key, thresholds_key=thresholds_key, present=present)
+
+    def to_dataframe(self):
+        '''
+        Convert to the long format with one row per event and threshold
+        '''
+        n_thresholds = len(self.thresholds)
+        data = {k: np.repeat(v, n_thresholds) for k, v in self.events.items()}
+        data[self.counts_key] = self.counts.ravel().astype(np.int64)
+        data[self.thresholds_key] = np.tile(self.thresholds, self.n_events)
+        df = pd.DataFrame(data)
+        if self.present is not None:
+            df = df[self.present.ravel()].reset_index(drop=True)
+        return df
+
+    def select(self, mask):
+        '''
+        Return a new Ratescan with the events selected by a boolean mask or
+        index array
+        '''
+        return Ratescan(
+            self.thresholds,
+            self.counts[mask],
+            {k: v[mask] for k, v in self.events.items()},
+            counts_key=self.counts_key,
+            thresholds_key=self.thresholds_key,
+            present=self.present[mask] if self.present is not None else None,
+        )
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import gzip
 import pandas as pd
-from fact.io import write_data, read_data
+from fact.io import write_data, read_data, read_h5py, h5py_get_n_rows
 import h5py
 import click
 import logging
@@ -9,11 +9,12 @@ import numpy as np
 import os
 from tqdm import tqdm
 
-from gridmap import Job, process_jobs
+from ..execution import Job, process_jobs, backends
 
 from ..utils import *
-from ..io import readJsonLtoDf
+from ..io import readJsonLtoDf, readInput, readColumnsH5py, copyRowsH5py, compressionProfiles, compressionOptions
 from ..features import *
+from ..trigger import AcceptedEvents
 
 
 log = logging.getLogger(__name__)
@@ -38,25 +39,53 @@ data_id_keys = [
 
 
 def run(
-        infile_group, df_trigger, id_keys, input_dataset_path
+        infile_group, accepted_events_path, input_dataset_path, chunk_rows=1000000
         ):
     '''
-    This is what will be executed on the cluster an will do extraction of
-    ratescans
+    This is what will be executed on the cluster, it keeps the rows of a
+    group of the input data set whose id keys are in the accepted events.
+    The group is read in chunks of chunk_rows rows.
     '''
     logger = logging.getLogger(__name__)
     logger.info("stream runner has been started.")
 
-    df_data = read_data(input_dataset_path, key=infile_group, mode='r')
-    df_merge = pd.merge(df_data, df_trigger, on=id_keys, indicator=True)
-    df_merge = df_merge[df_merge['_merge'] == 'both']
-    df_merge = df_merge[df_data.columns]
-    log.debug(
-        f'trigger reduction in group {infile_group}: {len(df_data)} before, {len(df_merge)} after, {100*(1 - len(df_merge)/len(df_data)):.3f}% loss')
+    accepted_events = AcceptedEvents.load(accepted_events_path)
+    n_rows = h5py_get_n_rows(input_dataset_path, key=infile_group)
+
+    dfs = []
+    for first in range(0, max(n_rows, 1), chunk_rows):
+        df_chunk = read_h5py(input_dataset_path, key=infile_group, first=first, last=first + chunk_rows)
+        dfs.append(df_chunk[accepted_events.contains(df_chunk)])
+    df_merge = pd.concat(dfs, ignore_index=True)
+
+    if n_rows > 0:
+        log.debug(
+            f'trigger reduction in group {infile_group}: {n_rows} before, {len(df_merge)} after, {100*(1 - len(df_merge)/n_rows):.3f}% loss')
     return infile_group, df_merge
 
 
-def make_jobs(infile_groups, df_trigger, id_keys, input_dataset_path, engine, queue, vmem, walltime):
+def select(
+        infile_group, accepted_events_path, input_dataset_path, chunk_rows=1000000
+        ):
+    '''
+    Job of the selection only mode, reads only the id columns of a group
+    and returns the boolean selection of its accepted rows
+    '''
+    accepted_events = AcceptedEvents.load(accepted_events_path)
+    n_rows = h5py_get_n_rows(input_dataset_path, key=infile_group)
+
+    selection = np.zeros(n_rows, dtype=bool)
+    for first in range(0, n_rows, chunk_rows):
+        columns = readColumnsH5py(
+            input_dataset_path, infile_group, accepted_events.id_keys, first=first, last=first + chunk_rows
+        )
+        selection[first:first + chunk_rows] = accepted_events.contains(columns)
+
+    log.debug(f'trigger reduction in group {infile_group}: {n_rows} before, {selection.sum()} after')
+    return infile_group, selection
+
+
+def make_jobs(infile_groups, accepted_events_path, input_dataset_path, chunk_rows, engine, queue, vmem, walltime, function=run):
     jobs = []
     logger = logging.getLogger(__name__)
     logger.info("queue: {}".format(queue))
@@ -65,12 +94,13 @@ def make_jobs(infile_groups, df_trigger, id_keys, input_dataset_path, engine, qu
     logger.info("mem_free: {}mb".format(vmem))
     for num, infile_group in enumerate(infile_groups):
         jobs.append(
-           Job(run,
-               [infile_group, df_trigger, id_keys, input_dataset_path],
+           Job(function,
+               [infile_group, accepted_events_path, input_dataset_path, chunk_rows],
                queue=queue,
                walltime=walltime,
                engine=engine,
                name="{}_ratescan_apply_trigger".format(num),
+               size=h5py_get_n_rows(input_dataset_path, key=infile_group),
                mem_free='{}mb'.format(vmem)
                )
            )
@@ -93,9 +123,14 @@ def make_jobs(infile_groups, df_trigger, id_keys, input_dataset_path, engine, qu
 @click.option("--log_dir", type=click.Path(exists=False, dir_okay=True, file_okay=False, readable=True), help='Directory to store output from m gridmap jobs', default=None)
 @click.option('--port', help='The port through which to communicate with the JobMonitor', default=None, type=int)
 @click.option('--local', default=False, is_flag=True,   help='Flag indicating whether jobs should be executed localy .')
+@click.option('--backend', help='Backend used to execute the jobs.', type=click.Choice(backends), default='gridmap')
+@click.option('--max_workers', help='Number of local processes for the pool backend, default is the number of cpus.', default=None, type=click.INT)
+@click.option('--compression', help='Compression profile of the written hdf5 datasets, by default the selection only mode keeps the compression of the input.', type=click.Choice(list(compressionProfiles())), default=None)
+@click.option('--chunk_rows', help='Number of rows of a group that are filtered at once.', default=1000000, type=click.INT)
+@click.option('--selection_only', is_flag=True, help='Jobs only read the id columns, all columns are then copied dataset by dataset with h5py without pandas.')
 def main(input_dataset_path, trigger_decision_path, output_path,
          trigger_group_key, trigger_threshold_key, log_level, ismc,
-         queue, walltime, engine, vmem, log_dir, port, local):
+         queue, walltime, engine, vmem, log_dir, port, local, backend, max_workers, chunk_rows, selection_only, compression):
     """
     apply the software trigger to the input data set
     """
@@ -110,10 +145,6 @@ def main(input_dataset_path, trigger_decision_path, output_path,
     with h5py.File(input_dataset_path, "r") as f:
         infile_groups = list(f.keys())
 
-    log.info("Reading trigger decission file")
-    df_trigger = read_data(trigger_decision_path, key=trigger_group_key)
-    df_trigger = df_trigger[df_trigger[trigger_threshold_key]]
-
     if ismc:
         log.info("MC mode")
         id_keys = mc_id_keys
@@ -121,29 +152,44 @@ def main(input_dataset_path, trigger_decision_path, output_path,
         log.info("Data mode")
         id_keys = data_id_keys
 
-    log.info(f"Applying trigger to groups in data set file")
-
-    jobs = make_jobs(infile_groups, df_trigger, id_keys, input_dataset_path, engine, queue, vmem, walltime)
-
-    log.info("Submitting {} jobs".format(len(jobs)))
-
-    job_arguments = dict(
-        jobs=jobs,
-        max_processes=len(jobs),
-        local=local,
-    )
-
-    if port:
-        job_arguments["port"] = port
-
-    if log_dir:
-        job_arguments["temp_dir"] = log_dir
-
-    job_outputs = process_jobs(**job_arguments)
+    log.info("Reading trigger decission file")
+    df_trigger = readInput(trigger_decision_path, key=trigger_group_key, columns=id_keys + [trigger_threshold_key])
+    df_trigger = df_trigger[df_trigger[trigger_threshold_key]]
 
-    for k, (infile_group, df_merge) in tqdm(enumerate(job_outputs)):
-        mode = 'w' if k < 1 else "a"
-        write_data(df_merge, output_path, key=infile_group, mode=mode, index=False)
+    # the jobs only get the path to this file instead of the trigger table
+    accepted_events = AcceptedEvents.from_dataframe(df_trigger, id_keys)
+    accepted_events_path = os.path.abspath(os.path.splitext(output_path)[0] + "_accepted_events.npz")
+    accepted_events.save(accepted_events_path)
+    log.info(f"Stored {len(accepted_events)} accepted events in {accepted_events_path}")
+
+    try:
+        log.info(f"Applying trigger to groups in data set file")
+
+        function = select if selection_only else run
+        jobs = make_jobs(infile_groups, accepted_events_path, input_dataset_path, chunk_rows, engine, queue, vmem, walltime, function=function)
+
+        log.info("Submitting {} jobs".format(len(jobs)))
+
+        job_outputs = process_jobs(
+            jobs,
+            backend=backend,
+            max_workers=max_workers,
+            local=local,
+            port=port,
+            temp_dir=log_dir,
+        )
+
+        if selection_only:
+            with h5py.File(output_path, "w") as output_file:
+                for infile_group, selection in tqdm(job_outputs):
+                    copyRowsH5py(input_dataset_path, output_file, infile_group, selection, chunk_rows=chunk_rows, compression=compression)
+        else:
+            for k, (infile_group, df_merge) in tqdm(enumerate(job_outputs)):
+                mode = 'w' if k < 1 else "a"
+                write_data(df_merge, output_path, key=infile_group, mode=mode, index=False, **compressionOptions(compression))
+    finally:
+        # also clean up if a job or the writing fails
+        os.remove(accepted_events_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+import pandas as pd
+from fact.io import read_data
+import click
+import logging
+import os
+import tempfile
+import time
+
+from ..io import readInput, HDF5Writer, compressionProfiles, compressionOptions
+from .convertRatescansToHDF5_cluster import default_keys_to_store
+
+logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def benchmarkProfile(df, path, profile, chunk_rows=2**16, key="ratescan", repeat=3):
+    '''
+    Write df with a compression profile to path and read it back repeat
+    times, returns the best write and read time in seconds and the file
+    size in bytes
+    '''
+    write_times, read_times = [], []
+    for _ in range(repeat):
+        if os.path.exists(path):
+            os.remove(path)
+        start = time.perf_counter()
+        with HDF5Writer(path, key=key, capacity=len(df), chunk_rows=chunk_rows, **compressionOptions(profile)) as writer:
+            writer.append(df)
+        write_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        read_data(path, key=key)
+        read_times.append(time.perf_counter() - start)
+
+    return dict(
+        profile=profile,
+        chunk_rows=chunk_rows,
+        write_time=min(write_times),
+        read_time=min(read_times),
+        size=os.path.getsize(path),
+    )
+
+
+@click.command()
+@click.argument('infile', type=click.Path(exists=True, dir_okay=True, file_okay=True, readable=True))
+@click.option('--key', help='Key of the data base in the hdf file', default="ratescan")
+@click.option('--profile', 'profiles', help='Compression profile to benchmark, can be given several times, default are all.', type=click.Choice(list(compressionProfiles())), multiple=True)
+@click.option('--chunk_rows', help='Chunk length of the datasets, can be given several times.', default=[2**16], type=click.INT, multiple=True)
+@click.option('--repeat', help='Number of repetitions, the best time is reported.', default=3, type=click.INT)
+@click.option('--outfile', type=click.Path(exists=False, dir_okay=False, file_okay=True), help='Store the results as csv.', default=None)
+def main(infile, key, profiles, chunk_rows, repeat, outfile):
+    """
+    Report write time, read time and file size of every compression profile
+    for the ratescans in INFILE
+    """
+    columns = default_keys_to_store if infile.endswith("json.gz") or infile.endswith("json") else None
+    df = readInput(infile, key=key, columns=columns)
+    log.info("Benchmarking compression on {} rows".format(len(df)))
+
+    if len(profiles) == 0:
+        profiles = list(compressionProfiles())
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for profile in profiles:
+            for rows in chunk_rows:
+                results.append(benchmarkProfile(
+                    df, os.path.join(tmpdir, "benchmark.hdf5"), profile, chunk_rows=rows, key=key, repeat=repeat
+                ))
+
+    df_results = pd.DataFrame(results)
+    df_results["ratio"] = df_results["size"] / df_results["size"].max()
+    click.echo(df_results.to_string(index=False, float_format="{:.3f}".format))
+
+    if outfile is not None:
+        df_results.to_csv(outfile, index=False)
+
+
+if __name__ == '__main__':
+    main()
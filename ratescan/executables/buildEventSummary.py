@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+import click
+import logging
+
+from ..rundb import openRunInfoCache, prefetchRunInfo
+from ..trigger import buildEventSummary
+from ..utils import append_current_at_start_from_run_db
+from ..io import readInput
+from . import determine_sw_trigger_event_list as trigger_event_list
+from .determine_sw_trigger_event_list import trigger_options, configure_key_dict, process_and_write
+
+logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+default_key_dict = dict(trigger_event_list.default_key_dict, n_primitives=[1])
+
+
+def get_value_from_dict_or_use_default(key_dict, key):
+    return key_dict[key] if key in key_dict.keys() else default_key_dict[key]
+
+
+def run(infile_path, inkey=None, key_dict=None):
+    '''
+    This is what will be executed on the cluster and reduces the raw
+    ratescan rows of a file to one summary row per event
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info("stream runner has been started.")
+
+    if key_dict is None:
+        key_dict = default_key_dict
+    if inkey is None:
+        inkey = get_value_from_dict_or_use_default(key_dict, "inkey")
+    night_key = get_value_from_dict_or_use_default(key_dict, "night_key")
+    run_id_key = get_value_from_dict_or_use_default(key_dict, "run_id_key")
+    group_keys = get_value_from_dict_or_use_default(key_dict, "group_keys")
+    counts_key = get_value_from_dict_or_use_default(key_dict, "counts_key")
+    thresholds_key = get_value_from_dict_or_use_default(key_dict, "thresholds_key")
+    n_primitives = get_value_from_dict_or_use_default(key_dict, "n_primitives")
+    workers = get_value_from_dict_or_use_default(key_dict, "workers")
+    run_db_snapshot = get_value_from_dict_or_use_default(key_dict, "run_db_snapshot")
+    run_db_offline = get_value_from_dict_or_use_default(key_dict, "run_db_offline")
+    run_db_table = get_value_from_dict_or_use_default(key_dict, "run_db_table")
+
+    relevant_keys = list(dict.fromkeys(group_keys + [night_key, run_id_key, counts_key, thresholds_key]))
+
+    df = readInput(infile_path, key=inkey, columns=relevant_keys, workers=workers)
+
+    with openRunInfoCache(run_db_snapshot, offline=run_db_offline, table=run_db_table) as run_db_cache:
+        df = append_current_at_start_from_run_db(df,
+                                                 night_key=night_key,
+                                                 run_id_key=run_id_key,
+                                                 current_key='current_at_start',
+                                                 run_db_cache=run_db_cache,
+                                                 )
+
+    df_summary = buildEventSummary(
+        df,
+        group_keys=group_keys,
+        counts_key=counts_key,
+        thresholds_key=thresholds_key,
+        current_key='current_at_start',
+        n_primitives=n_primitives,
+    )
+    df_summary["infile_path"] = infile_path
+    return df_summary
+
+
+@click.command()
+@trigger_options
+@click.option('--outkey', help='Key of the data base in the hdf file', default="event_summary")
+@click.option('--n_primitives', help='Store the highest threshold with n triggering patches, can be given several times.', default=[1], type=click.INT, multiple=True)
+def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, backend, max_workers, run_db_snapshot, run_db_offline, run_db_prefetch, mc, workers, n_primitives, compression):
+    """
+    Reduce raw ratescan files to a per event summary table with the highest
+    triggering threshold, the highest threshold with n primitives and the
+    current at the start of the run. Trigger studies with
+    ratescan_determine_sw_trigger_event_list --from_summary and
+    features.maxPossibleThreshold2KeepFromSummary work on this table.
+    """
+    log.info("Building per event summaries of ratescans")
+
+    key_dict = configure_key_dict(default_key_dict, mc, workers, run_db_snapshot, run_db_offline)
+    key_dict['n_primitives'] = list(n_primitives)
+    key_dict['run_db_table'] = prefetchRunInfo(infiles, key_dict) if run_db_prefetch else None
+
+    process_and_write(
+        infiles, outfile, outkey, key_dict, chunksize, engine, queue, vmem, walltime,
+        backend, max_workers, local, port, log_dir, compression,
+        function=run, name="ratescan_event_summary",
+    )
+
+
+if __name__ == '__main__':
+    main()
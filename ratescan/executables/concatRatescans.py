@@ -8,12 +8,13 @@ import numpy as np
 import os
 from tqdm import tqdm
 
-from gridmap import Job, process_jobs
+from ..execution import Job, process_jobs, file_size, backends
 import gc
 
 from ..utils import *
-from ..io import readJsonLtoDf
+from ..io import readJsonLtoDf, HDF5Writer, readInput, writeRunIndex, compressionProfiles, compressionOptions
 from ..features import *
+from ..shards import ShardSet
 
 logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
@@ -38,7 +39,7 @@ default_obs_cols =[
 
 
 
-def run(infile_path, inkey=None, key_list=None):
+def run(infile_path, inkey=None, key_list=None, workers=1):
     '''
     This is what will be executed on the cluster an will do extraction of
     ratescans
@@ -53,20 +54,17 @@ def run(infile_path, inkey=None, key_list=None):
     if key_list is None:
         key_list = default_common_cols + default_obs_cols
     
-    if infile_path.endswith("json.gz") or infile_path.endswith("json"):
-        df = readJsonLtoDf(infile_path, default_keys_to_store=key_list)
-    elif infile_path.endswith("hdf") or infile_path.endswith("hdf5"):
-        df = read_data(infile_path, key=inkey)
-    else:
-        logger.error("input fileformat not supported")
-        df = None
+    # key_list only selects the keys of json lines, hdf5 files and column
+    # stores are concatenated with all their columns
+    is_jsonl = infile_path.endswith("json.gz") or infile_path.endswith("json")
+    df = readInput(infile_path, key=inkey, columns=key_list if is_jsonl else None, workers=workers)
 
     df["infile_path"] = infile_path
     
     return df
 
 
-def make_jobs(infiles, engine, queue, vmem, walltime, key_list=None, inkey=None):
+def make_jobs(infiles, engine, queue, vmem, walltime, key_list=None, inkey=None, workers=1):
     jobs = []
     logger = logging.getLogger(__name__)
     logger.info("queue: {}".format(queue))
@@ -76,11 +74,12 @@ def make_jobs(infiles, engine, queue, vmem, walltime, key_list=None, inkey=None)
     for num, infile in enumerate(infiles):
         jobs.append(
            Job(run,
-               [infile, inkey, key_list],
+               [infile, inkey, key_list, workers],
                queue=queue,
                walltime=walltime,
                engine=engine,
                name="{}_ratescan_concat".format(num),
+               size=file_size(infile),
                mem_free='{}mb'.format(vmem)
                )
            )
@@ -89,7 +88,7 @@ def make_jobs(infiles, engine, queue, vmem, walltime, key_list=None, inkey=None)
 
 
 @click.command()
-@click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True) )
+@click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=True, file_okay=True, readable=True) )
 @click.argument('outfile', type=click.Path(exists=False, dir_okay=False, file_okay=True, readable=True) )
 @click.option('--outkey', help='Key of the data base in the hdf file', default="ratescan")
 @click.option('--queue', help='Name of the queue you want to send jobs to.', default='one_day')
@@ -101,8 +100,13 @@ def make_jobs(infiles, engine, queue, vmem, walltime, key_list=None, inkey=None)
 @click.option("--log_dir", type=click.Path(exists=False, dir_okay=True, file_okay=False, readable=True), help='Directory to store output from m gridmap jobs', default=None)
 @click.option('--port', help='The port through which to communicate with the JobMonitor', default=None, type=int)
 @click.option('--local', default=False, is_flag=True,   help='Flag indicating whether jobs should be executed localy .')
+@click.option('--backend', help='Backend used to execute the jobs.', type=click.Choice(backends), default='gridmap')
+@click.option('--max_workers', help='Number of local processes for the pool backend, default is the number of cpus.', default=None, type=click.INT)
+@click.option('--compression', help='Compression profile of the written hdf5 datasets.', type=click.Choice(list(compressionProfiles())), default='none')
+@click.option('--shard_dir', type=click.Path(exists=False, dir_okay=True, file_okay=False), help='Write one shard per input file to this directory and skip input files whose shard is done, the shards are merged into OUTFILE.', default=None)
 @click.option('--mc', default=False, is_flag=True,   help='Flag indicating whether input files are mcs.')
-def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, mc):
+@click.option('--workers', help='Number of processes used to decode json input files.', default=1, type=click.INT)
+def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, mc, workers, backend, max_workers, compression, shard_dir):
     """
     run over list of jsonl files convert each line to pandas df and dump it to HDF5
     """
@@ -110,44 +114,66 @@ def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log
     log.info("Putting ratescans from json files into hdf5 file")
     open_func = open
     
-    if chunksize > 0:
-        partitions = np.array_split(infiles, 1+len(infiles)//chunksize)
-    else:
-        partitions = np.array_split(infiles, 1)
-
-    key_list = default_common_cols
+    # a new list, += would extend default_common_cols itself
     if mc:
-        key_list += default_sim_cols
+        key_list = default_common_cols + default_sim_cols
     else:
-        key_list += default_obs_cols
-
-    for infile in partitions:
-        jobs = make_jobs(infile, engine, queue, vmem, walltime, key_list)
-
-        log.info("Submitting {} jobs".format(len(jobs)))
+        key_list = default_common_cols + default_obs_cols
 
-        job_arguments = dict(
-            jobs=jobs,
-            max_processes=len(jobs),
-            local=local,
-        )
+    if shard_dir is not None:
+        shards = ShardSet(shard_dir, infiles, key=outkey, config=dict(key_list=key_list))
+        infiles = shards.pending()
+        log.info("{} of {} input files have to be processed".format(len(infiles), len(shards.infiles)))
 
-        if port:
-            job_arguments["port"] = port
+    if chunksize > 0:
+        partitions = np.array_split(infiles, 1+len(infiles)//chunksize)
+    else:
+        partitions = np.array_split(infiles, 1)
 
-        if log_dir:
-            job_arguments["temp_dir"] = log_dir
+    if shard_dir is not None:
+        for infile in partitions:
+            jobs = make_jobs(infile, engine, queue, vmem, walltime, key_list, workers=workers)
+            jobs = [shards.wrap(job, f) for job, f in zip(jobs, infile)]
 
-        job_outputs = process_jobs(**job_arguments)
+            log.info("Submitting {} jobs".format(len(jobs)))
 
-        for k, df in tqdm(enumerate(job_outputs)):
-            mode = 'w' if k < 1 else "a"
-            write_data(df, outfile, key=outkey, mode=mode, index=False)
-            del df
-            gc.collect()
+            for n_rows in tqdm(process_jobs(
+                jobs,
+                backend=backend,
+                max_workers=max_workers,
+                local=local,
+                port=port,
+                temp_dir=log_dir,
+            )):
+                pass
 
-        del job_outputs
-        gc.collect()
+        shards.merge(outfile, compression=compression)
+    else:
+        with HDF5Writer(outfile, key=outkey, **compressionOptions(compression)) as writer:
+            for infile in partitions:
+                jobs = make_jobs(infile, engine, queue, vmem, walltime, key_list, workers=workers)
+
+                log.info("Submitting {} jobs".format(len(jobs)))
+
+                job_outputs = process_jobs(
+                    jobs,
+                    backend=backend,
+                    max_workers=max_workers,
+                    local=local,
+                    port=port,
+                    temp_dir=log_dir,
+                )
+
+                for df in tqdm(job_outputs):
+                    writer.append(df)
+                    del df
+                    gc.collect()
+
+                del job_outputs
+                gc.collect()
+
+    if not mc and os.path.exists(outfile):
+        writeRunIndex(outfile, key=outkey)
 
 
 if __name__ == '__main__':
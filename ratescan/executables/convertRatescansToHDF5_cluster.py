@@ -8,50 +8,43 @@ import numpy as np
 import os
 from tqdm import tqdm
 
-from gridmap import Job, process_jobs
+from ..execution import Job, process_jobs, file_size, backends
+
+from ..io import readJsonLtoDf, writeColumnStore, columnStoreSuffix, writeRunIndex, compressionProfiles, compressionOptions
 
 logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 log = logging.getLogger(__name__)
 
-def run(infile_path, keys, outkey):
+def run(infile_path, keys, outkey, workers=1, output_format="hdf5", compression="gzip9"):
     '''
-    This is what will be executed on the cluster
+    This is what will be executed on the cluster, the converted file is
+    either a gzip compressed hdf5 file or a column store directory that
+    later steps can memory map
     '''
     logger = logging.getLogger(__name__)
     logger.info("stream runner has been started.")
 
-    open_func = open
-
-    log.info("reading: {}".format(infile_path))
-    if infile_path.endswith(".gz"):
-        open_func = gzip.open
-
-    dfs = []
-    lines = 0
-    with open_func(infile_path) as f:
-        for line in f:
-            df = pd.read_json(line)
-            df = df[default_keys_to_store]
-            dfs.append(df)
-            lines+=1
-    
-    res = pd.concat(dfs)
+    res = readJsonLtoDf(infile_path, default_keys_to_store=keys, workers=workers)
     
     res["infile_path"] = infile_path
     
     pre, ext = os.path.splitext(infile_path)
     if infile_path.endswith(".gz"):
         pre, ext = os.path.splitext(pre)
-    outfile = pre + ".hdf5"
-    
-    write_data(res, outfile, key=outkey, mode="w", compression="gzip", compression_opts=9)
-    logger.info("extracted {} thresholds from {} lines".format(len(res), lines))
+    if output_format == "columns":
+        outfile = pre + columnStoreSuffix
+        writeColumnStore(res, outfile, key=outkey)
+    else:
+        outfile = pre + ".hdf5"
+        write_data(res, outfile, key=outkey, mode="w", **compressionOptions(compression))
+    writeRunIndex(outfile, key=outkey)
+    logger.info("extracted {} thresholds".format(len(res)))
     
     return res[res.duplicated([ 'event_num', 'run_id', 'night', 'infile_path'], keep='first') == False]
 
 
-def make_jobs(infiles, keys, outkey, engine, queue, vmem, walltime, num_runs):
+def make_jobs(infiles, keys, outkey, engine, queue, vmem, walltime, num_runs, workers=1, output_format="hdf5", compression="gzip9"):
     jobs = []
     logger = logging.getLogger(__name__)
     logger.info("queue: {}".format(queue))
@@ -61,11 +54,12 @@ def make_jobs(infiles, keys, outkey, engine, queue, vmem, walltime, num_runs):
     for num, infile in enumerate(infiles):
         jobs.append(
            Job(run,
-               [infile, keys, outkey],
+               [infile, keys, outkey, workers, output_format, compression],
                queue=queue,
                walltime=walltime,
                engine=engine,
                name="{}_ratescan_convert".format(num),
+               size=file_size(infile),
                mem_free='{}mb'.format(vmem)
                )
            )
@@ -121,7 +115,13 @@ default_keys_to_store = ratescan_keys + meta_keys + pedestal_keys
 @click.option("--log_dir", type=click.Path(exists=False, dir_okay=True, file_okay=False, readable=True), help='Directory to store output from m gridmap jobs', default=None)
 @click.option('--port', help='The port through which to communicate with the JobMonitor', default=None, type=int)
 @click.option('--local', default=False,is_flag=True,   help='Flag indicating whether jobs should be executed localy .')
-def main(infiles, outfile, key, queue, walltime, engine, num_runs, vmem, chunksize, log_level, log_dir, port, local):
+@click.option('--backend', help='Backend used to execute the jobs.', type=click.Choice(backends), default='gridmap')
+@click.option('--max_workers', help='Number of local processes for the pool backend, default is the number of cpus.', default=None, type=click.INT)
+@click.option('--compression', help='Compression profile of the hdf5 file written next to each input file.', type=click.Choice(list(compressionProfiles())), default='gzip9')
+@click.option('--merge_compression', help='Compression profile of the merged OUTFILE.', type=click.Choice(list(compressionProfiles())), default='none')
+@click.option('--workers', help='Number of processes used to decode json input files.', default=1, type=click.INT)
+@click.option('--output_format', help='Format of the converted file next to each input file, hdf5 or a directory of memory mappable .npy columns.', type=click.Choice(['hdf5', 'columns']), default='hdf5')
+def main(infiles, outfile, key, queue, walltime, engine, num_runs, vmem, chunksize, log_level, log_dir, port, local, workers, backend, max_workers, output_format, compression, merge_compression):
     """
     run over list of jsonl files convert each line to pandas df and dump it to HDF5
     """
@@ -136,26 +136,24 @@ def main(infiles, outfile, key, queue, walltime, engine, num_runs, vmem, chunksi
     
     
     for infile in partitions:
-        jobs = make_jobs(infile, default_keys_to_store, key, engine, queue, vmem, walltime, num_runs)
+        jobs = make_jobs(infile, default_keys_to_store, key, engine, queue, vmem, walltime, num_runs, workers=workers, output_format=output_format, compression=compression)
 
         log.info("Submitting {} jobs".format(len(jobs)))
 
-        job_arguments = dict(
-            jobs=jobs,
-            max_processes=len(jobs),
+        job_outputs = process_jobs(
+            jobs,
+            backend=backend,
+            max_workers=max_workers,
             local=local,
+            port=port,
+            temp_dir=log_dir,
         )
 
-        if port:
-            job_arguments["port"] = port
-
-        if log_dir:
-            job_arguments["temp_dir"] = log_dir
-
-        job_outputs = process_jobs(**job_arguments)
-
         for df in tqdm(job_outputs):
-            write_data(df, outfile, key=key, mode="a")
+            write_data(df, outfile, key=key, mode="a", **compressionOptions(merge_compression))
+
+    if os.path.exists(outfile):
+        writeRunIndex(outfile, key=key)
 
 if __name__ == '__main__':
     main()
@@ -8,11 +8,13 @@ import numpy as np
 import os
 from tqdm import tqdm
 
-from gridmap import Job, process_jobs
+from ..execution import Job, process_jobs, file_size, backends
 import gc
 
 from ..utils import append_current_at_start_from_run_db
-from ..io import readJsonLtoDf
+from ..rundb import openRunInfoCache, prefetchRunInfo
+from ..trigger import maxTriggeringThresholdPerEvent, softwareTriggerDecisions
+from ..io import readJsonLtoDf, readInput, HDF5Writer, compressionProfiles, compressionOptions
 from ..features import *
 
 logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
@@ -48,6 +50,12 @@ default_key_dict = dict(
     threshold_curve_par=[{'a': 63.2, 'k': 0.551 }],
     normalize=False,
     group_keys=["night", "run_id", "event_num"],
+    workers=1,
+    run_db_snapshot=None,
+    run_db_offline=False,
+    run_db_table=None,
+    from_summary=False,
+    summary_key="event_summary",
 )
 
 
@@ -77,56 +85,61 @@ def run(infile_path, inkey=None, key_dict=None):
     thresholds_key = get_value_from_dict_or_use_default(key_dict, "thresholds_key")
     threshold_curve_par = get_value_from_dict_or_use_default(key_dict, "threshold_curve_par")
     keys_to_read = get_value_from_dict_or_use_default(key_dict, "keys_to_read")
+    workers = get_value_from_dict_or_use_default(key_dict, "workers")
+    run_db_snapshot = get_value_from_dict_or_use_default(key_dict, "run_db_snapshot")
+    run_db_offline = get_value_from_dict_or_use_default(key_dict, "run_db_offline")
+    run_db_table = get_value_from_dict_or_use_default(key_dict, "run_db_table")
+    from_summary = get_value_from_dict_or_use_default(key_dict, "from_summary")
+    summary_key = get_value_from_dict_or_use_default(key_dict, "summary_key")
+
+    if from_summary:
+        # per event summaries of ratescan_build_event_summary already
+        # contain the max triggering threshold and the current
+        df_events = readInput(
+            infile_path,
+            key=summary_key,
+            columns=group_keys + ['max_triggering_threshold', 'current_at_start'],
+        )
+        df_trigger = softwareTriggerDecisions(
+            df_events['max_triggering_threshold'].values,
+            df_events['current_at_start'].values,
+            threshold_curve_par,
+        )
+        return pd.concat([df_events[group_keys].reset_index(drop=True), df_trigger], axis=1)
     
-    if infile_path.endswith("json.gz") or infile_path.endswith("json"):
-        df = readJsonLtoDf(infile_path, default_keys_to_store=keys_to_read)
-    elif infile_path.endswith("hdf") or infile_path.endswith("hdf5"):
-        df = read_data(infile_path, key=inkey)
-    else:
-        logger.error("input fileformat not supported")
-        df = None
-
+    df = readInput(infile_path, key=inkey, columns=keys_to_read, workers=workers)
 
     df["infile_path"] = infile_path
 
-    df = append_current_at_start_from_run_db(df,
-                                             night_key=night_key,
-                                             run_id_key=run_id_key,
-                                             current_key='current_at_start'
-                                             )
-
-    df_trigger = []
-    for parameter_pair in threshold_curve_par:
-        a = parameter_pair['a']
-        k = parameter_pair['k']
-        threshold_name = f'SetSWThreshold_{a}_{k}'
-        df[threshold_name] = df.apply(lambda row: power_law(row['current_at_start'], a, k), axis=1)
-
-        def has_triggered(group):
-            above_threshold = group[group[thresholds_key] >= group[threshold_name]]
-            if len(above_threshold) > 0:
-                counts_above_threshold = above_threshold[above_threshold[counts_key] > 0]
-                if len(counts_above_threshold) > 0:
-                    return True
-            return False
-
-        print(df.columns)
-        df_trigger_decission = df.groupby(group_keys).apply(has_triggered)
-        df_trigger_decission.name = threshold_name
-        df_trigger.append(df_trigger_decission)
-
-    if len(df_trigger) == 1:
-        return df_trigger[0].reset_index()
-    else:
-        df_trigger = pd.concat(df_trigger, axis=1)
-        return df_trigger.reset_index()
+    with openRunInfoCache(run_db_snapshot, offline=run_db_offline, table=run_db_table) as run_db_cache:
+        df = append_current_at_start_from_run_db(df,
+                                                 night_key=night_key,
+                                                 run_id_key=run_id_key,
+                                                 current_key='current_at_start',
+                                                 run_db_cache=run_db_cache,
+                                                 )
+
+    df_events = maxTriggeringThresholdPerEvent(
+        df,
+        group_keys=group_keys,
+        counts_key=counts_key,
+        thresholds_key=thresholds_key,
+        value_keys=['current_at_start'],
+    )
+
+    df_trigger = softwareTriggerDecisions(
+        df_events['max_triggering_threshold'].values,
+        df_events['current_at_start'].values,
+        threshold_curve_par,
+    )
+    return pd.concat([df_events[group_keys], df_trigger], axis=1)
 
 
 def power_law(x, a, k):
     return a * pow(x, k)
 
 
-def make_jobs(infiles, engine, queue, vmem, walltime, key_dict=None, inkey=None):
+def make_jobs(infiles, engine, queue, vmem, walltime, key_dict=None, inkey=None, function=run, name="ratescan_concat"):
     jobs = []
     logger = logging.getLogger(__name__)
     logger.info("queue: {}".format(queue))
@@ -135,50 +148,57 @@ def make_jobs(infiles, engine, queue, vmem, walltime, key_dict=None, inkey=None)
     logger.info("mem_free: {}mb".format(vmem))
     for num, infile in enumerate(infiles):
         jobs.append(
-           Job(run,
+           Job(function,
                [infile, inkey, key_dict],
                queue=queue,
                walltime=walltime,
                engine=engine,
-               name="{}_ratescan_concat".format(num),
+               name="{}_{}".format(num, name),
+               size=file_size(infile),
                mem_free='{}mb'.format(vmem)
                )
            )
     return jobs
 
 
+def trigger_options(function):
+    '''
+    Click options shared by ratescan_determine_sw_trigger_event_list and
+    ratescan_build_event_summary
+    '''
+    options = [
+        click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True) ),
+        click.argument('outfile', type=click.Path(exists=False, dir_okay=False, file_okay=True, readable=True) ),
+        click.option('--queue', help='Name of the queue you want to send jobs to.', default='one_day'),
+        click.option('--walltime', help='Estimated maximum walltime of your job in format hh:mm:ss.', default='02:00:00'),
+        click.option('--engine', help='Name of the grid engine used by the cluster.', type=click.Choice(['PBS', 'SGE',]), default='PBS'),
+        click.option('--vmem', help='Amount of memory to use per node in MB.', default='10000', type=click.INT),
+        click.option('--chunksize', help='number of simultaneus submitted jobs.', default='0', type=click.INT),
+        click.option('--log_level', type=click.Choice(['INFO', 'DEBUG', 'WARN']), help='increase output verbosity', default='INFO'),
+        click.option("--log_dir", type=click.Path(exists=False, dir_okay=True, file_okay=False, readable=True), help='Directory to store output from m gridmap jobs', default=None),
+        click.option('--port', help='The port through which to communicate with the JobMonitor', default=None, type=int),
+        click.option('--local', default=False, is_flag=True,   help='Flag indicating whether jobs should be executed localy .'),
+        click.option('--backend', help='Backend used to execute the jobs.', type=click.Choice(backends), default='gridmap'),
+        click.option('--max_workers', help='Number of local processes for the pool backend, default is the number of cpus.', default=None, type=click.INT),
+        click.option('--compression', help='Compression profile of the written hdf5 datasets.', type=click.Choice(list(compressionProfiles())), default='none'),
+        click.option('--run_db_snapshot', type=click.Path(exists=False, dir_okay=False, file_okay=True), help='SQLite snapshot of the run database, missing nights are fetched with one query.', default=None),
+        click.option('--run_db_offline', default=False, is_flag=True, help='Only use the run db snapshot, never query the run database.'),
+        click.option('--run_db_prefetch/--no_run_db_prefetch', default=False, help='Read the runs of all input files in the driver first and fetch their run infos with one query for all jobs, jsonl inputs are decoded for this.'),
+        click.option('--mc', default=False, is_flag=True,   help='Flag indicating whether input files are mcs.'),
+        click.option('--workers', help='Number of processes used to decode json input files.', default=1, type=click.INT),
+    ]
+    for option in reversed(options):
+        function = option(function)
+    return function
 
-@click.command()
-@click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True) )
-@click.argument('outfile', type=click.Path(exists=False, dir_okay=False, file_okay=True, readable=True) )
-@click.option('--outkey', help='Key of the data base in the hdf file', default="ratescan")
-@click.option('--queue', help='Name of the queue you want to send jobs to.', default='one_day')
-@click.option('--walltime', help='Estimated maximum walltime of your job in format hh:mm:ss.', default='02:00:00')
-@click.option('--engine', help='Name of the grid engine used by the cluster.', type=click.Choice(['PBS', 'SGE',]), default='PBS')
-@click.option('--vmem', help='Amount of memory to use per node in MB.', default='10000', type=click.INT)
-@click.option('--chunksize', help='number of simultaneus submitted jobs.', default='0', type=click.INT)
-@click.option('--log_level', type=click.Choice(['INFO', 'DEBUG', 'WARN']), help='increase output verbosity', default='INFO')
-@click.option("--log_dir", type=click.Path(exists=False, dir_okay=True, file_okay=False, readable=True), help='Directory to store output from m gridmap jobs', default=None)
-@click.option('--port', help='The port through which to communicate with the JobMonitor', default=None, type=int)
-@click.option('--local', default=False, is_flag=True,   help='Flag indicating whether jobs should be executed localy .')
-@click.option('--mc', default=False, is_flag=True,   help='Flag indicating whether input files are mcs.')
-@click.option('-t', '--threshold_curve_par', nargs=2, type=click.Tuple([float, float]), multiple=True, default=(63.2, 0.551))
-def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, mc, threshold_curve_par):
-    """
-    run over list of jsonl files convert each line to pandas df and dump it to HDF5
-    """
-
-    log.info("Putting ratescans from json files into hdf5 file")
-
-    if chunksize > 0:
-        partitions = np.array_split(infiles, 1+len(infiles)//chunksize)
-    else:
-        partitions = np.array_split(infiles, 1)
 
-    key_dict = default_key_dict
-    key_dict['threshold_curve_par'] = []
-    for (a,k) in threshold_curve_par:
-        key_dict['threshold_curve_par'].append(dict(a=a, k=k))
+def configure_key_dict(key_dict, mc, workers, run_db_snapshot, run_db_offline):
+    '''
+    Set the options of trigger_options that go to the jobs in key_dict
+    '''
+    key_dict['workers'] = workers
+    key_dict['run_db_snapshot'] = os.path.abspath(run_db_snapshot) if run_db_snapshot else None
+    key_dict['run_db_offline'] = run_db_offline
 
     if mc:
         key_dict['night_key'] = 'lons_night'
@@ -188,28 +208,63 @@ def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log
     else:
         key_dict['keys_to_read'] = default_common_cols + default_obs_cols
         key_dict['group_keys'] = ["night", "run_id", "event_num"]
+    return key_dict
+
+
+def process_and_write(infiles, outfile, outkey, key_dict, chunksize, engine, queue, vmem, walltime, backend, max_workers, local, port, log_dir, compression, function=run, name="ratescan_concat"):
+    '''
+    Run function on all infiles in chunks of chunksize jobs and append the
+    outputs to outkey in outfile
+    '''
+    if chunksize > 0:
+        partitions = np.array_split(infiles, 1+len(infiles)//chunksize)
+    else:
+        partitions = np.array_split(infiles, 1)
 
-    for infile in partitions:
-        jobs = make_jobs(infile, engine, queue, vmem, walltime, key_dict)
+    with HDF5Writer(outfile, key=outkey, **compressionOptions(compression)) as writer:
+        for infile in partitions:
+            jobs = make_jobs(infile, engine, queue, vmem, walltime, key_dict, function=function, name=name)
 
-        log.info("Submitting {} jobs".format(len(jobs)))
+            log.info("Submitting {} jobs".format(len(jobs)))
+
+            job_outputs = process_jobs(
+                jobs,
+                backend=backend,
+                max_workers=max_workers,
+                local=local,
+                port=port,
+                temp_dir=log_dir,
+            )
+
+            for df in tqdm(job_outputs):
+                writer.append(df)
 
-        job_arguments = dict(
-            jobs=jobs,
-            max_processes=len(jobs),
-            local=local,
-        )
 
-        if port:
-            job_arguments["port"] = port
+@click.command()
+@trigger_options
+@click.option('--outkey', help='Key of the data base in the hdf file', default="ratescan")
+@click.option('--from_summary', default=False, is_flag=True, help='Input files are per event summaries from ratescan_build_event_summary.')
+@click.option('-t', '--threshold_curve_par', nargs=2, type=click.Tuple([float, float]), multiple=True, default=(63.2, 0.551))
+def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, mc, workers, run_db_snapshot, run_db_offline, run_db_prefetch, from_summary, threshold_curve_par, backend, max_workers, compression):
+    """
+    run over list of jsonl files convert each line to pandas df and dump it to HDF5
+    """
+
+    log.info("Putting ratescans from json files into hdf5 file")
+
+    key_dict = configure_key_dict(default_key_dict, mc, workers, run_db_snapshot, run_db_offline)
+    key_dict['threshold_curve_par'] = []
+    for (a,k) in threshold_curve_par:
+        key_dict['threshold_curve_par'].append(dict(a=a, k=k))
 
-        if log_dir:
-            job_arguments["temp_dir"] = log_dir
+    key_dict['from_summary'] = from_summary
 
-        job_outputs = process_jobs(**job_arguments)
+    key_dict['run_db_table'] = prefetchRunInfo(infiles, key_dict) if run_db_prefetch and not from_summary else None
 
-        df = pd.concat(job_outputs)
-        write_data(df, outfile, key=outkey, mode='w', index=False)
+    process_and_write(
+        infiles, outfile, outkey, key_dict, chunksize, engine, queue, vmem, walltime,
+        backend, max_workers, local, port, log_dir, compression,
+    )
 
 
 if __name__ == '__main__':
@@ -8,11 +8,15 @@ import numpy as np
 import os
 from tqdm import tqdm
 
-from gridmap import Job, process_jobs
+from ..execution import Job, process_jobs, file_size, backends
 
 from ..utils import *
-from ..io import readJsonLtoDf
+from ..rundb import openRunInfoCache, prefetchRunInfo
+from ..io import readJsonLtoDf, HDF5Writer, readInput, compressionProfiles, compressionOptions
 from ..features import *
+from ..fitting import findTriggerSetThresholds, fit_methods, fit_version
+from ..cache import FitCache, cachedFits
+from ..shards import ShardSet
 
 logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
@@ -26,6 +30,16 @@ default_key_dict = dict(
     counts_key = "ratescan_trigger_counts",
     thresholds_key = "ratescan_trigger_thresholds",
     normalize=False,
+    workers=1,
+    n_primitives=1,
+    fit_engine="serial",
+    fit_method="staged",
+    fit_cache=None,
+    fit_cache_size=512,
+    run_db_snapshot=None,
+    run_db_offline=False,
+    run_db_table=None,
+    return_ratescans=False,
     )
 
 def run(
@@ -34,7 +48,8 @@ def run(
         ):
     '''
     This is what will be executed on the cluster an will do the feater extraction from 
-    ratescans
+    ratescans. With return_ratescans the summed ratescans are returned as
+    well, as (df_features, df_ratescans).
     '''
     logger = logging.getLogger(__name__)
     logger.info("stream runner has been started.")
@@ -45,18 +60,22 @@ def run(
     run_id_key = key_dict["run_id_key"] if "run_id_key" in key_dict.keys() else "run_id"
     counts_key = key_dict["counts_key"] if "counts_key" in key_dict.keys() else "ratescan_trigger_counts"
     thresholds_key = key_dict["thresholds_key"] if "thresholds_key" in key_dict.keys() else "ratescan_trigger_thresholds"
+    workers = key_dict["workers"] if "workers" in key_dict.keys() else 1
+    n_primitives = key_dict["n_primitives"] if "n_primitives" in key_dict.keys() else 1
+    fit_engine = key_dict["fit_engine"] if "fit_engine" in key_dict.keys() else "serial"
+    fit_method = key_dict["fit_method"] if "fit_method" in key_dict.keys() else "staged"
+    fit_cache = key_dict["fit_cache"] if "fit_cache" in key_dict.keys() else None
+    run_db_snapshot = key_dict["run_db_snapshot"] if "run_db_snapshot" in key_dict.keys() else None
+    run_db_offline = key_dict["run_db_offline"] if "run_db_offline" in key_dict.keys() else False
+    run_db_table = key_dict["run_db_table"] if "run_db_table" in key_dict.keys() else None
+    fit_cache_size = (key_dict["fit_cache_size"] if "fit_cache_size" in key_dict.keys() else 512) * 2**20
+    return_ratescans = key_dict["return_ratescans"] if "return_ratescans" in key_dict.keys() else False
     
     df = None
     
     relevant_keys= [night_key, event_num_key, run_id_key, counts_key, thresholds_key]
     
-    if infile_path.endswith("json.gz") or infile_path.endswith("json"):
-        df = readJsonLtoDf(infile_path, default_keys_to_store=relevant_keys)
-    elif infile_path.endswith("hdf") or infile_path.endswith("hdf5"):
-        df = read_data(infile_path, key=inkey)
-    else:
-        logger.error("input fileformat not supported")
-        df = None
+    df = readInput(infile_path, key=inkey, columns=relevant_keys, workers=workers)
         
     # at this stage we expect an data frame with coulmns containing:
     # thresholds, trigger_counts, event_ids, night_id (optional), run_id (optional)
@@ -71,49 +90,108 @@ def run(
             event_num_key=event_num_key,
             night_key=night_key,
             run_id_key=run_id_key,
+            n_primitives=n_primitives,
         )
     
     logger.info("Converting to rates")
-    df_ratescans = sumUpAndConvertToRates(
-                        df,
-                        night_key=night_key, 
-                        run_id_key=run_id_key,
-                        counts_key=counts_key, 
-                        thresholds_key=thresholds_key,
-                        rates_key="ratescan_trigger_rates",
-                        normalize=key_dict['normalize'],
-                        )
+    with openRunInfoCache(run_db_snapshot, offline=run_db_offline, table=run_db_table) as run_db_cache:
+        df_ratescans = sumUpAndConvertToRates(
+                            df,
+                            night_key=night_key, 
+                            run_id_key=run_id_key,
+                            counts_key=counts_key, 
+                            thresholds_key=thresholds_key,
+                            rates_key="ratescan_trigger_rates",
+                            normalize=key_dict['normalize'],
+                            run_db_cache=run_db_cache,
+                            )
         
     logger.info("Extracting feature: ratescanTriggerSetThreshold")
+    group_keys = [night_key, run_id_key]
+    fit = fitRatescansBatched if fit_engine == "batched" else fitRatescansSerial
+    fit_arguments = dict(
+        group_keys=group_keys,
+        rate_key="ratescan_trigger_rates",
+        thresholds_key=thresholds_key,
+        counts_key=counts_key,
+        max_threshold=5000,
+        scale=1,
+        method=fit_method,
+        )
+
+    if fit_cache:
+        # the cache key holds all arguments of the fit that change its
+        # result and the version of the fit code
+        fit_config = {k: v for k, v in fit_arguments.items() if k not in ["group_keys", "rate_key", "thresholds_key", "counts_key"]}
+        with FitCache(fit_cache, max_size=fit_cache_size) as cache:
+            df_ratescan_fits = cachedFits(
+                df_ratescans,
+                lambda df_missing: fit(df_missing, **fit_arguments),
+                cache,
+                group_keys=group_keys,
+                rate_key=fit_arguments["rate_key"],
+                thresholds_key=thresholds_key,
+                counts_key=counts_key if fit_method == "weighted" else None,
+                fit_engine=fit_engine,
+                fit_version=fit_version,
+                **fit_config
+                )
+    else:
+        df_ratescan_fits = fit(df_ratescans, **fit_arguments)
+
+    if len(df_ratescan_fits) == 0:
+        df_result = pd.DataFrame()
+    else:
+        df_result = pd.merge(df_thresholds, df_ratescan_fits, how="inner", on=group_keys)
+        df_result["infile_path"] = infile_path
+
+    if return_ratescans:
+        df_ratescans["infile_path"] = infile_path
+        return df_result, df_ratescans
+    return df_result
+
+
+def fitRatescansBatched(df_ratescans, group_keys, rate_key, thresholds_key, counts_key, max_threshold, scale, method):
+    return findTriggerSetThresholds(
+        df_ratescans,
+        group_keys=group_keys,
+        max_threshold=max_threshold,
+        scale=scale,
+        rate_key=rate_key,
+        thresholds_key=thresholds_key,
+        method=method,
+        counts_key=counts_key,
+        )
+
+
+def fitRatescansSerial(df_ratescans, group_keys, rate_key, thresholds_key, counts_key, max_threshold, scale, method):
     ss = []
     
-    for k, ((night, run_id), group) in enumerate(df_ratescans.groupby([night_key, run_id_key])):
+    for k, ((night, run_id), group) in enumerate(df_ratescans.groupby(group_keys)):
         if len(group) == 0:
             continue
         s_fit_results = findTriggerSetThreshold(
             group,
-            rate_key = "ratescan_trigger_rates", 
+            max_threshold=max_threshold,
+            scale=scale,
+            rate_key=rate_key,
             thresholds_key=thresholds_key,
+            method=method,
+            counts_key=counts_key,
             )
         if s_fit_results is None:
             continue
-        s_fit_results[night_key] = night
-        s_fit_results[run_id_key] = run_id
+        s_fit_results[group_keys[0]] = night
+        s_fit_results[group_keys[1]] = run_id
 
         ss.append(s_fit_results)
 
-    try:
-        df_ratescan_fits = pd.concat(ss, axis=1).T
-        df_ratescan_fits = df_ratescan_fits.apply(to_numeric_if_possible, axis=0)
-
-        df_result = pd.merge(df_thresholds, df_ratescan_fits, how="inner", on=[night_key, run_id_key])
-
-        df_result["infile_path"] = infile_path
-
-        return df_result
-    except ValueError:
+    if len(ss) == 0:
         return pd.DataFrame()
 
+    df_ratescan_fits = pd.concat(ss, axis=1).T
+    return df_ratescan_fits.apply(to_numeric_if_possible, axis=0)
+
 
 def make_jobs(infiles, key_dict, engine, queue, vmem, walltime):
     jobs = []
@@ -130,6 +208,7 @@ def make_jobs(infiles, key_dict, engine, queue, vmem, walltime):
                walltime=walltime,
                engine=engine,
                name="{}_ratescan_feature_extract".format(num),
+               size=file_size(infile),
                mem_free='{}mb'.format(vmem)
                )
            )
@@ -138,7 +217,7 @@ def make_jobs(infiles, key_dict, engine, queue, vmem, walltime):
 
 
 @click.command()
-@click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True))
+@click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=True, file_okay=True, readable=True))
 @click.argument('outfile', type=click.Path(exists=False, dir_okay=False, file_okay=True, readable=True))
 @click.option('--outkey', help='Key of the data base in the hdf file', default="ratescan")
 @click.option('--queue', help='Name of the queue you want to send jobs to.', default='one_day')
@@ -150,49 +229,95 @@ def make_jobs(infiles, key_dict, engine, queue, vmem, walltime):
 @click.option("--log_dir", type=click.Path(exists=False, dir_okay=True, file_okay=False, readable=True), help='Directory to store output from m gridmap jobs', default=None)
 @click.option('--port', help='The port through which to communicate with the JobMonitor', default=None, type=int)
 @click.option('--local', default=False,is_flag=True,   help='Flag indicating whether jobs should be executed localy .')
+@click.option('--backend', help='Backend used to execute the jobs.', type=click.Choice(backends), default='gridmap')
+@click.option('--max_workers', help='Number of local processes for the pool backend, default is the number of cpus.', default=None, type=click.INT)
+@click.option('--compression', help='Compression profile of the written hdf5 datasets.', type=click.Choice(list(compressionProfiles())), default='none')
+@click.option('--shard_dir', type=click.Path(exists=False, dir_okay=True, file_okay=False), help='Write one shard per input file to this directory and skip input files whose shard is done, the shards are merged into OUTFILE.', default=None)
+@click.option('--run_db_snapshot', type=click.Path(exists=False, dir_okay=False, file_okay=True), help='SQLite snapshot of the run database, missing nights are fetched with one query.', default=None)
+@click.option('--run_db_offline', default=False, is_flag=True, help='Only use the run db snapshot, never query the run database.')
+@click.option('--run_db_prefetch/--no_run_db_prefetch', default=False, help='Read the runs of all input files in the driver first and fetch their run infos with one query for all jobs, jsonl inputs are decoded for this.')
 @click.option('--mc', default=False, is_flag=True,   help='Flag indicating whether input files are mcs.')
-def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, mc):
+@click.option('--workers', help='Number of processes used to decode json input files.', default=1, type=click.INT)
+@click.option('--fit_engine', help='Fit all runs of a file at once (batched) or one after another with curve_fit (serial).', type=click.Choice(['batched', 'serial']), default='serial')
+@click.option('--fit_method', help='Fit the shower, nsb and full model one after another (staged) or only the full model to the log rates weighted with the poisson uncertainty of the counts (weighted).', type=click.Choice(fit_methods), default='staged')
+@click.option('--fit_cache', type=click.Path(exists=False, dir_okay=False, file_okay=True), help='SQLite file to cache fit results, runs with an unchanged ratescan are not fitted again.', default=None)
+@click.option('--fit_cache_size', help='Maximum size of the fit cache in MB, least recently used fits are removed.', default=512, type=click.INT)
+@click.option('--n_primitives', help='Number of triggering patches for maxPossibleThreshold2Keep, can be given several times.', default=[1], type=click.INT, multiple=True)
+def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, mc, workers, n_primitives, fit_engine, fit_method, fit_cache, fit_cache_size, run_db_snapshot, run_db_offline, run_db_prefetch, backend, max_workers, compression, shard_dir):
     """
     run over list of jsonl files convert each line to pandas df and dump it to HDF5
     """
 
     log.info("Putting ratescans from json files into hdf5 file")
     
+    if mc:
+        default_key_dict['night_key']  = "lons_night"
+        default_key_dict['run_id_key'] = "lons_run_id"
+        default_key_dict['normalize'] = True
+
+    default_key_dict['workers'] = workers
+    default_key_dict['fit_engine'] = fit_engine
+    default_key_dict['fit_method'] = fit_method
+    default_key_dict['fit_cache'] = os.path.abspath(fit_cache) if fit_cache else None
+    default_key_dict['fit_cache_size'] = fit_cache_size
+    default_key_dict['run_db_snapshot'] = os.path.abspath(run_db_snapshot) if run_db_snapshot else None
+    default_key_dict['run_db_offline'] = run_db_offline
+
+    default_key_dict['n_primitives'] = n_primitives[0] if len(n_primitives) == 1 else list(n_primitives)
+
+    if shard_dir is not None:
+        # settings that do not change the results are not part of the shard config
+        config = {k: v for k, v in default_key_dict.items() if k not in ['workers', 'fit_cache', 'fit_cache_size', 'run_db_table']}
+        shards = ShardSet(shard_dir, infiles, key=outkey, config=config)
+        infiles = shards.pending()
+        log.info("{} of {} input files have to be processed".format(len(infiles), len(shards.infiles)))
+
     if chunksize > 0:
         partitions = np.array_split(infiles, 1+len(infiles)//chunksize)
     else:
         partitions = np.array_split(infiles, 1)
 
-    if mc:
-        default_key_dict['night_key']  = "lons_night"
-        default_key_dict['run_id_key'] = "lons_run_id"
-        default_key_dict['normalize'] = True
+    default_key_dict['run_db_table'] = prefetchRunInfo(infiles, default_key_dict) if run_db_prefetch else None
 
-    for infile in partitions:
-        jobs = make_jobs(infile, default_key_dict, engine, queue, vmem, walltime)
+    if shard_dir is not None:
+        for infile in partitions:
+            jobs = make_jobs(infile, default_key_dict, engine, queue, vmem, walltime)
+            jobs = [shards.wrap(job, f) for job, f in zip(jobs, infile)]
 
-        log.info("Submitting {} jobs".format(len(jobs)))
+            log.info("Submitting {} jobs".format(len(jobs)))
 
-        job_arguments = dict(
-            jobs=jobs,
-            max_processes=len(jobs),
-            local=local,
-        )
+            for n_rows in tqdm(process_jobs(
+                jobs,
+                backend=backend,
+                max_workers=max_workers,
+                local=local,
+                port=port,
+                temp_dir=log_dir,
+            )):
+                pass
 
-        if port:
-            job_arguments["port"] = port
+        shards.merge(outfile, compression=compression)
+        return
 
-        if log_dir:
-            job_arguments["temp_dir"] = log_dir
+    with HDF5Writer(outfile, key=outkey, **compressionOptions(compression)) as writer:
+        for infile in partitions:
+            jobs = make_jobs(infile, default_key_dict, engine, queue, vmem, walltime)
 
-        job_outputs = process_jobs(**job_arguments)
+            log.info("Submitting {} jobs".format(len(jobs)))
+
+            job_outputs = process_jobs(
+                jobs,
+                backend=backend,
+                max_workers=max_workers,
+                local=local,
+                port=port,
+                temp_dir=log_dir,
+            )
 
-        mode = 'w'
-        for k, df in tqdm(enumerate(job_outputs)):
-            if len(df) == 0:
-                continue
-            write_data(df, outfile, key=outkey, mode=mode, index=False)
-            mode = 'a'
+            for df in tqdm(job_outputs):
+                if len(df) == 0:
+                    continue
+                writer.append(df)
 
 
 if __name__ == '__main__':
@@ -8,10 +8,11 @@ import numpy as np
 import os
 from tqdm import tqdm
 
-from gridmap import Job, process_jobs
+from ..execution import Job, process_jobs, file_size, backends
 
 from ..utils import *
-from ..io import readJsonLtoDf
+from ..rundb import openRunInfoCache, prefetchRunInfo
+from ..io import readJsonLtoDf, HDF5Writer, readInput, iterInput, compressionProfiles, compressionOptions
 from ..features import *
 
 logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
@@ -26,6 +27,11 @@ default_key_dict = dict(
     counts_key = "ratescan_trigger_counts",
     thresholds_key = "ratescan_trigger_thresholds",
     normalize = False,
+    workers = 1,
+    run_db_snapshot = None,
+    run_db_offline = False,
+    run_db_table = None,
+    chunk_rows = 0,
     )
 
 def run(
@@ -45,16 +51,39 @@ def run(
     run_id_key = key_dict["run_id_key"] if "run_id_key"  in key_dict.keys() else "run_id"
     counts_key = key_dict["counts_key"] if "counts_key"  in key_dict.keys() else "ratescan_trigger_counts"
     thresholds_key = key_dict["thresholds_key"] if "thresholds_key" in key_dict.keys() else "ratescan_trigger_thresholds"
+    workers = key_dict["workers"] if "workers" in key_dict.keys() else 1
+    run_db_snapshot = key_dict["run_db_snapshot"] if "run_db_snapshot" in key_dict.keys() else None
+    run_db_offline = key_dict["run_db_offline"] if "run_db_offline" in key_dict.keys() else False
+    run_db_table = key_dict["run_db_table"] if "run_db_table" in key_dict.keys() else None
+    chunk_rows = key_dict["chunk_rows"] if "chunk_rows" in key_dict.keys() else 0
 
     relevant_keys= [night_key, event_num_key, run_id_key, counts_key, thresholds_key]
-    
-    if infile_path.endswith("json.gz") or infile_path.endswith("json"):
-        df = readJsonLtoDf(infile_path, default_keys_to_store=relevant_keys)
-    elif infile_path.endswith("hdf") or infile_path.endswith("hdf5"):
-        df = read_data(infile_path, key=inkey)
-    else:
-        logger.error("input fileformat not supported")
-        df = None
+
+    if chunk_rows > 0:
+        # only one chunk of the file is in memory, the counts are summed
+        # per run and threshold and converted to rates at the end
+        logger.info("Summing up runs in chunks of {} rows".format(chunk_rows))
+        accumulator = RatescanAccumulator(
+            group_keys=[night_key, run_id_key], counts_key=counts_key, thresholds_key=thresholds_key
+        )
+        for df_chunk in iterInput(infile_path, key=inkey, columns=relevant_keys, chunk_rows=chunk_rows):
+            accumulator.add(df_chunk)
+
+        logger.info("Converting to rates")
+        with openRunInfoCache(run_db_snapshot, offline=run_db_offline, table=run_db_table) as run_db_cache:
+            df_result = convertToRates(
+                                accumulator.result(),
+                                night_key=night_key,
+                                run_id_key=run_id_key,
+                                counts_key=counts_key,
+                                rates_key="ratescan_trigger_rates",
+                                normalize=key_dict['normalize'],
+                                run_db_cache=run_db_cache,
+                                )
+        df_result["infile_path"] = infile_path
+        return df_result
+
+    df = readInput(infile_path, key=inkey, columns=relevant_keys, workers=workers)
         
     # at this stage we expect an data frame with coulmns containing:
     # thresholds, trigger_counts, event_ids, night_id (optional), run_id (optional)
@@ -62,15 +91,17 @@ def run(
     # df_features = df[df[thresholds_key] == df[thresholds_key].min()]
 
     logger.info("Summing up runs and converting to rates")
-    df_result = sumUpAndConvertToRates(
-                        df,
-                        night_key=night_key, 
-                        run_id_key=run_id_key,
-                        counts_key=counts_key, 
-                        thresholds_key=thresholds_key,
-                        rates_key="ratescan_trigger_rates",
-                        normalize=key_dict['normalize'],
-                        )
+    with openRunInfoCache(run_db_snapshot, offline=run_db_offline, table=run_db_table) as run_db_cache:
+        df_result = sumUpAndConvertToRates(
+                            df,
+                            night_key=night_key, 
+                            run_id_key=run_id_key,
+                            counts_key=counts_key, 
+                            thresholds_key=thresholds_key,
+                            rates_key="ratescan_trigger_rates",
+                            normalize=key_dict['normalize'],
+                            run_db_cache=run_db_cache,
+                            )
 
     df_result["infile_path"] = infile_path
     
@@ -92,6 +123,7 @@ def make_jobs(infiles, key_dict, engine, queue, vmem, walltime):
                walltime=walltime,
                engine=engine,
                name="{}_ratescan_feature_extract".format(num),
+               size=file_size(infile),
                mem_free='{}mb'.format(vmem)
                )
            )
@@ -100,7 +132,7 @@ def make_jobs(infiles, key_dict, engine, queue, vmem, walltime):
 
 
 @click.command()
-@click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True) )
+@click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=True, file_okay=True, readable=True) )
 @click.argument('outfile', type=click.Path(exists=False, dir_okay=False, file_okay=True, readable=True) )
 @click.option('--outkey', help='Key of the data base in the hdf file', default="ratescan")
 @click.option('--queue', help='Name of the queue you want to send jobs to.', default='one_day')
@@ -112,8 +144,16 @@ def make_jobs(infiles, key_dict, engine, queue, vmem, walltime):
 @click.option("--log_dir", type=click.Path(exists=False, dir_okay=True, file_okay=False, readable=True), help='Directory to store output from m gridmap jobs', default=None)
 @click.option('--port', help='The port through which to communicate with the JobMonitor', default=None, type=int)
 @click.option('--local', default=False, is_flag=True,   help='Flag indicating whether jobs should be executed localy .')
+@click.option('--backend', help='Backend used to execute the jobs.', type=click.Choice(backends), default='gridmap')
+@click.option('--max_workers', help='Number of local processes for the pool backend, default is the number of cpus.', default=None, type=click.INT)
+@click.option('--compression', help='Compression profile of the written hdf5 datasets.', type=click.Choice(list(compressionProfiles())), default='none')
+@click.option('--chunk_rows', help='Read the input files in chunks of this many rows to bound the memory, 0 reads each file at once.', default=0, type=click.INT)
+@click.option('--run_db_snapshot', type=click.Path(exists=False, dir_okay=False, file_okay=True), help='SQLite snapshot of the run database, missing nights are fetched with one query.', default=None)
+@click.option('--run_db_offline', default=False, is_flag=True, help='Only use the run db snapshot, never query the run database.')
+@click.option('--run_db_prefetch/--no_run_db_prefetch', default=False, help='Read the runs of all input files in the driver first and fetch their run infos with one query for all jobs, jsonl inputs are decoded for this.')
 @click.option('--mc', default=False, is_flag=True,   help='Flag indicating whether input files are mcs.')
-def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, mc):
+@click.option('--workers', help='Number of processes used to decode json input files.', default=1, type=click.INT)
+def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, mc, workers, run_db_snapshot, run_db_offline, run_db_prefetch, backend, max_workers, compression, chunk_rows):
     """
     run over list of jsonl files convert each line to pandas df and dump it to HDF5
     """
@@ -131,28 +171,30 @@ def main(infiles, outfile, outkey, queue, walltime, engine, vmem, chunksize, log
         default_key_dict['run_id_key'] = "lons_run_id"
         default_key_dict['normalize'] = True
 
-    for infile in partitions:
-        jobs = make_jobs(infile, default_key_dict, engine, queue, vmem, walltime)
-
-        log.info("Submitting {} jobs".format(len(jobs)))
+    default_key_dict['workers'] = workers
+    default_key_dict['run_db_snapshot'] = os.path.abspath(run_db_snapshot) if run_db_snapshot else None
+    default_key_dict['run_db_offline'] = run_db_offline
+    default_key_dict['chunk_rows'] = chunk_rows
 
-        job_arguments = dict(
-            jobs=jobs,
-            max_processes=len(jobs),
-            local=local,
-        )
+    default_key_dict['run_db_table'] = prefetchRunInfo(infiles, default_key_dict) if run_db_prefetch else None
 
-        if port:
-            job_arguments["port"] = port
+    with HDF5Writer(outfile, key=outkey, **compressionOptions(compression)) as writer:
+        for infile in partitions:
+            jobs = make_jobs(infile, default_key_dict, engine, queue, vmem, walltime)
 
-        if log_dir:
-            job_arguments["temp_dir"] = log_dir
+            log.info("Submitting {} jobs".format(len(jobs)))
 
-        job_outputs = process_jobs(**job_arguments)
+            job_outputs = process_jobs(
+                jobs,
+                backend=backend,
+                max_workers=max_workers,
+                local=local,
+                port=port,
+                temp_dir=log_dir,
+            )
 
-        for k, df in tqdm(enumerate(job_outputs)):
-            mode = 'w' if k < 1 else "a"
-            write_data(df, outfile, key=outkey, mode=mode, index=False)
+            for df in tqdm(job_outputs):
+                writer.append(df)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+import click
+import logging
+
+from ..rundb import RunInfoCache
+
+logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+@click.command()
+@click.argument('snapshot', type=click.Path(exists=False, dir_okay=False, file_okay=True))
+@click.argument('first_night', type=click.INT)
+@click.argument('last_night', type=click.INT)
+def main(snapshot, first_night, last_night):
+    """
+    Fetch all runs between FIRST_NIGHT and LAST_NIGHT (YYYYMMDD) from the run
+    database into the sqlite SNAPSHOT with one query. Jobs can then use the
+    snapshot with --run_db_snapshot and --run_db_offline.
+    """
+    with RunInfoCache(snapshot) as run_db:
+        run_db.fetch(first_night, last_night)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ from fact.factdb.utils import read_into_dataframe
 from peewee import SQL, fn
 
 from ..features import findTriggerSetThreshold
+from ..io import readInput, readRunKeys
 from ..models import *
 
 logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
@@ -44,19 +45,26 @@ def main(infile, outfile, key, run_id, night, run_id_key, night_key, counts_key,
     """
     
     log.info("reading {}".format(infile))
-    df = read_data(infile, key=key)
-            
-    if len(df[df[night_key] == night]) == 0:
-        night = df[night_key].unique()[0]
-        
-    df = df[df[night_key] == night]
-    
-    
-    if len(df[df[run_id_key] == run_id]) == 0:
-        run_id = df[run_id_key].unique()[0]
-    
-    df = df[df[run_id_key] == run_id]
-        
+    # only the runs are read to pick the run, then only its rows
+    df_runs = readRunKeys(infile, night_key=night_key, run_id_key=run_id_key, inkey=key)
+
+    if len(df_runs[df_runs[night_key] == night]) == 0:
+        night = df_runs[night_key].unique()[0]
+
+    df_runs = df_runs[df_runs[night_key] == night]
+
+    if len(df_runs[df_runs[run_id_key] == run_id]) == 0:
+        run_id = df_runs[run_id_key].unique()[0]
+
+    df = readInput(
+        infile,
+        key=key,
+        columns=[counts_key, thresholds_key, run_id_key, night_key],
+        runs=[(night, run_id)],
+        night_key=night_key,
+        run_id_key=run_id_key,
+    )
+
     df = df[[
         counts_key,
         thresholds_key,
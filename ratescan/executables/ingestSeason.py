@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import pandas as pd
+import click
+import logging
+import numpy as np
+import os
+from tqdm import tqdm
+
+from ..execution import process_jobs, backends
+from ..rundb import prefetchRunInfo
+from ..io import compressionProfiles
+from ..season import SeasonStore
+from ..fitting import fit_methods
+from .extractFeaturesPerRun import default_key_dict, make_jobs
+
+logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+@click.command()
+@click.argument('infiles', nargs=-1, type=click.Path(exists=True, dir_okay=True, file_okay=True, readable=True))
+@click.argument('store', type=click.Path(exists=False, dir_okay=True, file_okay=False))
+@click.option('--queue', help='Name of the queue you want to send jobs to.', default='one_day')
+@click.option('--walltime', help='Estimated maximum walltime of your job in format hh:mm:ss.', default='02:00:00')
+@click.option('--engine', help='Name of the grid engine used by the cluster.', type=click.Choice(['PBS', 'SGE',]), default='PBS')
+@click.option('--vmem', help='Amount of memory to use per node in MB.', default='10000', type=click.INT)
+@click.option('--chunksize', help='number of simultaneus submitted jobs.', default='0', type=click.INT)
+@click.option('--log_level', type=click.Choice(['INFO', 'DEBUG', 'WARN']), help='increase output verbosity', default='INFO')
+@click.option("--log_dir", type=click.Path(exists=False, dir_okay=True, file_okay=False, readable=True), help='Directory to store output from m gridmap jobs', default=None)
+@click.option('--port', help='The port through which to communicate with the JobMonitor', default=None, type=int)
+@click.option('--local', default=False, is_flag=True, help='Flag indicating whether jobs should be executed localy .')
+@click.option('--backend', help='Backend used to execute the jobs.', type=click.Choice(backends), default='gridmap')
+@click.option('--max_workers', help='Number of local processes for the pool backend, default is the number of cpus.', default=None, type=click.INT)
+@click.option('--compression', help='Compression profile of the written hdf5 datasets.', type=click.Choice(list(compressionProfiles())), default='none')
+@click.option('--workers', help='Number of processes used to decode json input files.', default=1, type=click.INT)
+@click.option('--n_primitives', help='Number of triggering patches for maxPossibleThreshold2Keep, can be given several times.', default=[1], type=click.INT, multiple=True)
+@click.option('--fit_engine', help='Fit all runs of a file at once (batched) or one after another with curve_fit (serial).', type=click.Choice(['batched', 'serial']), default='serial')
+@click.option('--fit_method', help='Fit the shower, nsb and full model one after another (staged) or only the full model to the log rates weighted with the poisson uncertainty of the counts (weighted).', type=click.Choice(fit_methods), default='staged')
+@click.option('--fit_cache', type=click.Path(exists=False, dir_okay=False, file_okay=True), help='SQLite file to cache fit results, runs with an unchanged ratescan are not fitted again.', default=None)
+@click.option('--fit_cache_size', help='Maximum size of the fit cache in MB, least recently used fits are removed.', default=512, type=click.INT)
+@click.option('--run_db_snapshot', type=click.Path(exists=False, dir_okay=False, file_okay=True), help='SQLite snapshot of the run database, missing nights are fetched with one query.', default=None)
+@click.option('--run_db_offline', default=False, is_flag=True, help='Only use the run db snapshot, never query the run database.')
+@click.option('--run_db_prefetch/--no_run_db_prefetch', default=False, help='Read the runs of all input files in the driver first and fetch their run infos with one query for all jobs, jsonl inputs are decoded for this.')
+def main(infiles, store, queue, walltime, engine, vmem, chunksize, log_level, log_dir, port, local, backend, max_workers, compression, workers, n_primitives, fit_engine, fit_method, fit_cache, fit_cache_size, run_db_snapshot, run_db_offline, run_db_prefetch):
+    """
+    Add the runs in INFILES to the season STORE, a directory with one hdf5
+    file per night holding the summed ratescans (table ratescans) and the
+    features with the fit results and the max possible threshold to keep
+    (table features). Runs that are already in the store are replaced, only
+    the nights of the new runs are rewritten.
+    """
+    log.info("Ingesting {} files into the season store {}".format(len(infiles), store))
+
+    key_dict = dict(default_key_dict)
+    key_dict['workers'] = workers
+    key_dict['fit_engine'] = fit_engine
+    key_dict['fit_method'] = fit_method
+    key_dict['fit_cache'] = os.path.abspath(fit_cache) if fit_cache else None
+    key_dict['fit_cache_size'] = fit_cache_size
+    key_dict['run_db_snapshot'] = os.path.abspath(run_db_snapshot) if run_db_snapshot else None
+    key_dict['run_db_offline'] = run_db_offline
+    key_dict['n_primitives'] = n_primitives[0] if len(n_primitives) == 1 else list(n_primitives)
+    key_dict['return_ratescans'] = True
+
+    key_dict['run_db_table'] = prefetchRunInfo(infiles, key_dict) if run_db_prefetch else None
+
+    if chunksize > 0:
+        partitions = np.array_split(infiles, 1+len(infiles)//chunksize)
+    else:
+        partitions = np.array_split(infiles, 1)
+
+    season_store = SeasonStore(
+        store,
+        night_key=key_dict['night_key'],
+        run_id_key=key_dict['run_id_key'],
+        compression=compression,
+    )
+
+    for infile in partitions:
+        jobs = make_jobs(infile, key_dict, engine, queue, vmem, walltime)
+
+        log.info("Submitting {} jobs".format(len(jobs)))
+
+        job_outputs = process_jobs(
+            jobs,
+            backend=backend,
+            max_workers=max_workers,
+            local=local,
+            port=port,
+            temp_dir=log_dir,
+        )
+
+        for df_features, df_ratescans in tqdm(job_outputs):
+            season_store.write(dict(features=df_features, ratescans=df_ratescans))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+log = logging.getLogger(__name__)
+
+backends = ['gridmap', 'pool']
+
+
+class Job:
+    '''
+    Backend independent description of a job, a function and its arguments.
+    size is used to order the jobs, e.g. the size of the input file,
+    all other keyword arguments are passed to gridmap.Job.
+    '''
+
+    def __init__(self, function, args, name="ratescan_job", size=0, **options):
+        self.function = function
+        self.args = args
+        self.name = name
+        self.size = size
+        self.options = options
+
+
+def file_size(path):
+    try:
+        if os.path.isdir(path):
+            return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _process_jobs_gridmap(jobs, local=False, port=None, temp_dir=None):
+    from gridmap import Job as GridmapJob, process_jobs
+
+    gridmap_jobs = [
+        GridmapJob(job.function, job.args, name=job.name, **job.options)
+        for job in jobs
+    ]
+
+    job_arguments = dict(
+        jobs=gridmap_jobs,
+        max_processes=len(gridmap_jobs),
+        local=local,
+    )
+
+    if port:
+        job_arguments["port"] = port
+
+    if temp_dir:
+        job_arguments["temp_dir"] = temp_dir
+
+    for output in process_jobs(**job_arguments):
+        yield output
+
+
+def _process_jobs_pool(jobs, max_workers=None):
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(job.function, *job.args): job for job in jobs}
+        for future in as_completed(futures):
+            log.debug("job {} finished".format(futures[future].name))
+            yield future.result()
+
+
+def process_jobs(jobs, backend="gridmap", max_workers=None, local=False, port=None, temp_dir=None):
+    '''
+    Run the given jobs with the chosen backend, largest jobs first, and
+    yield their outputs.
+
+    gridmap: submit all jobs to the grid engine (or gridmaps local mode)
+             and yield the outputs once all jobs are done
+    pool:    run the jobs in a local process pool with max_workers
+             processes and yield each output as soon as its job is done
+    '''
+    jobs = sorted(jobs, key=lambda job: job.size, reverse=True)
+
+    log.debug("running {} jobs with the {} backend".format(len(jobs), backend))
+
+    if backend == "gridmap":
+        return _process_jobs_gridmap(jobs, local=local, port=port, temp_dir=temp_dir)
+    elif backend == "pool":
+        return _process_jobs_pool(jobs, max_workers=max_workers)
+    else:
+        raise ValueError("Unknown backend {}, choose one of {}".format(backend, backends))
@@ -2,9 +2,17 @@ import numpy as np
 import pandas as pd
 import logging
 import math as m
-from scipy.optimize import root, curve_fit
+from scipy.optimize import curve_fit
 
-from .models import (powerLaw, nsbContribution, ratescan_func)
+from .models import (
+    powerLaw, nsbContribution, ratescan_func,
+    powerLawJacobian, nsbContributionJacobian, ratescan_funcJacobian,
+    powerLawInitialGuess, nsbContributionInitialGuess,
+    logRatescan_func, logRatescan_funcJacobian, ratescan_funcBounds,
+)
+from .container import Ratescan, factorize_keys
+from .trigger import maxPrimitivesThresholdName
+from .fitting import setThresholdRoots, fit_methods
 
 logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
@@ -26,38 +34,186 @@ def maxPossibleThreshold2Keep(
     thresholds_key get per night and run_id the value of the highest possilble 
     trigger threshold to trigger n_primitives,
     
-    return value is either a data frame with several runs or a single value in case only one run was provided
+    return value is a data frame with one row per night and run_id. For a
+    single n_primitives the value is stored in the column thresholds_key,
+    for a list of n_primitives there is one column
+    max_possible_threshold_key + "_" + n per value.
+
+    df can also be a Ratescan, then the per event maximum is taken directly
+    on its count matrix
     """
-    event_keys = [event_num_key, run_id_key, night_key]
-    
-    # Get all events with n_primitives triggering patches
-    df_tmp = df[df[counts_key] == n_primitives]
-    groups = df_tmp[[*event_keys, thresholds_key]].groupby(event_keys)
-    
-    df_tmp = groups.max()
-    
-    df_tmp.reset_index(inplace=True)
-    
-    df_tmp.drop([event_num_key], axis=1, inplace=True)
-    
-    # now we havethe max possible threshold to keep for each event. 
+    n_values = np.atleast_1d(n_primitives)
+    run_keys = [night_key, run_id_key]
+
+    if isinstance(df, Ratescan):
+        df_events = _maxThresholdPerEvent(df, n_values, [event_num_key, *run_keys])
+    else:
+        df_events = _maxThresholdPerEventSorted(
+            df, n_values, [event_num_key, *run_keys], counts_key, thresholds_key
+        )
+
+    # now we have the max possible threshold to keep for each event.
     # Next step is to find the event with the smallest possible threshold.
-    group_keys = None
-    if all(key in event_keys for key in [night_key, run_id_key]):
-        group_keys = [night_key, run_id_key]
-    elif run_id_key in event_keys:
-        group_keys = run_id_key
-    
-    if group_keys:
-        df_tmp = df_tmp.groupby(group_keys).min()
-        df_tmp.rename({thresholds_key: max_possible_threshold_key}, inplace=True)
-        df_tmp = df_tmp.reset_index()
-        return df_tmp
+    run_columns = [df_events[k] for k in run_keys]
+    codes, _ = factorize_keys([*run_columns, df_events["n_index"]])
+    starts, order = _sortedGroups(codes)
+    if len(codes) > 0:
+        thresholds = np.minimum.reduceat(df_events["threshold"][order], starts)
     else:
-        return df_tmp.min()
+        thresholds, starts = df_events["threshold"], starts[:0]
+    first = order[starts]
+
+    runs, run_codes = _sortedUniqueRows([c[first] for c in run_columns])
+    result = pd.DataFrame({k: c for k, c in zip(run_keys, runs)})
+
+    if np.ndim(n_primitives) == 0:
+        column = np.empty(len(result), dtype=thresholds.dtype)
+        column[run_codes] = thresholds
+        result[thresholds_key] = column
+        return result
+
+    n_index = df_events["n_index"][first]
+    for i, n in enumerate(n_values):
+        column = np.full(len(result), np.nan)
+        column[run_codes[n_index == i]] = thresholds[n_index == i]
+        result["{}_{}".format(max_possible_threshold_key, n)] = column
+    return result
+
+
+def maxPossibleThreshold2KeepFromSummary(
+        df_summary,
+        thresholds_key = "ratescan_trigger_thresholds",
+        night_key = "night",
+        run_id_key = "run_id",
+        max_possible_threshold_key = "max_possible_threshold_to_keep",
+        n_primitives = 1,
+        ):
+    """
+    maxPossibleThreshold2Keep from a per event summary of
+    trigger.buildEventSummary instead of the raw ratescan rows, with the
+    same output columns. The summary must contain the column of every
+    requested n_primitives. The summary stores thresholds as float32, for a
+    single n_primitives they are cast back to int.
+    """
+    n_values = np.atleast_1d(n_primitives)
+    columns = {maxPrimitivesThresholdName(n): n for n in n_values}
+    missing = [k for k in columns if k not in df_summary.columns]
+    if missing:
+        raise KeyError("Event summary has no columns {}".format(missing))
+
+    result = df_summary.groupby([night_key, run_id_key], sort=True)[list(columns)].min()
+
+    if np.ndim(n_primitives) == 0:
+        result = result.dropna().rename(columns={maxPrimitivesThresholdName(n_primitives): thresholds_key})
+        result[thresholds_key] = result[thresholds_key].astype(np.int64)
+        return result.reset_index()
+
+    return result.rename(
+        columns={k: "{}_{}".format(max_possible_threshold_key, n) for k, n in columns.items()}
+    ).reset_index()
+
+
+def _sortedGroups(codes):
+    """
+    Sort group codes and return the start of each group in the sorted
+    order together with the sorting order
+    """
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+    return starts, order
+
+
+def _sortedUniqueRows(columns):
+    """
+    Lexicographically sorted unique rows of the given key columns and the
+    position of each input row in that sorted unique list
+    """
+    order = np.lexsort(columns[::-1])
+    sorted_columns = [c[order] for c in columns]
+    is_new = np.zeros(len(order), dtype=bool)
+    is_new[:1] = True
+    for c in sorted_columns:
+        is_new[1:] |= c[1:] != c[:-1]
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.cumsum(is_new) - 1
+    return [c[is_new] for c in sorted_columns], position
+
+
+def _maxThresholdPerEventSorted(df, n_values, event_keys, counts_key, thresholds_key):
+    """
+    Highest threshold of each event with exactly n triggering patches for
+    every n in n_values, computed with np.maximum.reduceat.
+
+    Rows of one event are usually contiguous, so the maximum is first taken
+    over runs of equal keys in file order, only these segments are then
+    factorized and sorted to merge events that are split up.
+    """
+    counts = df[counts_key].values
+    n_index = np.full(len(counts), -1, dtype=np.int64)
+    for i, n in enumerate(n_values):
+        n_index[counts == n] = i
+    selected = np.flatnonzero(n_index >= 0)
+    n_index = n_index[selected]
+
+    event_columns = [df[k].values[selected] for k in event_keys]
+    thresholds = df[thresholds_key].values[selected]
+
+    is_start = np.ones(len(selected), dtype=bool)
+    for column in [*event_columns, n_index]:
+        is_start[1:] = is_start[1:] & (column[1:] == column[:-1])
+    is_start[1:] = ~is_start[1:]
+    starts = np.flatnonzero(is_start)
+
+    thresholds = np.maximum.reduceat(thresholds, starts) if len(starts) > 0 else thresholds[:0]
+    event_columns = [c[starts] for c in event_columns]
+    n_index = n_index[starts]
+
+    codes, first = factorize_keys([*event_columns, n_index])
+    if len(first) < len(codes):
+        group_starts, order = _sortedGroups(codes)
+        thresholds = np.maximum.reduceat(thresholds[order], group_starts)
+        first = order[group_starts]
+        event_columns = [c[first] for c in event_columns]
+        n_index = n_index[first]
+
+    df_events = {k: c for k, c in zip(event_keys, event_columns)}
+    df_events["n_index"] = n_index
+    df_events["threshold"] = thresholds
+    return df_events
+
+
+def _maxThresholdPerEvent(ratescan, n_values, event_keys):
+    """
+    Highest threshold of each event with exactly n triggering patches for
+    every n in n_values, taken on the count matrix of a Ratescan
+    """
+    columns = {k: [] for k in [*event_keys, "n_index", "threshold"]}
+    for i, n in enumerate(n_values):
+        mask = ratescan.counts == n
+        has_threshold = mask.any(axis=1)
+        # thresholds are sorted, so the last matching column is the maximum
+        last = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
 
+        for k in event_keys:
+            columns[k].append(ratescan.events[k][has_threshold])
+        columns["n_index"].append(np.full(has_threshold.sum(), i))
+        columns["threshold"].append(ratescan.thresholds[last[has_threshold]])
 
-def fit_given_range(df_ranged, thresholds_key, rate_key, func, p0=None):
+    return {k: np.concatenate(v) for k, v in columns.items()}
+
+
+def initial_guess(df_ranged, thresholds_key, rate_key, guess, default):
+    """
+    Data driven starting values for a fit, default if they can not be
+    estimated from the given range
+    """
+    p0 = guess(df_ranged[thresholds_key].values, df_ranged[rate_key].values)
+    if not np.all(np.isfinite(p0)):
+        return default
+    return p0
+
+
+def fit_given_range(df_ranged, thresholds_key, rate_key, func, p0=None, jac=None):
     xdata = df_ranged[thresholds_key].values
     ydata = df_ranged[rate_key].values
 
@@ -65,12 +221,33 @@ def fit_given_range(df_ranged, thresholds_key, rate_key, func, p0=None):
         return [None, None]
 
     try:
-        return curve_fit(func, xdata, ydata, p0=p0)
+        return curve_fit(func, xdata, ydata, p0=p0, jac=jac)
     except RuntimeError:
         log.warning("Fit failed: Optimal parameters not found")
         return [None, None]
 
 
+def fit_log_given_range(df_ranged, thresholds_key, rate_key, counts_key, func, p0, jac=None, bounds=(-np.inf, np.inf)):
+    """
+    Fit func to the log of the rates, weighted with the poisson
+    uncertainty 1/sqrt(counts) of the log rates. Points without counts
+    are left out.
+    """
+    df_ranged = df_ranged[df_ranged[counts_key] > 0]
+    xdata = df_ranged[thresholds_key].values
+    ydata = np.log(df_ranged[rate_key].values)
+    sigma = 1/np.sqrt(df_ranged[counts_key].values)
+
+    if len(xdata) < 3:
+        return [None, None]
+
+    try:
+        return curve_fit(func, xdata, ydata, p0=np.clip(p0, *bounds), sigma=sigma, jac=jac, bounds=bounds)
+    except (RuntimeError, ValueError):
+        log.warning("Fit failed: Optimal parameters not found")
+        return [None, None]
+
+
 def fit_result_to_series(opt, cov, name="shower"):
     result = dict()
     for i, parameter in enumerate(opt):
@@ -94,11 +271,22 @@ def findTriggerSetThreshold(
         scale=1,
         rate_key = "ratescan_trigger_rate",
         thresholds_key = "ratescan_trigger_thresholds",
+        method = "staged",
+        counts_key = "ratescan_trigger_counts",
         ):
     """
     Find the threshold where the shower contribution of the triggerate is
     equal to 1/e of the NSB contribution for a given ratescan
+
+    method staged fits the shower and the nsb part in their ranges and
+    then the full model starting from both. method weighted only fits the
+    full model once to the log rates, weighted with the poisson
+    uncertainty of the counts in counts_key and within bounds, the start
+    values are estimated from both parts.
     """
+    if method not in fit_methods:
+        raise ValueError("Unknown fit method {}, use one of {}".format(method, fit_methods))
+
     max_rate = df[rate_key].max()
     
     ranges_dict = dict()
@@ -124,34 +312,62 @@ def findTriggerSetThreshold(
     
     
     
-    shower_opt, shower_cov = fit_given_range(
-        df[filter_shower_range], 
-        thresholds_key, 
-        rate_key, 
-        powerLaw,
-        p0=[5.52310784e10, -3, 3.70127911e2])
-    if (shower_opt is None) or (shower_cov is None):
-        return None
+    if method == "weighted":
+        full_p0 = [
+            *initial_guess(
+                df[filter_shower_range], thresholds_key, rate_key,
+                powerLawInitialGuess, default=[5.52310784e10, -3, 3.70127911e2]),
+            *initial_guess(
+                df[filter_nsb_range], thresholds_key, rate_key,
+                nsbContributionInitialGuess, default=[-2.18757227e-2, 6.94879358e2]),
+        ]
+        full_opt, full_cov = fit_log_given_range(
+            df[filter_full_range],
+            thresholds_key,
+            rate_key,
+            counts_key,
+            logRatescan_func,
+            p0=full_p0,
+            jac=logRatescan_funcJacobian,
+            bounds=ratescan_funcBounds)
+    else:
+        shower_p0 = initial_guess(
+            df[filter_shower_range], thresholds_key, rate_key,
+            powerLawInitialGuess, default=[5.52310784e10, -3, 3.70127911e2])
+        shower_opt, shower_cov = fit_given_range(
+            df[filter_shower_range], 
+            thresholds_key, 
+            rate_key, 
+            powerLaw,
+            p0=shower_p0,
+            jac=powerLawJacobian)
+        if (shower_opt is None) or (shower_cov is None):
+            return None
 
-    s_fit_results.append(fit_result_to_series(shower_opt, shower_cov, name="shower"))
+        s_fit_results.append(fit_result_to_series(shower_opt, shower_cov, name="shower"))
 
-    nsb_opt, nsb_cov = fit_given_range(
-        df[filter_nsb_range],
-        thresholds_key,
-        rate_key,
-        nsbContribution,
-        p0=[-2.18757227e-2, 6.94879358e2])
-    if (nsb_opt is None) or (nsb_cov is None):
-        return None
+        nsb_p0 = initial_guess(
+            df[filter_nsb_range], thresholds_key, rate_key,
+            nsbContributionInitialGuess, default=[-2.18757227e-2, 6.94879358e2])
+        nsb_opt, nsb_cov = fit_given_range(
+            df[filter_nsb_range],
+            thresholds_key,
+            rate_key,
+            nsbContribution,
+            p0=nsb_p0,
+            jac=nsbContributionJacobian)
+        if (nsb_opt is None) or (nsb_cov is None):
+            return None
 
-    s_fit_results.append(fit_result_to_series(nsb_opt, nsb_cov, name="nsb"))
+        s_fit_results.append(fit_result_to_series(nsb_opt, nsb_cov, name="nsb"))
 
-    full_opt, full_cov = fit_given_range(
-        df[filter_full_range],
-        thresholds_key,
-        rate_key,
-        ratescan_func,
-        p0=[*shower_opt, *nsb_opt])
+        full_opt, full_cov = fit_given_range(
+            df[filter_full_range],
+            thresholds_key,
+            rate_key,
+            ratescan_func,
+            p0=[*shower_opt, *nsb_opt],
+            jac=ratescan_funcJacobian)
 
     if (full_opt is None) or (full_cov is None):
         return None
@@ -161,20 +377,11 @@ def findTriggerSetThreshold(
     s_fit_results = concatSeriesNamesToPrefix(s_fit_results)
 
     #estimate location
-    estimatedThreshold = df[df[rate_key] <= max_rate*0.1][thresholds_key].dropna().first_valid_index()
+    estimatedThreshold = df[df[rate_key] <= max_rate*0.1][thresholds_key].dropna().iloc[0]
 
-    if full_opt is not None:
-        poly = lambda t: powerLaw(t, *full_opt[:3])/(m.e*scale) - nsbContribution(t, *full_opt[3:])
-        solution = root(poly, estimatedThreshold)
+    s_fit_results["setThreshold"] = setThresholdRoots([full_opt], [estimatedThreshold], scale=scale)[0]
 
-        s_fit_results["setThreshold"] = solution.x
-
-        if len(s_fit_results["setThreshold"]) == 1:
-            s_fit_results["setThreshold"] = s_fit_results["setThreshold"][0]
-
-        return s_fit_results
-    else:
-        return None
+    return s_fit_results
 
     
     
@@ -0,0 +1,464 @@
+import numpy as np
+import pandas as pd
+import logging
+import math as m
+
+from .models import (
+    powerLaw, nsbContribution, ratescan_func,
+    powerLawJacobian, nsbContributionJacobian, ratescan_funcJacobian,
+    powerLawInitialGuess, nsbContributionInitialGuess,
+    logRatescan_func, logRatescan_funcJacobian, ratescan_funcBounds,
+)
+from .container import factorize_keys
+
+log = logging.getLogger(__name__)
+
+shower_p0 = [5.52310784e10, -3, 3.70127911e2]
+nsb_p0 = [-2.18757227e-2, 6.94879358e2]
+
+# staged: shower, nsb and full fit chained, weighted: one fit of the full
+# model to the log rates with poisson weights
+fit_methods = ["staged", "weighted"]
+
+# version of the fit code, part of the fit cache keys. Increase it whenever
+# a change of the fits, start values or root finding changes the results.
+fit_version = 1
+
+
+def _model_args(x, p):
+    # parameters of every fit as (n_fits, 1) columns, broadcasting against x
+    return [p[:, i, np.newaxis] for i in range(p.shape[1])]
+
+
+def _residuals(func, x, y, weights, p):
+    with np.errstate(all="ignore"):
+        r = weights * (y - func(x, *_model_args(x, p)))
+    r[weights == 0] = 0
+    return r
+
+
+def _jacobian(jac, x, weights, p):
+    with np.errstate(all="ignore"):
+        J = weights[..., np.newaxis] * jac(x, *_model_args(x, p))
+    J[weights == 0] = 0
+    return J
+
+
+def _solve(A, b):
+    with np.errstate(all="ignore"):
+        try:
+            return np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            return np.stack([np.linalg.lstsq(a, c, rcond=None)[0] for a, c in zip(A, b)])
+
+
+def levenbergMarquardt(func, jac, x, y, weights, p0, max_iter=400, ftol=1.5e-8, xtol=1.5e-8, factor=100, bounds=None):
+    """
+    Fit func to many independent data sets at once.
+
+    x, y and weights have the shape (n_fits, n_points), padded points get
+    weight 0. p0 has the shape (n_fits, n_parameters). func and jac are
+    evaluated on all fits together, jac returns the partial derivatives
+    along the last axis.
+
+    Like MINPACK's lmder, which is used by scipy's curve_fit, every fit
+    has its own damping parameter and a bound on the scaled step length,
+    starting at factor * |D p0|. A fit stops on its own once the actual and
+    predicted relative reduction of chi2 are below ftol or the step bound
+    is below xtol relative to the parameters.
+
+    bounds is an optional pair of arrays with the lower and upper bound of
+    every parameter, p0 and all steps are projected onto them.
+
+    Returns popt, pcov and a boolean array of converged fits. pcov is
+    scaled with chi2/(n_points - n_parameters) like scipy's curve_fit.
+    """
+    p = np.array(p0, dtype=float)
+    if bounds is not None:
+        lower, upper = (np.asarray(b, dtype=float) for b in bounds)
+        p = np.clip(p, lower, upper)
+    n_fits, n_parameters = p.shape
+    diagonal = np.arange(n_parameters)
+
+    r = _residuals(func, x, y, weights, p)
+    cost = np.sum(r**2, axis=1)
+
+    damping = np.full(n_fits, 1e-3)
+    D = np.zeros((n_fits, n_parameters))
+    radius = np.full(n_fits, np.nan)
+    active = np.isfinite(cost)
+    converged = np.zeros(n_fits, dtype=bool)
+
+    for iteration in range(max_iter):
+        if not active.any():
+            break
+        idx = np.flatnonzero(active)
+
+        J = _jacobian(jac, x[idx], weights[idx], p[idx])
+        JT = J.transpose(0, 2, 1)
+        A = JT @ J
+        g = (JT @ r[idx, :, np.newaxis])[..., 0]
+
+        # parameter scaling, the largest column norm seen so far
+        column_norm = np.sqrt(A[:, diagonal, diagonal])
+        D[idx] = np.maximum(D[idx], np.where(column_norm > 0, column_norm, 1))
+        first = np.isnan(radius[idx])
+        scaled_p = np.linalg.norm(D[idx] * p[idx], axis=1)
+        radius[idx[first]] = np.where(scaled_p > 0, factor * scaled_p, factor)[first]
+
+        A_damped = A.copy()
+        A_damped[:, diagonal, diagonal] += damping[idx, np.newaxis] * D[idx]**2
+        if bounds is not None:
+            # parameters at a bound which the gradient pushes outside are
+            # kept fixed for this step
+            fixed = ((p[idx] <= lower) & (g < 0)) | ((p[idx] >= upper) & (g > 0))
+            A_damped[fixed[:, :, np.newaxis] | fixed[:, np.newaxis, :]] = 0
+            A_damped[:, diagonal, diagonal] = np.where(fixed, 1, A_damped[:, diagonal, diagonal])
+            g = np.where(fixed, 0, g)
+        step = _solve(A_damped, g)
+
+        # restrict the step to the trust region
+        step_norm = np.linalg.norm(D[idx] * step, axis=1)
+        too_long = step_norm > radius[idx]
+        step[too_long] *= (radius[idx] / step_norm)[too_long, np.newaxis]
+        step_norm = np.minimum(step_norm, radius[idx])
+        if bounds is not None:
+            step = np.clip(p[idx] + step, lower, upper) - p[idx]
+            step_norm = np.linalg.norm(D[idx] * step, axis=1)
+
+        p_new = p[idx] + step
+        r_new = _residuals(func, x[idx], y[idx], weights[idx], p_new)
+        cost_new = np.sum(r_new**2, axis=1)
+        cost_new[~np.all(np.isfinite(p_new), axis=1)] = np.nan
+
+        with np.errstate(all="ignore"):
+            actual = np.where(np.isfinite(cost_new), 1 - cost_new / cost[idx], -1)
+            linear = r[idx] - (J @ step[..., np.newaxis])[..., 0]
+            predicted = 1 - np.sum(linear**2, axis=1) / cost[idx]
+            ratio = np.where(predicted > 0, actual / predicted, 0)
+
+        shrink = ratio < 0.25
+        radius[idx[shrink]] = 0.5 * np.minimum(radius[idx], 10 * step_norm)[shrink]
+        damping[idx[shrink]] *= 10
+        grow = ratio > 0.75
+        radius[idx[grow]] = np.maximum(radius[idx], 2 * step_norm)[grow]
+        damping[idx[grow]] /= 10
+
+        accept = ratio >= 1e-4
+        accepted = idx[accept]
+        p[accepted] = p_new[accept]
+        r[accepted] = r_new[accept]
+        cost[accepted] = cost_new[accept]
+
+        scaled_p = np.linalg.norm(D[idx] * p[idx], axis=1)
+        done = (
+            ((np.abs(actual) <= ftol) & (predicted <= ftol) & (ratio <= 2))
+            | (radius[idx] <= xtol * scaled_p)
+            | (cost[idx] == 0)
+        )
+        converged[idx[done]] = True
+        active[idx[done]] = False
+        # no progress possible anymore
+        active[idx[radius[idx] <= np.finfo(float).eps * scaled_p]] = False
+
+    n_points = np.sum(weights > 0, axis=1)
+    dof = n_points - n_parameters
+    pcov = np.full((n_fits, n_parameters, n_parameters), np.inf)
+
+    # moore-penrose inverse of J^T J from the svd of J, like curve_fit
+    idx = np.flatnonzero(converged & (dof > 0))
+    if len(idx) > 0:
+        J = _jacobian(jac, x[idx], weights[idx], p[idx])
+        _, singular_values, VT = np.linalg.svd(J, full_matrices=False)
+        threshold = np.finfo(float).eps * n_points[idx] * singular_values[:, 0]
+        keep = singular_values > threshold[:, np.newaxis]
+        with np.errstate(divide="ignore"):
+            inverse_squares = np.where(keep, 1 / singular_values**2, 0)
+        VT_scaled = VT * inverse_squares[:, :, np.newaxis]
+        pcov[idx] = np.einsum("fki,fkj->fij", VT, VT_scaled) * (cost[idx] / dof[idx])[:, np.newaxis, np.newaxis]
+
+    return p, pcov, converged
+
+
+def padRatescans(df, group_keys, thresholds_key, rate_key):
+    """
+    Stack the summed ratescans of many runs into padded 2d arrays with one
+    row per run, sorted by threshold. Returns the run keys, thresholds,
+    rates and a mask of valid entries.
+    """
+    columns = [df[k].values for k in group_keys]
+    codes, first = factorize_keys(columns)
+    order = np.lexsort((df[thresholds_key].values, codes))
+    codes = codes[order]
+
+    n_runs = len(first)
+    n_per_run = np.bincount(codes, minlength=n_runs)
+    starts = np.r_[0, np.cumsum(n_per_run)[:-1]]
+    position = np.arange(len(codes)) - starts[codes]
+
+    n_max = n_per_run.max() if n_runs > 0 else 0
+    x = np.ones((n_runs, n_max))
+    y = np.zeros((n_runs, n_max))
+    valid = np.zeros((n_runs, n_max), dtype=bool)
+    x[codes, position] = df[thresholds_key].values[order]
+    y[codes, position] = df[rate_key].values[order]
+    valid[codes, position] = True
+
+    keys = {k: c[first] for k, c in zip(group_keys, columns)}
+    return keys, x, y, valid
+
+
+def _initialGuess(guess, x, y, selected, default):
+    """
+    Data driven starting values for every run, default for runs where they
+    can not be estimated
+    """
+    p0 = guess(x, y, selected)
+    missing = ~np.all(np.isfinite(p0), axis=1)
+    p0[missing] = default
+    return p0
+
+
+def _fitSelected(func, jac, x, y, selected, p0, weights=None, bounds=None):
+    """
+    Fit all runs with at least 3 selected points, returns popt, pcov and
+    a boolean array of successful fits. weights are 1/sigma of the points,
+    1 if not given.
+    """
+    n_parameters = p0.shape[1]
+    enough = selected.sum(axis=1) >= 3
+    popt = np.full((len(x), n_parameters), np.nan)
+    pcov = np.full((len(x), n_parameters, n_parameters), np.nan)
+    ok = np.zeros(len(x), dtype=bool)
+
+    idx = np.flatnonzero(enough)
+    if len(idx) == 0:
+        return popt, pcov, ok
+
+    # only keep the selected points of each run, the fits run on arrays as
+    # wide as the largest selection instead of the whole ratescan
+    selected = selected[idx]
+    n_selected = selected.sum(axis=1)
+    position = np.cumsum(selected, axis=1) - 1
+    rows, columns = np.nonzero(selected)
+    x_fit = np.ones((len(idx), n_selected.max()))
+    y_fit = np.zeros_like(x_fit)
+    w_fit = np.zeros_like(x_fit)
+    x_fit[rows, position[rows, columns]] = x[idx][rows, columns]
+    y_fit[rows, position[rows, columns]] = y[idx][rows, columns]
+    w_fit[rows, position[rows, columns]] = 1 if weights is None else weights[idx][rows, columns]
+
+    popt[idx], pcov[idx], ok[idx] = levenbergMarquardt(func, jac, x_fit, y_fit, w_fit, p0[idx], bounds=bounds)
+    n_failed = len(idx) - ok[idx].sum()
+    if n_failed > 0:
+        log.warning("Fit failed for {} runs: Optimal parameters not found".format(n_failed))
+    return popt, pcov, ok
+
+
+def _fitResultColumns(name, popt, pcov):
+    columns = dict()
+    n_parameters = popt.shape[1]
+    for i in range(n_parameters):
+        columns["{}_par_{}".format(name, i)] = popt[:, i]
+    for i in range(n_parameters):
+        for j in range(n_parameters):
+            columns["{}_cov_{}_{}".format(name, i, j)] = pcov[:, i, j]
+    return columns
+
+
+def _setThresholdCondition(t, p, scale):
+    # scaled shower minus nsb contribution and its derivative with respect to t
+    m_shower, a, b, m_nsb, t_0 = p.T
+    with np.errstate(all="ignore"):
+        shower = m_shower*np.power(t, a)
+        nsb = nsbContribution(t, m_nsb, t_0)
+        f = (shower + b)/(m.e*scale) - nsb
+        df = a*shower/t/(m.e*scale) - m_nsb*nsb
+    return f, df
+
+
+def setThresholdRoots(full_opt, estimated=None, scale=1, xtol=1e-12, max_iter=100, max_expand=40):
+    """
+    Solve powerLaw(t)/(e*scale) = nsbContribution(t) for the full fit
+    parameters of many runs and several scales at once.
+
+    full_opt has the shape (n_runs, 5), estimated holds the start
+    threshold of every run, by default t_0 of the nsb contribution. scale
+    is a number or an array of scales, the result has the shape
+    (n_runs,) + np.shape(scale).
+
+    The start is widened by factors of 2 until the difference changes its
+    sign, the root is then found with Newton steps which are replaced by
+    bisection whenever they leave the bracket. Runs without a sign change
+    get NaN.
+    """
+    full_opt = np.asarray(full_opt, dtype=float).reshape(-1, 5)
+    scale = np.asarray(scale, dtype=float)
+    shape = (len(full_opt),) + scale.shape
+    if estimated is None:
+        estimated = full_opt[:, 4]
+
+    # one row per run and scale
+    n_roots = int(np.prod(shape))
+    n_scales = n_roots // len(full_opt) if len(full_opt) > 0 else 0
+    p = np.repeat(full_opt, n_scales, axis=0)
+    scale = np.broadcast_to(scale, shape).ravel()
+    start = np.repeat(np.asarray(estimated, dtype=float), n_scales)
+
+    # bracket: the nearest sign change below or above the start
+    f_start, _ = _setThresholdCondition(start, p, scale)
+    lo, f_lo = start.copy(), f_start.copy()
+    hi, f_hi = start.copy(), f_start.copy()
+    a, f_a = start.copy(), f_start.copy()
+    b = start.copy()
+    bracketed = f_start == 0
+    searching = np.isfinite(f_start) & (start > 0) & ~bracketed
+    for _ in range(max_expand):
+        idx = np.flatnonzero(searching)
+        if len(idx) == 0:
+            break
+        for edge, f_edge, factor in [(lo, f_lo, 0.5), (hi, f_hi, 2.0)]:
+            t_new = edge[idx]*factor
+            f_new, _ = _setThresholdCondition(t_new, p[idx], scale[idx])
+            found = searching[idx] & np.isfinite(f_new) & (np.sign(f_new) != np.sign(f_edge[idx]))
+            a[idx[found]] = edge[idx[found]]
+            f_a[idx[found]] = f_edge[idx[found]]
+            b[idx[found]] = t_new[found]
+            bracketed[idx[found]] = True
+            searching[idx[found]] = False
+            edge[idx] = t_new
+            f_edge[idx] = f_new
+        searching &= np.isfinite(f_lo) | np.isfinite(f_hi)
+
+    t = np.where(bracketed, 0.5*(a + b), np.nan)
+    t[f_start == 0] = start[f_start == 0]
+    active = bracketed & (f_start != 0)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        f, df = _setThresholdCondition(t[idx], p[idx], scale[idx])
+
+        # keep the root between a and b
+        same_as_a = np.sign(f) == np.sign(f_a[idx])
+        a[idx] = np.where(same_as_a, t[idx], a[idx])
+        f_a[idx] = np.where(same_as_a, f, f_a[idx])
+        b[idx] = np.where(same_as_a, b[idx], t[idx])
+
+        with np.errstate(all="ignore"):
+            newton = t[idx] - f/df
+        inside = np.isfinite(newton) & (newton > np.minimum(a[idx], b[idx])) & (newton < np.maximum(a[idx], b[idx]))
+        t_new = np.where(inside, newton, 0.5*(a[idx] + b[idx]))
+
+        done = (
+            (f == 0)
+            | (np.abs(t_new - t[idx]) <= xtol*np.abs(t_new))
+            | (np.abs(b[idx] - a[idx]) <= xtol*np.abs(t_new))
+        )
+        t[idx] = np.where(f == 0, t[idx], t_new)
+        active[idx[done]] = False
+
+    return t.reshape(shape)
+
+
+def setThresholdScaleName(scale):
+    return f'setThreshold_{scale}'
+
+
+def setThresholdsForScales(df_fits, scales, name="full"):
+    """
+    Set thresholds of already fitted runs for several scales without
+    fitting again. df_fits holds the parameters of the full fit, e.g. the
+    output of findTriggerSetThresholds, the result has one column per
+    scale.
+    """
+    full_opt = df_fits[["{}_par_{}".format(name, i) for i in range(5)]].values
+    roots = setThresholdRoots(full_opt, scale=np.asarray(scales, dtype=float))
+    return pd.DataFrame(
+        {setThresholdScaleName(scale): roots[:, i] for i, scale in enumerate(scales)},
+        index=df_fits.index,
+    )
+
+
+def findTriggerSetThresholds(
+        df,
+        group_keys=["night", "run_id"],
+        max_threshold=5000,
+        scale=1,
+        rate_key="ratescan_trigger_rate",
+        thresholds_key="ratescan_trigger_thresholds",
+        method="staged",
+        counts_key="ratescan_trigger_counts",
+        ):
+    """
+    Batched version of features.findTriggerSetThreshold for the summed
+    ratescans of many runs. The shower, nsb and full fit are each done for
+    all runs at once with a vectorized Levenberg-Marquardt, with method
+    weighted only the full fit in log space.
+
+    Returns a data frame with one row per successfully fitted run, the
+    group keys and the same columns as findTriggerSetThreshold.
+    """
+    if method not in fit_methods:
+        raise ValueError("Unknown fit method {}, use one of {}".format(method, fit_methods))
+
+    keys, x, y, valid = padRatescans(df, group_keys, thresholds_key, rate_key)
+
+    with np.errstate(invalid="ignore"):
+        max_rate = np.nanmax(np.where(valid, y, np.nan), axis=1) if x.shape[1] > 0 else np.zeros(len(x))
+        nsb_rate_max = max_rate*0.6
+        nsb_rate_min = max_rate*0.1
+        shower_rate_max = nsb_rate_min/2
+
+        below_max_threshold = valid & (x < max_threshold)
+        shower_range = below_max_threshold & (y < shower_rate_max[:, np.newaxis])
+        nsb_range = valid & (y < nsb_rate_max[:, np.newaxis]) & (y > nsb_rate_min[:, np.newaxis])
+        full_range = below_max_threshold & (y < nsb_rate_max[:, np.newaxis])
+
+    n_runs = len(x)
+    if method == "weighted":
+        # one fit of the log rates, weighted with their poisson uncertainty
+        # 1/sqrt(counts), starting from the data driven guesses of both parts
+        _, _, counts, _ = padRatescans(df, group_keys, thresholds_key, counts_key)
+        full_p0 = np.hstack([
+            _initialGuess(powerLawInitialGuess, x, y, shower_range, shower_p0),
+            _initialGuess(nsbContributionInitialGuess, x, y, nsb_range, nsb_p0),
+        ])
+        log_y = np.log(np.where(counts > 0, y, 1))
+        full_opt, full_cov, ok = _fitSelected(
+            logRatescan_func, logRatescan_funcJacobian, x, log_y, full_range & (counts > 0), full_p0,
+            weights=np.sqrt(counts), bounds=ratescan_funcBounds)
+        fits = [("full", full_opt, full_cov)]
+    else:
+        shower_opt, shower_cov, ok = _fitSelected(
+            powerLaw, powerLawJacobian, x, y, shower_range,
+            _initialGuess(powerLawInitialGuess, x, y, shower_range, shower_p0))
+        nsb_range &= ok[:, np.newaxis]
+        nsb_opt, nsb_cov, nsb_ok = _fitSelected(
+            nsbContribution, nsbContributionJacobian, x, y, nsb_range,
+            _initialGuess(nsbContributionInitialGuess, x, y, nsb_range, nsb_p0))
+        ok &= nsb_ok
+        full_p0 = np.hstack([shower_opt, nsb_opt])
+        full_opt, full_cov, full_ok = _fitSelected(
+            ratescan_func, ratescan_funcJacobian, x, y, full_range & ok[:, np.newaxis], full_p0)
+        ok &= full_ok
+        fits = [("shower", shower_opt, shower_cov), ("nsb", nsb_opt, nsb_cov), ("full", full_opt, full_cov)]
+
+    result = dict(keys)
+    result["ranges_max_rate"] = max_rate
+    result["ranges_max_threshold"] = np.full(n_runs, max_threshold)
+    result["ranges_nsb_rate_max"] = nsb_rate_max
+    result["ranges_nsb_rate_min"] = nsb_rate_min
+    result["ranges_shower_rate_max"] = shower_rate_max
+    for name, popt, pcov in fits:
+        result.update(_fitResultColumns(name, popt, pcov))
+
+    # estimate location: first threshold with a rate below 10% of the maximum
+    below = valid & (y <= nsb_rate_min[:, np.newaxis])
+    estimated = x[np.arange(n_runs), np.argmax(below, axis=1)]
+
+    set_threshold = np.full(n_runs, np.nan)
+    set_threshold[ok] = setThresholdRoots(full_opt[ok], estimated[ok], scale=scale)
+    result["setThreshold"] = set_threshold
+
+    return pd.DataFrame(result)[ok].reset_index(drop=True)
@@ -1,36 +1,890 @@
 import gzip
 import pandas as pd
+import numpy as np
 import logging
 import json
+import re
+import os
+import h5py
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from fact.io import read_h5py
+
+from .container import Ratescan
 
 logging.basicConfig(format='%(asctime)s|%(levelname)s|%(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 log = logging.getLogger(__name__)
 
-def readJsonLtoDf(infile_path, default_keys_to_store=None):
-    open_func = open
 
-    log.info("reading: {}".format(infile_path))
+class ColumnBuffer:
+    '''
+    Growable numpy array used to collect the values of one column while
+    streaming through a jsonl file. The capacity is doubled whenever it is
+    exhausted, so appending n values costs amortized O(n).
+    '''
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.size = 0
+        self.data = None
+
+    def _reserve(self, n_new, dtype):
+        if self.data is None:
+            while self.capacity < n_new:
+                self.capacity *= 2
+            self.data = np.empty(self.capacity, dtype=dtype)
+            return
+
+        if dtype != self.data.dtype:
+            new_dtype = np.result_type(self.data.dtype, dtype)
+            if new_dtype != self.data.dtype:
+                self.data = self.data.astype(new_dtype)
+
+        if self.size + n_new > self.capacity:
+            while self.size + n_new > self.capacity:
+                self.capacity *= 2
+            data = np.empty(self.capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+    def extend(self, values):
+        values = np.asarray(values)
+        self._reserve(len(values), values.dtype)
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+    def repeat(self, value, n):
+        value = np.asarray(value)
+        self._reserve(n, value.dtype)
+        self.data[self.size:self.size + n] = value
+        self.size += n
+
+    def __len__(self):
+        return self.size
+
+    def values(self):
+        if self.data is None:
+            return np.empty(0)
+        return self.data[:self.size]
+
+    def take(self, n):
+        '''
+        Remove the first n values from the buffer and return them
+        '''
+        values = self.data[:n].copy()
+        self.data[:self.size - n] = self.data[n:self.size]
+        self.size -= n
+        return values
+
+
+def _to_column(value):
+    '''
+    Convert a list parsed from json into a numpy array, nested lists and
+    strings are kept as python objects like pandas does
+    '''
+    if len(value) > 0 and isinstance(value[0], (list, dict, str)):
+        column = np.empty(len(value), dtype=object)
+        for i, v in enumerate(value):
+            column[i] = v
+        return column
+    return np.asarray(value)
+
+
+def _to_scalar(value):
+    if isinstance(value, (list, dict, str)) or value is None:
+        return np.asarray(value, dtype=object)
+    return np.asarray(value)
+
+
+def _open(infile_path):
     if infile_path.endswith(".gz"):
-        open_func = gzip.open
+        return gzip.open(infile_path)
+    return open(infile_path)
+
+
+class JsonLColumns:
+    '''
+    Collects the entries of selected keys from json lines into column buffers.
+    List valued entries are stored element wise, scalar entries are repeated
+    to the length of the list valued entries of the same line, which gives the
+    same long format as `pd.DataFrame(data)` on each line. Keys missing in
+    a line are filled with NaN, keys missing in all lines are left out, like
+    concatenating the data frames of all lines.
+    '''
+
+    def __init__(self, keys=None):
+        self.keys = keys
+        self.buffers = None
+        self.found = set()
+        self.lines = 0
+
+    def _init_buffers(self, data):
+        if self.keys is None:
+            self.keys = list(data.keys())
+        self.buffers = {k: ColumnBuffer() for k in self.keys}
+
+    def add_line(self, line):
+        data = json.loads(line)
+
+        if self.buffers is None:
+            self._init_buffers(data)
+
+        for k in self.keys:
+            if k not in data.keys():
+                log.warning((f'{k} not in keys of input file'))
+
+        n_rows = 1
+        for k in self.keys:
+            if isinstance(data.get(k), list):
+                n_rows = len(data[k])
+                break
+
+        # every buffer grows by n_rows, so the columns stay aligned
+        for k in self.keys:
+            if k not in data.keys():
+                self.buffers[k].repeat(np.nan, n_rows)
+                continue
+            self.found.add(k)
+            value = data[k]
+            if isinstance(value, list):
+                self.buffers[k].extend(_to_column(value))
+            else:
+                self.buffers[k].repeat(_to_scalar(value), n_rows)
+
+        self.lines += 1
+
+    def __len__(self):
+        if not self.buffers:
+            return 0
+        return max(len(b) for b in self.buffers.values())
+
+    def to_dict(self):
+        if self.buffers is None:
+            return {}
+        return {k: b.values() for k, b in self.buffers.items() if k in self.found}
+
+    def take(self, n):
+        columns = {k: b.take(n) for k, b in self.buffers.items()}
+        return {k: v for k, v in columns.items() if k in self.found}
+
+
+def iterJsonLBatches(infile_path, default_keys_to_store=None, batch_size=100000):
+    '''
+    Generator over a jsonl ratescan file yielding data frames with exactly
+    batch_size rows, the last batch may be shorter.
+    '''
+    log.info("reading: {}".format(infile_path))
+
+    columns = JsonLColumns(default_keys_to_store)
+    with _open(infile_path) as f:
+        for line in f:
+            columns.add_line(line)
+            while len(columns) >= batch_size:
+                yield pd.DataFrame(columns.take(batch_size))
+
+    if len(columns) > 0:
+        yield pd.DataFrame(columns.to_dict())
 
-    dfs = []
-    # lines = 0
-    with open_func(infile_path) as f:
+
+def _decodeLines(lines, keys):
+    '''
+    Decode a chunk of json lines into a dict of column arrays and the set of
+    keys found in the chunk, this is what runs in the worker processes of
+    readJsonLtoDf
+    '''
+    columns = JsonLColumns(keys)
+    for line in lines:
+        columns.add_line(line)
+    if columns.buffers is None:
+        return {}, set()
+    return {k: b.values() for k, b in columns.buffers.items()}, columns.found
+
+
+def _concatColumns(chunks):
+    # keys missing in a chunk are NaN filled there, keys missing in all
+    # chunks are left out
+    found = set().union(*[f for _, f in chunks])
+    keys = []
+    for chunk, _ in chunks:
+        keys += [k for k in chunk.keys() if k not in keys and k in found]
+    return {k: np.concatenate([c[k] for c, _ in chunks if k in c]) for k in keys}
+
+
+def decodeJsonLParallel(infile_path, keys=None, workers=2, lines_per_chunk=64):
+    '''
+    Decompress a jsonl file in this process and decode chunks of
+    lines_per_chunk lines in a pool of worker processes. The decoded chunks
+    are merged in file order into one dict of column arrays.
+    '''
+    chunks = []
+    pending = []
+    with _open(infile_path) as f, ProcessPoolExecutor(max_workers=workers) as pool:
+        if keys is None:
+            first = f.readline()
+            if not first:
+                return {}
+            keys = list(json.loads(first).keys())
+            chunks.append(_decodeLines([first], keys))
+
+        while True:
+            lines = list(islice(f, lines_per_chunk))
+            if not lines:
+                break
+            pending.append(pool.submit(_decodeLines, lines, keys))
+            # keep the number of chunks in flight bounded
+            if len(pending) >= 2 * workers:
+                chunks.append(pending.pop(0).result())
+
+        chunks += [future.result() for future in pending]
+
+    return _concatColumns(chunks)
+
+
+def readJsonLtoDf(infile_path, default_keys_to_store=None, workers=1):
+    '''
+    Read a jsonl ratescan file into one data frame in long format, with one
+    row per event and threshold. With workers > 1 the lines are decoded in
+    a process pool.
+    '''
+    log.info("reading: {}".format(infile_path))
+
+    if workers > 1:
+        return pd.DataFrame(decodeJsonLParallel(infile_path, default_keys_to_store, workers=workers))
+
+    columns = JsonLColumns(default_keys_to_store)
+    with _open(infile_path) as f:
+        for line in f:
+            columns.add_line(line)
+
+    log.debug("extracted {} rows from {} lines".format(len(columns), columns.lines))
+    return pd.DataFrame(columns.to_dict())
+
+
+def readJsonLtoRatescan(
+        infile_path,
+        event_keys=["night", "run_id", "event_num"],
+        counts_key="ratescan_trigger_counts",
+        thresholds_key="ratescan_trigger_thresholds",
+        workers=1,
+        ):
+    '''
+    Read a jsonl ratescan file into a dense Ratescan, without building a
+    data frame in long format.
+    '''
+    keys = [*event_keys, counts_key, thresholds_key]
+    if workers > 1:
+        columns = decodeJsonLParallel(infile_path, keys, workers=workers)
+    else:
+        log.info("reading: {}".format(infile_path))
+        json_columns = JsonLColumns(keys)
+        with _open(infile_path) as f:
+            for line in f:
+                json_columns.add_line(line)
+        columns = json_columns.to_dict()
+
+    return Ratescan.from_dataframe(
+        columns,
+        event_keys=event_keys,
+        counts_key=counts_key,
+        thresholds_key=thresholds_key,
+    )
+
+
+def _scalarPattern(key, binary):
+    pattern = r'"{}"\s*:\s*(-?\d+)'.format(re.escape(key))
+    return re.compile(pattern.encode() if binary else pattern)
+
+
+def readRunKeys(infile_path, night_key="night", run_id_key="run_id", inkey="ratescan"):
+    '''
+    Read the distinct (night, run_id) pairs of a ratescan file without
+    reading the ratescans. The run index is used if the file has one, else
+    for hdf5 files and column stores only the two columns are read, for jsonl files the keys are matched with a regex on
+    the raw lines and only lines without a match are decoded.
+    Returns a data frame with the columns night_key and run_id_key.
+    '''
+    if isColumnStore(infile_path) or infile_path.endswith("hdf") or infile_path.endswith("hdf5"):
+        ranges = readRunIndex(infile_path, inkey, night_key=night_key, run_id_key=run_id_key)
+        if ranges is not None:
+            df = ranges[["night", "run_id"]].rename(columns={"night": night_key, "run_id": run_id_key})
+            return df.drop_duplicates().reset_index(drop=True)
+
+    if isColumnStore(infile_path):
+        df = readColumnStore(infile_path, columns=[night_key, run_id_key])
+        return df.drop_duplicates().reset_index(drop=True)
+
+    if infile_path.endswith("hdf") or infile_path.endswith("hdf5"):
+        with h5py.File(infile_path, "r") as f:
+            group = f[inkey]
+            df = pd.DataFrame({k: group[k][:] for k in [night_key, run_id_key]})
+        return df.drop_duplicates().reset_index(drop=True)
+
+    runs = set()
+    patterns = None
+    with _open(infile_path) as f:
         for line in f:
-            data = json.loads(line)
-            for k in default_keys_to_store:
-                if k not in data.keys():
-                    log.warning((f'{k} not in keys of input file'))
-
-            data = {k: data[k] for k in default_keys_to_store if k in data.keys()}
-
-            df = pd.DataFrame(data)
-
-            # df = pd.read_json(line)
-            # if len(default_keys_to_store) > 0:
-                # df = df[default_keys_to_store]
-            dfs.append(df)
-            # lines+=1
-    
-    return pd.concat(dfs, ignore_index=True)
\ No newline at end of file
+            if patterns is None:
+                binary = isinstance(line, bytes)
+                patterns = [_scalarPattern(k, binary) for k in [night_key, run_id_key]]
+            matches = [p.search(line) for p in patterns]
+            if all(matches):
+                runs.add(tuple(int(m.group(1)) for m in matches))
+            else:
+                data = json.loads(line)
+                runs.add((data.get(night_key), data.get(run_id_key)))
+
+    return pd.DataFrame(sorted(runs, key=str), columns=[night_key, run_id_key])
+
+
+columnStoreSuffix = ".columns"
+columnStoreManifest = "manifest.json"
+runIndexFile = "run_index.npz"
+
+
+def isColumnStore(path):
+    '''
+    Whether path is a column store directory written by writeColumnStore
+    '''
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, columnStoreManifest))
+
+
+def writeColumnStore(df, path, key="ratescan"):
+    '''
+    Write a data frame to a column store: a directory with one uncompressed
+    .npy file per column and a json manifest with the number of rows and
+    the dtype of every column. Object columns, e.g. infile_path, are stored
+    as fixed width strings. The manifest is written last, a directory
+    without it is not a complete store. The column files of a store that
+    is overwritten are removed.
+    '''
+    os.makedirs(path, exist_ok=True)
+    manifest_path = os.path.join(path, columnStoreManifest)
+    old_files = []
+    if isColumnStore(path):
+        old_files = [c["file"] for c in readColumnStoreManifest(path)["columns"].values()]
+    for old in [manifest_path, os.path.join(path, runIndexFile)] + [os.path.join(path, f) for f in old_files]:
+        if os.path.exists(old):
+            os.remove(old)
+
+    columns = dict()
+    for i, column in enumerate(df.columns):
+        values = df[column].values
+        if values.dtype == object:
+            values = values.astype(str)
+        file_name = "{:03d}.npy".format(i)
+        np.save(os.path.join(path, file_name), np.ascontiguousarray(values))
+        columns[column] = dict(file=file_name, dtype=values.dtype.str)
+
+    with open(manifest_path, "w") as f:
+        json.dump(dict(key=key, n_rows=len(df), columns=columns), f, indent=1)
+
+
+def readColumnStoreManifest(path):
+    with open(os.path.join(path, columnStoreManifest)) as f:
+        return json.load(f)
+
+
+def loadColumnStore(path, columns=None):
+    '''
+    Memory map the given columns of a column store, returns a dict of
+    read only arrays. Nothing is read until the arrays are accessed.
+    '''
+    manifest = readColumnStoreManifest(path)
+    if columns is None:
+        columns = list(manifest["columns"])
+    missing = [c for c in columns if c not in manifest["columns"]]
+    if len(missing) > 0:
+        raise KeyError("columns {} not in column store {}".format(missing, path))
+    return {
+        c: np.load(os.path.join(path, manifest["columns"][c]["file"]), mmap_mode="r")
+        for c in columns
+    }
+
+
+def readColumnStore(path, columns=None):
+    '''
+    Read the given columns of a column store into a data frame, only the
+    files of these columns are touched
+    '''
+    return pd.DataFrame(loadColumnStore(path, columns))
+
+
+def compressionProfiles():
+    '''
+    Named h5py dataset options for the compression of written columns. The
+    gzip profiles are plain gzip like write_data(..., compression="gzip"),
+    the _shuffle ones add the shuffle filter, which groups the bytes of the
+    integer ratescan columns and makes them compress much better. blosc and
+    zstd are only available if hdf5plugin is installed.
+    '''
+    profiles = dict(
+        none=dict(),
+        lzf=dict(compression="lzf", shuffle=True),
+    )
+    for level in [1, 4, 9]:
+        profiles["gzip{}".format(level)] = dict(compression="gzip", compression_opts=level)
+        profiles["gzip{}_shuffle".format(level)] = dict(compression="gzip", compression_opts=level, shuffle=True)
+
+    try:
+        import hdf5plugin
+    except ImportError:
+        return profiles
+
+    profiles["blosc_lz4"] = dict(hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    profiles["zstd"] = dict(hdf5plugin.Zstd(clevel=3))
+    return profiles
+
+
+def compressionOptions(profile):
+    '''
+    The h5py dataset options of a compression profile, to be passed to
+    write_data or HDF5Writer, None means no options
+    '''
+    if profile is None:
+        return dict()
+    profiles = compressionProfiles()
+    if profile not in profiles:
+        raise ValueError("Unknown compression profile {}, available are {}".format(profile, list(profiles)))
+    return profiles[profile]
+
+
+class HDF5Writer:
+    '''
+    Append data frames to a h5py style hdf5 group with one dataset per
+    column, the same layout as fact.io.write_data. The file stays open
+    between appends and the datasets are preallocated and grown by
+    doubling their size, they are cut to the number of written rows on
+    close. chunk_rows is the chunk length of the datasets, all other
+    keyword arguments are passed to create_dataset, e.g. the options of a
+    compression profile. If only empty data frames were appended, empty
+    datasets of their columns are written on close.
+
+    Use it as a context manager:
+
+        with HDF5Writer(outfile, key="ratescan", **compressionOptions("gzip4")) as writer:
+            for df in job_outputs:
+                writer.append(df)
+    '''
+
+    def __init__(self, file_path, key="data", mode="w", capacity=2**16, chunk_rows=2**16, **dataset_kwargs):
+        self.file_path = file_path
+        self.key = key
+        self.mode = mode
+        self.capacity = max(1, capacity)
+        self.chunk_rows = chunk_rows
+        self.dataset_kwargs = dataset_kwargs
+        self.file = None
+        self.group = None
+        self.n_rows = 0
+        self.empty = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self.file = h5py.File(self.file_path, self.mode)
+        if self.key in self.file:
+            self.group = self.file[self.key]
+            columns = list(self.group.keys())
+            if columns:
+                self.n_rows = self.group[columns[0]].shape[0]
+                self.capacity = self.n_rows
+
+    def close(self):
+        if self.file is None:
+            return
+        if (self.group is None or len(self.group.keys()) == 0) and self.empty is not None:
+            self._create_datasets(self.empty)
+        if self.group is not None:
+            for dataset in self.group.values():
+                dataset.resize(self.n_rows, axis=0)
+        self.file.close()
+        self.file = None
+
+    def _create_datasets(self, df):
+        self.group = self.file.require_group(self.key)
+        for column in df.columns:
+            array = df[column].values
+            attrs = {}
+            if array.dtype == object:
+                dtype = h5py.special_dtype(vlen=str)
+            elif array.dtype.type == np.datetime64:
+                dtype = np.array(0, dtype=array.dtype).astype("S").dtype
+                attrs["timeformat"] = "iso"
+            else:
+                dtype = array.dtype
+            chunks = (max(1, min(self.capacity, self.chunk_rows)),)
+            dataset = self.group.create_dataset(
+                column,
+                shape=(self.capacity,),
+                maxshape=(None,),
+                dtype=dtype,
+                chunks=chunks,
+                **self.dataset_kwargs
+            )
+            for k, v in attrs.items():
+                dataset.attrs[k] = v
+
+    def _promote(self, column, dtype):
+        '''
+        Replace the dataset of column by one with the common dtype of the
+        written rows and dtype, e.g. float64 for an int column that gets
+        NaN values, like pandas does when concatenating
+        '''
+        dataset = self.group[column]
+        if dataset.dtype.kind not in "biuf" or np.dtype(dtype).kind not in "biuf":
+            raise TypeError("Can not append {} values to the {} dataset {}/{}/{}".format(
+                dtype, dataset.dtype, self.file_path, self.key, column
+            ))
+        new_dtype = np.result_type(dataset.dtype, dtype)
+        log.debug("promoting {}/{} from {} to {}".format(self.key, column, dataset.dtype, new_dtype))
+
+        values = dataset[:self.n_rows]
+        attrs = dict(dataset.attrs)
+        chunks = dataset.chunks
+        del self.group[column]
+        dataset = self.group.create_dataset(
+            column,
+            shape=(self.capacity,),
+            maxshape=(None,),
+            dtype=new_dtype,
+            chunks=chunks,
+            **self.dataset_kwargs
+        )
+        dataset[:self.n_rows] = values
+        for k, v in attrs.items():
+            dataset.attrs[k] = v
+
+    def append(self, df):
+        if len(df) == 0:
+            if len(df.columns) > 0:
+                self.empty = df.iloc[:0]
+            return
+
+        if self.group is None or len(self.group.keys()) == 0:
+            self._create_datasets(df)
+
+        columns = set(self.group.keys())
+        if columns != set(df.columns):
+            raise ValueError(
+                "Columns of data frame do not match the datasets in {}/{}: {}".format(
+                    self.file_path, self.key, sorted(columns ^ set(df.columns))
+                )
+            )
+
+        n_new = len(df)
+        if self.n_rows + n_new > self.capacity:
+            self.capacity = max(2 * self.capacity, self.n_rows + n_new)
+            for dataset in self.group.values():
+                dataset.resize(self.capacity, axis=0)
+
+        for column in df.columns:
+            array = df[column].values
+            if array.dtype.type == np.datetime64:
+                array = array.astype("S")
+            elif array.dtype == object:
+                array = array.astype(str).astype(object)
+            if not np.can_cast(array.dtype, self.group[column].dtype, casting="safe"):
+                self._promote(column, array.dtype)
+            self.group[column][self.n_rows:self.n_rows + n_new] = array
+
+        self.n_rows += n_new
+
+
+def readColumnsH5py(file_path, key, columns, first=None, last=None):
+    '''
+    Read the given column datasets of a h5py style group into a dict of
+    arrays without building a data frame
+    '''
+    with h5py.File(file_path, "r") as f:
+        group = f[key]
+        return {c: group[c][first:last] for c in columns}
+
+
+def copyRowsH5py(input_path, output_file, key, selection, chunk_rows=1000000, compression=None):
+    '''
+    Copy the rows selected by the boolean array selection of every column
+    dataset of the group key in input_path into the same group of the open
+    h5py.File output_file. Each dataset is read in contiguous chunks of
+    chunk_rows rows and only the selected rows are written, the data never
+    goes through pandas. Dtypes and attributes are kept, the compression
+    as well unless a compression profile is given.
+    '''
+    selection = np.asarray(selection, dtype=bool)
+    n_selected = int(selection.sum())
+
+    with h5py.File(input_path, "r") as f:
+        group = f[key]
+        out_group = output_file.require_group(key)
+        for k, v in group.attrs.items():
+            out_group.attrs[k] = v
+
+        for name, dataset in group.items():
+            if not isinstance(dataset, h5py.Dataset):
+                continue
+            if compression is None:
+                options = dict(
+                    compression=dataset.compression,
+                    compression_opts=dataset.compression_opts,
+                    shuffle=dataset.shuffle,
+                )
+            else:
+                options = compressionOptions(compression)
+            out = out_group.create_dataset(
+                name,
+                shape=(n_selected, ) + dataset.shape[1:],
+                maxshape=(None, ) + dataset.shape[1:],
+                dtype=dataset.dtype,
+                chunks=dataset.chunks if dataset.chunks is not None else True,
+                **options
+            )
+            for k, v in dataset.attrs.items():
+                out.attrs[k] = v
+
+            n_written = 0
+            for first in range(0, dataset.shape[0], chunk_rows):
+                mask = selection[first:first + chunk_rows]
+                n_chunk = int(mask.sum())
+                if n_chunk == 0:
+                    continue
+                out[n_written:n_written + n_chunk] = dataset[first:first + chunk_rows][mask]
+                n_written += n_chunk
+    return n_selected
+
+
+def hdf5Layout(infile_path, key):
+    '''
+    Layout of the group key of a hdf5 file: pandas_table or pandas_fixed
+    for files written by pandas in table or fixed format, h5py for one
+    dataset per column as written by fact.io
+    '''
+    with h5py.File(infile_path, "r") as f:
+        pandas_type = f[key].attrs.get("pandas_type")
+    if isinstance(pandas_type, bytes):
+        pandas_type = pandas_type.decode()
+    if pandas_type is None:
+        return "h5py"
+    return "pandas_table" if pandas_type == "frame_table" else "pandas_fixed"
+
+
+def _availableColumns(columns, available, infile_path):
+    # like reading all columns, requested columns missing in the file are
+    # left out of the result
+    if columns is None:
+        return None
+    missing = [c for c in columns if c not in available]
+    if len(missing) > 0:
+        log.warning("columns {} not in {}".format(missing, infile_path))
+    return [c for c in columns if c in available]
+
+
+def _readRows(infile_path, key, columns, first=None, last=None):
+    if isColumnStore(infile_path):
+        columns = _availableColumns(columns, readColumnStoreManifest(infile_path)["columns"], infile_path)
+        return pd.DataFrame({c: v[first:last] for c, v in loadColumnStore(infile_path, columns).items()})
+
+    layout = hdf5Layout(infile_path, key)
+    if layout == "h5py":
+        with h5py.File(infile_path, "r") as f:
+            available = list(f[key].keys())
+        columns = _availableColumns(columns, available, infile_path)
+        return read_h5py(infile_path, key=key, columns=columns, first=first, last=last)
+
+    if layout == "pandas_table":
+        with pd.HDFStore(infile_path, "r") as store:
+            available = list(store.get_storer(key).non_index_axes[0][1])
+        columns = _availableColumns(columns, available, infile_path)
+        return pd.read_hdf(infile_path, key=key, columns=columns, start=first, stop=last)
+
+    # the fixed format can only be read as a whole
+    df = pd.read_hdf(infile_path, key=key, start=first, stop=last)
+    columns = _availableColumns(columns, df.columns, infile_path)
+    return df if columns is None else df[columns]
+
+
+def readInput(
+        infile_path,
+        key="ratescan",
+        columns=None,
+        first=None,
+        last=None,
+        runs=None,
+        night_key="night",
+        run_id_key="run_id",
+        workers=1,
+        ):
+    '''
+    Read a ratescan input file, jsonl, hdf5 or a column store, into a data
+    frame with only the given columns, all columns if None. For hdf5 files
+    and column stores only the datasets of these columns are read.
+
+    first and last select a range of rows. runs is a list of
+    (night, run_id) pairs, only their rows are returned. For hdf5 files and
+    column stores with a run index only the row ranges of these runs are
+    read. Without an index the run keys are read first and the other
+    columns only between the first and the last selected row.
+    '''
+    columns = None if columns is None else list(columns)
+    if infile_path.endswith("json.gz") or infile_path.endswith("json"):
+        keys = None if columns is None else list(dict.fromkeys(columns + [night_key, run_id_key]))
+        df = readJsonLtoDf(infile_path, default_keys_to_store=keys, workers=workers).iloc[first:last]
+        if runs is not None:
+            df = df[_runSelection(df[night_key], df[run_id_key], runs)]
+        df = df.reset_index(drop=True)
+        return df if columns is None else df[columns]
+
+    if not (isColumnStore(infile_path) or infile_path.endswith("hdf") or infile_path.endswith("hdf5")):
+        raise IOError("input fileformat of {} not supported".format(infile_path))
+
+    if runs is None:
+        return _readRows(infile_path, key, columns, first, last)
+
+    ranges = None
+    if first is None and last is None:
+        ranges = readRunIndex(infile_path, key, night_key=night_key, run_id_key=run_id_key)
+    if ranges is not None:
+        ranges = ranges[_runSelection(ranges["night"], ranges["run_id"], runs)]
+        dfs = [_readRows(infile_path, key, columns, start, stop) for start, stop in _mergeRanges(ranges)]
+        if len(dfs) == 0:
+            return _readRows(infile_path, key, columns, 0, 0)
+        return pd.concat(dfs, ignore_index=True)
+
+    df_keys = _readRows(infile_path, key, [night_key, run_id_key], first, last)
+    selected = _runSelection(df_keys[night_key], df_keys[run_id_key], runs)
+    rows = np.flatnonzero(selected)
+    offset = 0 if first is None else first
+    if len(rows) == 0:
+        start, stop = offset, offset
+    else:
+        start, stop = offset + rows[0], offset + rows[-1] + 1
+
+    df = _readRows(infile_path, key, columns, start, stop)
+    return df[selected[start - offset:stop - offset]].reset_index(drop=True)
+
+
+def nRows(infile_path, key="ratescan"):
+    '''
+    Number of rows of a hdf5 group or column store without reading it
+    '''
+    if isColumnStore(infile_path):
+        return readColumnStoreManifest(infile_path)["n_rows"]
+    layout = hdf5Layout(infile_path, key)
+    with h5py.File(infile_path, "r") as f:
+        group = f[key]
+        if layout == "pandas_table":
+            return group["table"].shape[0]
+        if layout == "pandas_fixed":
+            # axis1 is the row index of a fixed format frame
+            return group["axis1"].shape[0]
+        datasets = [d for d in group.values() if isinstance(d, h5py.Dataset)]
+        return datasets[0].shape[0] if len(datasets) > 0 else 0
+
+
+def iterInput(infile_path, key="ratescan", columns=None, chunk_rows=1000000):
+    '''
+    Generator over a ratescan input file yielding data frames of at most
+    chunk_rows rows with the given columns, so only one chunk is in memory
+    at a time
+    '''
+    if infile_path.endswith("json.gz") or infile_path.endswith("json"):
+        yield from iterJsonLBatches(infile_path, default_keys_to_store=columns, batch_size=chunk_rows)
+        return
+
+    n_rows = nRows(infile_path, key)
+    for first in range(0, n_rows, chunk_rows):
+        yield readInput(infile_path, key=key, columns=columns, first=first, last=first + chunk_rows)
+
+
+def _runSelection(nights, run_ids, runs):
+    index = pd.MultiIndex.from_arrays([np.asarray(nights), np.asarray(run_ids)])
+    return index.isin([tuple(run) for run in runs])
+
+
+def _mergeRanges(ranges):
+    merged = []
+    for start, stop in sorted(zip(ranges["first"], ranges["last"])):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def runRowRanges(nights, run_ids):
+    '''
+    Row ranges [first, last) of consecutive rows with the same night and
+    run_id, a run that is split in a file has several ranges
+    '''
+    nights = np.asarray(nights)
+    run_ids = np.asarray(run_ids)
+    change = np.flatnonzero((nights[1:] != nights[:-1]) | (run_ids[1:] != run_ids[:-1])) + 1
+    first = np.concatenate([[0], change]).astype(np.int64)
+    last = np.concatenate([change, [len(nights)]]).astype(np.int64)
+    if len(nights) == 0:
+        first, last = first[:0], last[:0]
+    return pd.DataFrame(dict(night=nights[first], run_id=run_ids[first], first=first, last=last))
+
+
+def runIndexPath(path, key="ratescan"):
+    '''
+    Path of the run index file of a hdf5 file or column store. The index is
+    kept outside of the data, so it never shows up as a group of the file.
+    '''
+    if isColumnStore(path):
+        return os.path.join(path, runIndexFile)
+    return "{}.{}_{}".format(path, key, runIndexFile)
+
+
+def writeRunIndex(path, key="ratescan", night_key="night", run_id_key="run_id"):
+    '''
+    Store the row ranges of all runs of a hdf5 file or column store in the
+    file given by runIndexPath. The number of rows and the modification time
+    of a hdf5 file are stored as well, so the index of a file that was
+    changed later is not used.
+    '''
+    df_keys = _readRows(path, key, [night_key, run_id_key])
+    ranges = runRowRanges(df_keys[night_key].values, df_keys[run_id_key].values)
+    meta = dict(n_rows=len(df_keys), night_key=night_key, run_id_key=run_id_key)
+    if not isColumnStore(path):
+        meta["mtime"] = os.path.getmtime(path)
+
+    np.savez(runIndexPath(path, key), **{c: ranges[c].values for c in ranges.columns}, **meta)
+    log.debug("run index of {}: {} ranges".format(path, len(ranges)))
+    return ranges
+
+
+def readRunIndex(path, key="ratescan", night_key="night", run_id_key="run_id"):
+    '''
+    The row ranges written by writeRunIndex as data frame with the columns
+    night, run_id, first and last, None if there is no up to date index
+    '''
+    columns = ["night", "run_id", "first", "last"]
+    index_path = runIndexPath(path, key)
+    if not os.path.exists(index_path):
+        return None
+    with np.load(index_path) as f:
+        meta = {k: f[k].item() for k in f.files if k not in columns}
+        ranges = pd.DataFrame({c: f[c] for c in columns})
+
+    if isColumnStore(path):
+        n_rows = readColumnStoreManifest(path)["n_rows"]
+    else:
+        if meta.get("mtime") != os.path.getmtime(path):
+            log.warning("run index of {} is outdated, it is not used".format(path))
+            return None
+        with h5py.File(path, "r") as f:
+            if key not in f or night_key not in f[key]:
+                return None
+            n_rows = f[key][night_key].shape[0]
+
+    if (meta["night_key"], meta["run_id_key"]) != (night_key, run_id_key):
+        return None
+    if meta["n_rows"] != n_rows:
+        log.warning("run index of {} is outdated, it is not used".format(path))
+        return None
+    return ranges
@@ -23,4 +23,92 @@ def ratescan_func(t, m, a, b, m_0, t_0):
     """
     Model for both regions of a ratescan without the saturated part
     """
-    return nsbContribution(t, m_0, t_0) + powerLaw(t, m, a, b)
\ No newline at end of file
+    return nsbContribution(t, m_0, t_0) + powerLaw(t, m, a, b)
+
+def powerLawJacobian(t, m, a, b):
+    """
+    Partial derivatives of powerLaw with respect to m, a and b,
+    stacked along the last axis
+    """
+    t_a = np.power(t, a)
+    return np.stack([t_a, m*t_a*np.log(t), np.ones_like(t_a)], axis=-1)
+
+def nsbContributionJacobian(t, m, t_0):
+    """
+    Partial derivatives of nsbContribution with respect to m and t_0,
+    stacked along the last axis
+    """
+    nsb = nsbContribution(t, m, t_0)
+    return np.stack([nsb*(t - t_0), -m*nsb], axis=-1)
+
+def ratescan_funcJacobian(t, m, a, b, m_0, t_0):
+    """
+    Partial derivatives of ratescan_func with respect to all parameters,
+    stacked along the last axis
+    """
+    return np.concatenate([powerLawJacobian(t, m, a, b), nsbContributionJacobian(t, m_0, t_0)], axis=-1)
+
+def logRatescan_func(t, m, a, b, m_0, t_0):
+    """
+    Logarithm of ratescan_func, for fits in log space
+    """
+    return np.log(ratescan_func(t, m, a, b, m_0, t_0))
+
+def logRatescan_funcJacobian(t, m, a, b, m_0, t_0):
+    """
+    Partial derivatives of logRatescan_func with respect to all parameters,
+    stacked along the last axis
+    """
+    rate = ratescan_func(t, m, a, b, m_0, t_0)
+    return ratescan_funcJacobian(t, m, a, b, m_0, t_0)/rate[..., np.newaxis]
+
+# lower and upper bounds of the parameters of ratescan_func: a falling
+# power law with a non negative offset and a falling nsb contribution
+ratescan_funcBounds = (
+    np.array([0, -np.inf, 0, -np.inf, -np.inf]),
+    np.array([np.inf, 0, np.inf, 0, np.inf]),
+)
+
+def _linearLeastSquares(x, y, w):
+    """
+    Weighted straight line fit y = slope*x + intercept along the last axis,
+    returns slope and intercept
+    """
+    sw = np.sum(w, axis=-1)
+    x_mean = np.sum(w*x, axis=-1)/sw
+    y_mean = np.sum(w*y, axis=-1)/sw
+    dx = x - x_mean[..., np.newaxis]
+    dy = y - y_mean[..., np.newaxis]
+    slope = np.sum(w*dx*dy, axis=-1)/np.sum(w*dx*dx, axis=-1)
+    return slope, y_mean - slope*x_mean
+
+def _positiveWeights(rate, weights):
+    weights = np.ones_like(rate, dtype=float) if weights is None else np.asarray(weights, dtype=float)
+    return np.where(rate > 0, weights, 0)
+
+def powerLawInitialGuess(t, rate, weights=None):
+    """
+    Starting values for powerLaw from a straight line fit of log(rate)
+    against log(t), the offset b is set to the mean remaining residual.
+    Works along the last axis, points with weight 0 are ignored.
+    """
+    w = _positiveWeights(rate, weights)
+    with np.errstate(all="ignore"):
+        # unused points, e.g. at threshold 0, must not turn the sums into nan
+        t = np.where(w > 0, t, 1)
+        a, log_m = _linearLeastSquares(np.log(t), np.log(np.where(w > 0, rate, 1)), w)
+        m = np.exp(log_m)
+        residual = rate - m[..., np.newaxis]*np.power(t, a[..., np.newaxis])
+        b = np.sum(w*residual, axis=-1)/np.sum(w, axis=-1)
+    return np.stack([m, a, b], axis=-1)
+
+def nsbContributionInitialGuess(t, rate, weights=None):
+    """
+    Starting values for nsbContribution from a straight line fit of
+    log(rate) = m*t - m*t_0. Works along the last axis, points with
+    weight 0 are ignored.
+    """
+    w = _positiveWeights(rate, weights)
+    with np.errstate(all="ignore"):
+        m, intercept = _linearLeastSquares(t, np.log(np.where(w > 0, rate, 1)), w)
+    return np.stack([m, -intercept/m], axis=-1)
@@ -0,0 +1,269 @@
+import logging
+import sqlite3
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from fact.factdb import RunInfo
+from fact.factdb.utils import read_into_dataframe
+from peewee import SQL, Tuple, fn
+
+log = logging.getLogger(__name__)
+
+
+def _runInfoColumns():
+    return (
+        RunInfo.fnight.alias('night'),
+        RunInfo.frunid.alias('run_id'),
+        (
+            fn.TIMESTAMPDIFF(SQL('SECOND'),
+            RunInfo.frunstart,
+            RunInfo.frunstop
+        )*RunInfo.feffectiveon).alias('ontime'),
+        RunInfo.fcurrentsmedmeanbeg.alias('current_at_start'),
+    )
+
+
+def queryRunInfo(first_night, last_night):
+    '''
+    Get night, run_id, ontime and current_at_start of all runs between
+    first_night and last_night from the FACT run database in one query
+    '''
+    query = (
+        RunInfo.select(*_runInfoColumns())
+        .where(RunInfo.fnight >= int(first_night))
+        .where(RunInfo.fnight <= int(last_night))
+    )
+    return read_into_dataframe(query)
+
+
+def queryRunInfoForRuns(nights, run_ids, chunk_size=1000):
+    '''
+    Get night, run_id, ontime and current_at_start of exactly the given
+    runs from the FACT run database, with one IN query per chunk_size runs
+    '''
+    runs = sorted(set(zip(np.asarray(nights).tolist(), np.asarray(run_ids).tolist())))
+    dfs = []
+    for start in range(0, len(runs), chunk_size):
+        query = (
+            RunInfo.select(*_runInfoColumns())
+            .where(Tuple(RunInfo.fnight, RunInfo.frunid).in_(runs[start:start + chunk_size]))
+        )
+        dfs.append(read_into_dataframe(query))
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=['night', 'run_id', 'ontime', 'current_at_start'])
+    return pd.concat(dfs, ignore_index=True)
+
+
+class RunInfoCache:
+    '''
+    Local snapshot of the run database in a sqlite file with the columns
+    night, run_id, ontime and current_at_start.
+
+    lookup fetches nights that are not in the snapshot with one query for
+    the whole range of missing nights. A night that was fetched less than
+    settle_days after it was observed is fetched again, as its runs may
+    not have been complete in the run database. With offline=True the
+    database is never queried and only the snapshot is used.
+
+        with RunInfoCache("run_db.sqlite") as run_db:
+            df = joinOnTimesFromRunDB(df, run_db_cache=run_db)
+    '''
+
+    columns = ['ontime', 'current_at_start']
+
+    def __init__(self, path, offline=False, settle_days=2, timeout=60):
+        self.path = path
+        self.offline = offline
+        self.settle_days = settle_days
+        self.timeout = timeout
+        self.connection = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self.connection = sqlite3.connect(self.path, timeout=self.timeout)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "night INTEGER, run_id INTEGER, ontime REAL, current_at_start REAL, "
+                "PRIMARY KEY (night, run_id))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS nights (night INTEGER PRIMARY KEY, fetched_at REAL)"
+            )
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def insert(self, df_runs, nights=None, fetched_at=None):
+        '''
+        Store runs from a data frame with the columns night, run_id, ontime
+        and current_at_start, nights are marked as complete at fetched_at
+        '''
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        if nights is None:
+            nights = df_runs['night'].unique()
+
+        rows = [
+            (int(night), int(run_id), _toFloat(ontime), _toFloat(current))
+            for night, run_id, ontime, current in zip(
+                df_runs['night'], df_runs['run_id'], df_runs['ontime'], df_runs['current_at_start']
+            )
+        ]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)", rows
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO nights VALUES (?, ?)",
+                [(int(night), fetched_at) for night in nights],
+            )
+
+    def fetch(self, first_night, last_night):
+        '''
+        Query all runs between first_night and last_night from the run
+        database and store them in the snapshot
+        '''
+        log.info("fetching runs of nights {} to {} from the run db".format(first_night, last_night))
+        df_runs = queryRunInfo(first_night, last_night)
+        nights = pd.date_range(
+            _nightToDatetime(first_night), _nightToDatetime(last_night)
+        ).strftime('%Y%m%d').astype(int)
+        self.insert(df_runs, nights=nights)
+
+    def staleNights(self, nights):
+        '''
+        The given nights that are missing in the snapshot or were fetched
+        before they were settled
+        '''
+        nights = np.unique(np.asarray(nights, dtype=np.int64))
+        fetched = dict(self.connection.execute("SELECT night, fetched_at FROM nights").fetchall())
+        stale = []
+        for night in nights:
+            settled = _nightToDatetime(night).timestamp() + self.settle_days * 24 * 3600
+            if night not in fetched or fetched[night] < settled:
+                stale.append(night)
+        return stale
+
+    def update(self, nights):
+        stale = self.staleNights(nights)
+        if len(stale) == 0:
+            return
+        if self.offline:
+            log.warning("{} nights are missing in the run db snapshot {}".format(len(stale), self.path))
+            return
+        self.fetch(min(stale), max(stale))
+
+    def lookup(self, nights, run_ids, columns=None):
+        '''
+        Return a data frame with night, run_id and the requested columns for
+        the given runs, runs missing in the snapshot are left out
+        '''
+        columns = self.columns if columns is None else list(columns)
+        runs = pd.DataFrame({'night': np.asarray(nights), 'run_id': np.asarray(run_ids)}).drop_duplicates()
+        if len(runs) == 0:
+            return pd.DataFrame(columns=['night', 'run_id', *columns])
+        self.update(runs['night'].values)
+
+        df_snapshot = pd.read_sql_query(
+            "SELECT night, run_id, {} FROM runs WHERE night >= ? AND night <= ?".format(", ".join(columns)),
+            self.connection,
+            params=(int(runs['night'].min()), int(runs['night'].max())),
+        )
+        df_runs = pd.merge(runs, df_snapshot, on=['night', 'run_id'], how='inner')
+        if len(df_runs) < len(runs):
+            log.warning("{} runs not found in the run db snapshot".format(len(runs) - len(df_runs)))
+        return df_runs
+
+
+class RunInfoTable:
+    '''
+    Run infos that were fetched up front, e.g. by the driver for all runs of
+    all input files, with the lookup interface of RunInfoCache. It never
+    queries the run database.
+    '''
+
+    def __init__(self, df_runs):
+        self.df_runs = df_runs
+
+    def lookup(self, nights, run_ids, columns=None):
+        columns = RunInfoCache.columns if columns is None else list(columns)
+        runs = pd.DataFrame({'night': np.asarray(nights), 'run_id': np.asarray(run_ids)}).drop_duplicates()
+        df_runs = pd.merge(runs, self.df_runs[['night', 'run_id', *columns]], on=['night', 'run_id'], how='inner')
+        if len(df_runs) < len(runs):
+            log.warning("{} runs not found in the run info table".format(len(runs) - len(df_runs)))
+        return df_runs
+
+
+def fetchRunInfo(df_keys, night_key="night", run_id_key="run_id", snapshot=None, offline=False):
+    '''
+    Fetch the run infos of the runs in df_keys with one round trip, from
+    the snapshot if a path is given, otherwise with chunked IN queries.
+    Returns a data frame to build a RunInfoTable from.
+    '''
+    nights, run_ids = df_keys[night_key].values, df_keys[run_id_key].values
+    if snapshot is not None:
+        with RunInfoCache(snapshot, offline=offline) as run_db:
+            return run_db.lookup(nights, run_ids)
+    log.info("fetching {} runs from the run db".format(len(df_keys)))
+    return queryRunInfoForRuns(nights, run_ids)
+
+
+def openRunInfoCache(path, offline=False, table=None):
+    '''
+    Context manager for the run infos used in a job: a RunInfoTable if a
+    table was fetched up front, a RunInfoCache at path, or None if neither
+    is given so the run database is queried directly
+    '''
+    if table is not None:
+        return nullcontext(RunInfoTable(table))
+    if path is None:
+        return nullcontext()
+    return RunInfoCache(path, offline=offline)
+
+
+def _toFloat(value):
+    return None if pd.isnull(value) else float(value)
+
+
+def _nightToDatetime(night):
+    return datetime.strptime(str(int(night)), '%Y%m%d')
+
+
+def prefetchRunInfo(infiles, key_dict):
+    '''
+    Read the runs of all input files in the driver and fetch their run infos
+    with one query, the table is passed to the jobs as run_db_table.
+    The keys and the snapshot are taken from key_dict. Jsonl files
+    are decoded for this, so it pays off mostly for hdf5 and column store
+    inputs.
+    '''
+    from .io import readRunKeys
+
+    if len(infiles) == 0:
+        return None
+    night_key = key_dict["night_key"] if "night_key" in key_dict.keys() else "night"
+    run_id_key = key_dict["run_id_key"] if "run_id_key" in key_dict.keys() else "run_id"
+    inkey = key_dict["inkey"] if "inkey" in key_dict.keys() else "ratescan"
+
+    df_run_keys = pd.concat([
+        readRunKeys(f, night_key=night_key, run_id_key=run_id_key, inkey=inkey)
+        for f in infiles
+    ]).drop_duplicates()
+    return fetchRunInfo(
+        df_run_keys,
+        night_key=night_key,
+        run_id_key=run_id_key,
+        snapshot=key_dict["run_db_snapshot"] if "run_db_snapshot" in key_dict.keys() else None,
+        offline=key_dict["run_db_offline"] if "run_db_offline" in key_dict.keys() else False,
+    )
@@ -0,0 +1,117 @@
+import logging
+import os
+import re
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from .io import HDF5Writer, readInput, compressionOptions
+
+log = logging.getLogger(__name__)
+
+
+class SeasonStore:
+    '''
+    Season wide store of per run results, e.g. the summed ratescans and the
+    fitted features, partitioned by night: one hdf5 file per night in the
+    directory path with one group per table.
+
+    write adds or replaces runs and only rewrites the partitions of the
+    nights in the new data. read of a night range only opens the
+    partitions of these nights.
+
+        store = SeasonStore("season")
+        store.write(dict(features=df_features, ratescans=df_ratescans))
+        df = store.read("features", first_night=20150901, last_night=20150930)
+    '''
+
+    partition_pattern = re.compile(r"^(\d{8})\.hdf5$")
+
+    def __init__(self, path, night_key="night", run_id_key="run_id", compression=None):
+        self.path = path
+        self.night_key = night_key
+        self.run_id_key = run_id_key
+        self.compression = compression
+        os.makedirs(path, exist_ok=True)
+
+    def partitionPath(self, night):
+        return os.path.join(self.path, "{}.hdf5".format(int(night)))
+
+    def nights(self):
+        nights = []
+        for name in os.listdir(self.path):
+            match = self.partition_pattern.match(name)
+            if match:
+                nights.append(int(match.group(1)))
+        return sorted(nights)
+
+    def tables(self, night):
+        with h5py.File(self.partitionPath(night), "r") as f:
+            return list(f.keys())
+
+    def readPartition(self, night, table, columns=None):
+        if table not in self.tables(night):
+            return pd.DataFrame()
+        return readInput(self.partitionPath(night), key=table, columns=columns)
+
+    def read(self, table, first_night=None, last_night=None, columns=None):
+        '''
+        Read a table for all nights between first_night and last_night,
+        only the partitions of these nights are read
+        '''
+        nights = [
+            night for night in self.nights()
+            if (first_night is None or night >= first_night) and (last_night is None or night <= last_night)
+        ]
+        dfs = [self.readPartition(night, table, columns=columns) for night in nights]
+        dfs = [df for df in dfs if len(df) > 0]
+        if len(dfs) == 0:
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True)
+
+    def write(self, tables):
+        '''
+        Add the runs in tables, a dict of table name: data frame. Runs that
+        are already stored are replaced in all tables, also in tables that
+        have no rows for them in the new data. Each night partition is
+        written to a temporary file and then renamed.
+        '''
+        new_nights = np.unique(np.concatenate([
+            df[self.night_key].values for df in tables.values() if len(df) > 0
+        ] + [np.array([], dtype=np.int64)]))
+
+        for night in new_nights:
+            self._writeNight(night, {
+                table: df[df[self.night_key] == night] if len(df) > 0 else df for table, df in tables.items()
+            })
+        log.info("season store: wrote {} nights".format(len(new_nights)))
+
+    def _writeNight(self, night, new_tables):
+        path = self.partitionPath(night)
+        new_runs = np.unique(np.concatenate([
+            df[self.run_id_key].values for df in new_tables.values() if len(df) > 0
+        ]))
+
+        tables = dict()
+        stored_tables = self.tables(night) if os.path.exists(path) else []
+        for table in sorted(set(stored_tables) | set(new_tables)):
+            df_old = self.readPartition(night, table) if table in stored_tables else pd.DataFrame()
+            if len(df_old) > 0:
+                df_old = df_old[~np.isin(df_old[self.run_id_key].values, new_runs)]
+            dfs = [df for df in [df_old, new_tables.get(table, pd.DataFrame())] if len(df) > 0]
+            tables[table] = pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame()
+
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with h5py.File(tmp_path, "w"):
+            pass
+        for table, df in tables.items():
+            if len(df) == 0:
+                continue
+            df = df.sort_values(self.run_id_key, kind="stable").reset_index(drop=True)
+            with HDF5Writer(tmp_path, key=table, mode="a", **compressionOptions(self.compression)) as writer:
+                writer.append(df)
+        os.replace(tmp_path, path)
+        log.debug("season store: wrote {} runs of night {}".format(len(new_runs), night))
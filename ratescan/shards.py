@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+
+from .execution import Job
+from .io import HDF5Writer, readInput, compressionOptions
+
+log = logging.getLogger(__name__)
+
+
+def fileChecksum(path, block_size=2**20):
+    '''
+    sha1 of the content of a file, or of all files of a directory such as a
+    column store
+    '''
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(path, name) for name in os.listdir(path))
+    else:
+        paths = [path]
+    for p in paths:
+        if not os.path.isfile(p):
+            continue
+        with open(p, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def configHash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def runShard(function, args, shard_path, marker):
+    '''
+    Job that runs function(*args), writes the resulting data frame to
+    shard_path and then the completion marker. Both are written to a
+    temporary file first and renamed, a shard without a marker is never
+    used.
+    '''
+    df = function(*args)
+
+    marker_path = shard_path + ".done"
+    for path in [marker_path, shard_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    if len(df) > 0:
+        with HDF5Writer(shard_path + ".tmp", key=marker["key"]) as writer:
+            writer.append(df)
+        os.replace(shard_path + ".tmp", shard_path)
+
+    with open(marker_path + ".tmp", "w") as f:
+        json.dump(dict(marker, n_rows=len(df)), f)
+    os.replace(marker_path + ".tmp", marker_path)
+    return len(df)
+
+
+class ShardSet:
+    '''
+    One output shard per input file in shard_dir, so a campaign can be
+    resumed after failed jobs and extended by new input files.
+
+    Every shard has a completion marker with the checksum of its input file
+    and a hash of the configuration. Only input files without a valid marker
+    are processed again, merge combines the shards of all input files.
+
+        shards = ShardSet(shard_dir, infiles, key="ratescan", config=config)
+        jobs = make_jobs(shards.pending(), ...)
+        jobs = [shards.wrap(job, infile) for job, infile in zip(jobs, shards.pending())]
+        for n_rows in process_jobs(jobs):
+            pass
+        shards.merge(outfile)
+    '''
+
+    def __init__(self, shard_dir, infiles, key="ratescan", config=None):
+        self.shard_dir = shard_dir
+        self.infiles = list(infiles)
+        self.key = key
+        self.config_hash = configHash(config)
+        os.makedirs(shard_dir, exist_ok=True)
+        self.checksums = {f: fileChecksum(f) for f in self.infiles}
+
+    def shardPath(self, infile_path):
+        name = os.path.basename(os.path.normpath(infile_path))
+        path_hash = hashlib.sha1(os.path.abspath(infile_path).encode()).hexdigest()[:10]
+        return os.path.join(self.shard_dir, "{}_{}.hdf5".format(name, path_hash))
+
+    def marker(self, infile_path):
+        return dict(
+            infile=os.path.abspath(infile_path),
+            checksum=self.checksums[infile_path],
+            config=self.config_hash,
+            key=self.key,
+        )
+
+    def readMarker(self, infile_path):
+        try:
+            with open(self.shardPath(infile_path) + ".done") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def isDone(self, infile_path):
+        marker = self.readMarker(infile_path)
+        if marker is None:
+            return False
+        if any(marker.get(k) != v for k, v in self.marker(infile_path).items()):
+            return False
+        return marker["n_rows"] == 0 or os.path.exists(self.shardPath(infile_path))
+
+    def pending(self):
+        return [f for f in self.infiles if not self.isDone(f)]
+
+    def wrap(self, job, infile_path):
+        '''
+        Job that runs job and stores its output as shard of infile_path
+        '''
+        return Job(
+            runShard,
+            [job.function, job.args, self.shardPath(infile_path), self.marker(infile_path)],
+            name=job.name,
+            size=job.size,
+            **job.options
+        )
+
+    def merge(self, outfile, compression=None):
+        '''
+        Combine the shards of all input files into outfile, raises a
+        RuntimeError if some input files are not done
+        '''
+        pending = self.pending()
+        if len(pending) > 0:
+            raise RuntimeError("{} input files have no valid shard, e.g. {}".format(len(pending), pending[0]))
+
+        with HDF5Writer(outfile, key=self.key, **compressionOptions(compression)) as writer:
+            for infile_path in self.infiles:
+                if self.readMarker(infile_path)["n_rows"] == 0:
+                    continue
+                writer.append(readInput(self.shardPath(infile_path), key=self.key))
+        log.info("merged {} shards into {}".format(len(self.infiles), outfile))
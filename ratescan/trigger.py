@@ -0,0 +1,199 @@
+import numpy as np
+import pandas as pd
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def thresholdCurve(current, a, k):
+    """
+    Software trigger threshold for a given current, a * current**k.
+    current, a and k are broadcast against each other.
+    """
+    with np.errstate(invalid="ignore"):
+        return a * np.power(current, k)
+
+
+def thresholdCurveName(a, k):
+    return f'SetSWThreshold_{a}_{k}'
+
+
+def maxPrimitivesThresholdName(n):
+    return f'max_threshold_{n}_primitives'
+
+
+def maxTriggeringThresholdPerEvent(
+        df,
+        group_keys=["night", "run_id", "event_num"],
+        counts_key="ratescan_trigger_counts",
+        thresholds_key="ratescan_trigger_thresholds",
+        value_keys=["current_at_start"],
+        n_primitives=(),
+        ):
+    """
+    Highest threshold with counts > 0 of every event, -inf for events
+    that never triggered. The first value of each of value_keys is kept
+    per event. For every n in n_primitives the highest threshold with
+    exactly n triggering patches is added as well, NaN if there is none.
+
+    Returns a data frame with one row per event sorted by group_keys.
+    """
+    counts = df[counts_key].values
+    thresholds = df[thresholds_key].values.astype(float)
+
+    columns = {"max_triggering_threshold": np.where(counts > 0, thresholds, -np.inf)}
+    for n in n_primitives:
+        columns[maxPrimitivesThresholdName(n)] = np.where(counts == n, thresholds, np.nan)
+
+    df_events = df[group_keys + value_keys].assign(**columns)
+    aggregations = {k: "max" for k in columns}
+    aggregations.update({k: "first" for k in value_keys})
+    return df_events.groupby(group_keys, sort=True).agg(aggregations).reset_index()
+
+
+def buildEventSummary(
+        df,
+        group_keys=["night", "run_id", "event_num"],
+        counts_key="ratescan_trigger_counts",
+        thresholds_key="ratescan_trigger_thresholds",
+        current_key="current_at_start",
+        n_primitives=[1],
+        ):
+    """
+    Reduce raw ratescan rows to one row per event with everything needed
+    for trigger studies: the event keys, the highest triggering threshold,
+    the highest threshold with n primitives for every n in n_primitives
+    and the current. Thresholds are stored as float32.
+    """
+    df_summary = maxTriggeringThresholdPerEvent(
+        df,
+        group_keys=group_keys,
+        counts_key=counts_key,
+        thresholds_key=thresholds_key,
+        value_keys=[current_key],
+        n_primitives=n_primitives,
+    )
+    threshold_columns = ["max_triggering_threshold"] + [maxPrimitivesThresholdName(n) for n in n_primitives]
+    return df_summary.astype({k: np.float32 for k in threshold_columns})
+
+
+def softwareTriggerDecisions(max_triggering_threshold, current, threshold_curve_par):
+    """
+    Decide for all events and all threshold curves at once, whether the
+    event would have triggered: its highest triggering threshold is at or
+    above the threshold curve a * current**k.
+
+    threshold_curve_par is a list of dicts with the keys a and k, returns a
+    data frame with one boolean column per curve.
+    """
+    a = np.array([p['a'] for p in threshold_curve_par], dtype=float)
+    k = np.array([p['k'] for p in threshold_curve_par], dtype=float)
+
+    thresholds = thresholdCurve(np.asarray(current, dtype=float)[:, np.newaxis], a, k)
+    triggered = np.asarray(max_triggering_threshold)[:, np.newaxis] >= thresholds
+
+    names = [thresholdCurveName(p['a'], p['k']) for p in threshold_curve_par]
+    return pd.DataFrame(triggered, columns=names)
+
+
+def _idValues(df, k):
+    """
+    Id column k of df as int64 and a mask of the rows with a valid id,
+    NaN ids are not valid
+    """
+    values = np.asarray(df[k])
+    if values.dtype.kind not in "iub":
+        values = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=float)
+        valid = np.isfinite(values)
+        return np.where(valid, values, 0).astype(np.int64), valid
+    return values.astype(np.int64), np.ones(len(values), dtype=bool)
+
+
+class AcceptedEvents:
+    """
+    Set of accepted events, e.g. the events passing a software trigger,
+    with the id keys packed into one int64 per event.
+
+    Every key column is stored as offset from its minimum in as many bits
+    as its range needs. Membership is looked up in a hash table of the
+    packed keys, which is built once and reused for all chunks. The set is
+    saved to a compact npz file which is all that jobs need to receive.
+    Events with a NaN id are never accepted, like in a merge on the id keys.
+    """
+
+    def __init__(self, id_keys, offsets, bits, keys):
+        self.id_keys = list(id_keys)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.bits = np.asarray(bits, dtype=np.int64)
+        self.keys = np.asarray(keys, dtype=np.int64)
+        # hash table of the keys, built on the first lookup
+        self._index = None
+
+    @classmethod
+    def from_dataframe(cls, df, id_keys):
+        ids = [_idValues(df, k) for k in id_keys]
+        valid = np.logical_and.reduce([v for _, v in ids]) if len(ids) > 0 else np.ones(len(df), dtype=bool)
+        if not valid.all():
+            log.warning("Ignoring {} accepted events with NaN ids".format((~valid).sum()))
+        df = pd.DataFrame({k: values[valid] for k, (values, _) in zip(id_keys, ids)})
+
+        offsets, bits = [], []
+        for k in id_keys:
+            values = df[k].values
+            low = values.min() if len(values) > 0 else 0
+            high = values.max() if len(values) > 0 else 0
+            offsets.append(low)
+            bits.append(int(high - low).bit_length())
+
+        if sum(bits) > 63:
+            raise ValueError(
+                "The ranges of the id keys {} need {} bits, at most 63 fit into an int64 key".format(
+                    id_keys, sum(bits)
+                )
+            )
+
+        accepted = cls(id_keys, offsets, bits, [])
+        keys, _ = accepted.encode(df)
+        return cls(id_keys, offsets, bits, np.unique(keys))
+
+    def encode(self, df):
+        """
+        Pack the id keys of df into int64 keys, returns the keys and a mask
+        of rows whose keys are valid and inside the ranges of the set
+        """
+        n_rows = len(df[self.id_keys[0]])
+        keys = np.zeros(n_rows, dtype=np.int64)
+        in_range = np.ones(n_rows, dtype=bool)
+        for k, offset, bits in zip(self.id_keys, self.offsets, self.bits):
+            values, valid = _idValues(df, k)
+            values = values - offset
+            in_range &= valid & (values >= 0) & (values < (1 << bits))
+            keys = (keys << bits) | np.where(in_range, values, 0)
+        return keys, in_range
+
+    def contains(self, df):
+        """
+        Boolean mask of the rows of df (a data frame or dict of columns)
+        that are accepted
+        """
+        keys, in_range = self.encode(df)
+        if self._index is None:
+            self._index = pd.Index(self.keys)
+        return in_range & (self._index.get_indexer(keys) >= 0)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def save(self, path):
+        np.savez(
+            path,
+            id_keys=np.array(self.id_keys),
+            offsets=self.offsets,
+            bits=self.bits,
+            keys=self.keys,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["id_keys"].tolist(), f["offsets"], f["bits"], f["keys"])
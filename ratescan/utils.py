@@ -2,25 +2,177 @@ from fact.factdb import RunInfo
 from fact.factdb.utils import read_into_dataframe
 from peewee import SQL, fn
 import pandas as pd
+import numpy as np
 from random import randint
 from time import sleep
 
+from .container import Ratescan, factorize_keys, integer_counts
+
+class RatescanAccumulator:
+    """
+    Sum up ratescan counts per run and threshold chunk by chunk.
+
+    The sums are kept in a dense matrix with one row per run (factorized
+    group keys) and one column per threshold, so each chunk is added with a
+    single bincount instead of a groupby. result() returns the same frame
+    as sumupCountsOfRun on the concatenation of all chunks. Like a groupby,
+    rows with a NaN group key or threshold are left out.
+    """
+
+    def __init__(
+            self,
+            group_keys=["night", "run_id"],
+            counts_key="ratescan_trigger_counts",
+            thresholds_key="ratescan_trigger_thresholds",
+    ):
+        self.group_keys = list(group_keys)
+        self.counts_key = counts_key
+        self.thresholds_key = thresholds_key
+
+        self.runs = dict()
+        self.thresholds = None
+        self.counts = np.zeros((0, 0), dtype=np.int64)
+        self.present = np.zeros((0, 0), dtype=bool)
+        self.n_events = np.zeros(0, dtype=np.int64)
+        self.has_zero_threshold = np.zeros(0, dtype=bool)
+
+    def _run_indices(self, df):
+        columns = [np.asarray(df[k]) for k in self.group_keys]
+        codes, first = factorize_keys(columns)
+        n_uniques = len(first)
+        uniques = zip(*[c[first] for c in columns])
+
+        run_map = np.empty(n_uniques, dtype=np.int64)
+        for i, key in enumerate(uniques):
+            if key not in self.runs:
+                self.runs[key] = len(self.runs)
+            run_map[i] = self.runs[key]
+
+        n_runs = len(self.runs)
+        if n_runs > self.counts.shape[0]:
+            n_new = max(n_runs, 2 * self.counts.shape[0]) - self.counts.shape[0]
+            n_thresholds = self.counts.shape[1]
+            self.counts = np.vstack([self.counts, np.zeros((n_new, n_thresholds), dtype=np.int64)])
+            self.present = np.vstack([self.present, np.zeros((n_new, n_thresholds), dtype=bool)])
+            self.n_events = np.concatenate([self.n_events, np.zeros(n_new, dtype=np.int64)])
+            self.has_zero_threshold = np.concatenate([self.has_zero_threshold, np.zeros(n_new, dtype=bool)])
+
+        return codes, run_map
+
+    def _threshold_indices(self, thresholds):
+        codes, uniques = pd.factorize(thresholds)
+        order = np.argsort(uniques)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        codes, uniques = rank[codes], uniques[order]
+
+        if self.thresholds is None:
+            self.thresholds = uniques[:0]
+
+        axis = np.union1d(self.thresholds, uniques)
+        if len(axis) != len(self.thresholds):
+            columns = np.searchsorted(axis, self.thresholds)
+            counts = np.zeros((self.counts.shape[0], len(axis)), dtype=np.int64)
+            counts[:, columns] = self.counts
+            present = np.zeros((self.counts.shape[0], len(axis)), dtype=bool)
+            present[:, columns] = self.present
+            self.counts, self.present, self.thresholds = counts, present, axis
+
+        return codes, np.searchsorted(axis, uniques)
+
+    def add(self, df):
+        valid = df[self.group_keys + [self.thresholds_key]].notna().all(axis=1).values
+        if not valid.all():
+            df = df[valid]
+        if len(df) == 0:
+            return
+
+        run_codes, run_map = self._run_indices(df)
+        thresholds = df[self.thresholds_key].values
+        threshold_codes, threshold_map = self._threshold_indices(thresholds)
+
+        n_runs, n_thresholds = len(run_map), len(threshold_map)
+        flat = run_codes * n_thresholds + threshold_codes
+
+        # sum in int64, a float bincount is not exact for large sums
+        summed = np.zeros(n_runs * n_thresholds, dtype=np.int64)
+        np.add.at(summed, flat, integer_counts(df[self.counts_key].values))
+        seen = np.bincount(flat, minlength=n_runs * n_thresholds) > 0
+
+        cells = np.ix_(run_map, threshold_map)
+        self.counts[cells] += summed.reshape(n_runs, n_thresholds)
+        self.present[cells] |= seen.reshape(n_runs, n_thresholds)
+
+        is_zero = thresholds == 0
+        self.n_events[run_map] += np.bincount(run_codes[is_zero], minlength=n_runs)
+        self.has_zero_threshold[run_map] |= np.bincount(run_codes[is_zero], minlength=n_runs) > 0
+
+    def add_ratescan(self, ratescan):
+        valid = np.logical_and.reduce([pd.notna(ratescan.events[k]) for k in self.group_keys])
+        if not valid.all():
+            ratescan = ratescan.select(valid)
+        if ratescan.n_events == 0:
+            return
+
+        run_codes, run_map = self._run_indices(ratescan.events)
+        threshold_codes, threshold_map = self._threshold_indices(ratescan.thresholds)
+
+        order = np.argsort(run_codes, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(run_codes[order]) != 0])
+        runs = run_codes[order][starts]
+
+        summed = np.add.reduceat(ratescan.counts[order].astype(np.int64), starts, axis=0)
+        n_events = np.diff(np.r_[starts, len(order)])
+
+        cells = np.ix_(run_map[runs], threshold_map[threshold_codes])
+        self.counts[cells] += summed
+        if ratescan.present is None:
+            self.present[cells] = True
+        else:
+            self.present[cells] |= np.logical_or.reduceat(ratescan.present[order], starts, axis=0)
+
+        if (ratescan.thresholds == 0).any():
+            self.n_events[run_map[runs]] += n_events
+            self.has_zero_threshold[run_map[runs]] = True
+
+    def result(self):
+        n_runs = len(self.runs)
+        keys = list(self.runs.keys())
+        key_columns = [np.array([key[i] for key in keys]) for i in range(len(self.group_keys))]
+
+        order = np.lexsort(key_columns[::-1]) if n_runs > 0 else np.zeros(0, dtype=np.int64)
+        rows, columns = np.nonzero(self.present[:n_runs][order])
+        runs = order[rows]
+
+        df = pd.DataFrame({k: c[runs] for k, c in zip(self.group_keys, key_columns)})
+        df[self.thresholds_key] = self.thresholds[columns] if self.thresholds is not None else []
+        df[self.counts_key] = self.counts[runs, columns]
+
+        n_events = self.n_events[runs]
+        if self.has_zero_threshold[runs].all():
+            df['n_events_per_run'] = n_events
+        else:
+            df['n_events_per_run'] = np.where(self.has_zero_threshold[runs], n_events, np.nan)
+
+        return df
+
+
 def sumupCountsOfRun(
         df,
         group_keys=["night", "run_id"],
         counts_key="ratescan_trigger_counts",
         thresholds_key="ratescan_trigger_thresholds"
 ):
-    
-    df_summed = df[[counts_key, thresholds_key, *group_keys]].groupby(group_keys+[thresholds_key]).sum()
-    df_summed = df_summed.reset_index()
-
-    df_zero = df[df[thresholds_key] == 0][[counts_key, *group_keys]]
-    df_size = df_zero[[counts_key, *group_keys]].groupby(group_keys).size()
-    df_size = df_size.to_frame(name='n_events_per_run')
-    df_size = df_size.reset_index()
-
-    return pd.merge(df_summed, df_size, how='left', on=group_keys, suffixes=['', '_nevents'])
+    """
+    Sum up the counts per run and threshold, df is either a data frame in
+    long format or a Ratescan
+    """
+    accumulator = RatescanAccumulator(group_keys=group_keys, counts_key=counts_key, thresholds_key=thresholds_key)
+    if isinstance(df, Ratescan):
+        accumulator.add_ratescan(df)
+    else:
+        accumulator.add(df)
+    return accumulator.result()
 
 
 def compileRatescanForRun(
@@ -46,23 +198,32 @@ def append_current_at_start_from_run_db(df,
                                         night_key="night",
                                         run_id_key="run_id",
                                         current_key='current_at_start',
+                                        run_db_cache=None,
                                         ):
-    query = (
-        RunInfo.select(
-            RunInfo.fnight.alias('night'),
-            RunInfo.frunid.alias('run_id'),
-            RunInfo.fcurrentsmedmeanbeg.alias(current_key)
+    """
+    Join the median current at the start of each run from the run database,
+    looked up in the local snapshot if a RunInfoCache is given
+    """
+    if run_db_cache is not None:
+        df_run_db = run_db_cache.lookup(df[night_key], df[run_id_key], columns=['current_at_start'])
+        df_run_db = df_run_db.rename(columns={'current_at_start': current_key})
+    else:
+        query = (
+            RunInfo.select(
+                RunInfo.fnight.alias('night'),
+                RunInfo.frunid.alias('run_id'),
+                RunInfo.fcurrentsmedmeanbeg.alias(current_key)
+            )
+                .where(RunInfo.fnight >= df[night_key].min())
+                .where(RunInfo.fnight <= df[night_key].max())
+                .where(RunInfo.frunid >= df[run_id_key].min())
+                .where(RunInfo.frunid <= df[run_id_key].max())
         )
-            .where(RunInfo.fnight >= df[night_key].min())
-            .where(RunInfo.fnight <= df[night_key].max())
-            .where(RunInfo.frunid >= df[run_id_key].min())
-            .where(RunInfo.frunid <= df[run_id_key].max())
-    )
 
-    # This necessary so the FACT DB does not go bananas
-    sleep(randint(10, 5 * 60))
+        # This necessary so the FACT DB does not go bananas
+        sleep(randint(10, 5 * 60))
 
-    df_run_db = read_into_dataframe(query)
+        df_run_db = read_into_dataframe(query)
 
     return pd.merge(df, df_run_db, how='left', left_on=[night_key, run_id_key], right_on=['night', 'run_id'],
                     suffixes=('', '_run_info'))
@@ -71,7 +232,16 @@ def append_current_at_start_from_run_db(df,
 def joinOnTimesFromRunDB(df,
                         night_key="night", 
                         run_id_key="run_id",
+                        run_db_cache=None,
                         ):
+    """
+    Join the ontime of each run from the run database, looked up in the
+    local snapshot if a RunInfoCache is given
+    """
+    if run_db_cache is not None:
+        df_run_db = run_db_cache.lookup(df[night_key], df[run_id_key], columns=['ontime'])
+        return pd.merge(df, df_run_db, how='left', left_on=[night_key, run_id_key], right_on=['night', 'run_id'])
+
     query = (
         RunInfo.select(
             RunInfo.fnight.alias('night'),
@@ -103,16 +273,43 @@ def sumUpAndConvertToRates(
                         counts_key="ratescan_trigger_counts", 
                         thresholds_key="ratescan_trigger_thresholds",
                         rates_key="ratescan_trigger_rates",
-                        normalize=False
+                        normalize=False,
+                        run_db_cache=None,
                         ):
                         
     df_result = sumupCountsOfRun(df, group_keys=[night_key, run_id_key],
                                  thresholds_key=thresholds_key, counts_key=counts_key)
 
+    return convertToRates(
+                        df_result,
+                        night_key=night_key,
+                        run_id_key=run_id_key,
+                        counts_key=counts_key,
+                        rates_key=rates_key,
+                        normalize=normalize,
+                        run_db_cache=run_db_cache,
+                        )
+
+
+def convertToRates(
+                        df_result,
+                        night_key="night",
+                        run_id_key="run_id",
+                        counts_key="ratescan_trigger_counts",
+                        rates_key="ratescan_trigger_rates",
+                        normalize=False,
+                        run_db_cache=None,
+                        ):
+    """
+    Convert counts summed per run and threshold, e.g. the result of a
+    RatescanAccumulator, to rates with the ontime from the run database or
+    normalized by the number of events
+    """
     df_result = joinOnTimesFromRunDB(
                         df_result,
                         night_key=night_key, 
                         run_id_key=run_id_key,
+                        run_db_cache=run_db_cache,
                         )
     
     df_result[rates_key] = df_result[counts_key]
@@ -35,6 +35,10 @@ setup(
             'ratescan_concat_runs = ratescan.executables.concatRatescans:main',
             'ratescan_determine_sw_trigger_event_list = ratescan.executables.determine_sw_trigger_event_list:main',
             'ratescan_applyTrigger = ratescan.executables.applyTrigger:main',
+            'ratescan_fill_run_db_snapshot = ratescan.executables.fillRunDBSnapshot:main',
+            'ratescan_build_event_summary = ratescan.executables.buildEventSummary:main',
+            'ratescan_benchmark_compression = ratescan.executables.benchmarkCompression:main',
+            'ratescan_ingest_season = ratescan.executables.ingestSeason:main',
         ],
     }
 )
\ No newline at end of file
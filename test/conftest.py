@@ -0,0 +1,24 @@
+import os
+import pytest
+
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def test_hdf5():
+    '''
+    The tests read the ratescans of test/test.json.gz from test/test.hdf5,
+    convert them once if the file does not exist yet
+    '''
+    from fact.io import write_data
+    from ratescan.io import readJsonLtoDf
+
+    path = os.path.join(test_dir, "test.hdf5")
+    if not os.path.exists(path):
+        df = readJsonLtoDf(
+            os.path.join(test_dir, "test.json.gz"),
+            default_keys_to_store=["event_num", "night", "run_id", "ratescan_trigger_counts", "ratescan_trigger_thresholds"],
+        )
+        write_data(df, path, key="ratescan", mode="w")
+    return path
@@ -0,0 +1,79 @@
+from fact.io import read_data
+import numpy as np
+import pandas as pd
+
+
+def test_FitCache_eviction(tmpdir):
+    from ratescan.cache import FitCache
+
+    with FitCache(str(tmpdir.join("fits.sqlite")), max_size=300) as cache:
+        for i in range(10):
+            cache["key_{}".format(i)] = {"setThreshold": np.float64(i), "failed": None}
+        assert "key_9" in cache
+        assert "key_0" not in cache
+        assert cache.size <= 300
+        assert cache["key_9"]["setThreshold"] == 9
+
+
+def test_cachedFits(tmpdir):
+    from ratescan.cache import FitCache, cachedFits
+    from ratescan.fitting import findTriggerSetThresholds
+    from ratescan.utils import compileRatescanForRun
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df = compileRatescanForRun(df, ontime=160)
+    df_other_run = df.copy()
+    df_other_run["run_id"] += 1
+
+    n_fitted = []
+
+    def fit(df_missing):
+        n_fitted.append(df_missing.groupby(["night", "run_id"]).ngroups)
+        return findTriggerSetThresholds(df_missing)
+
+    path = str(tmpdir.join("fits.sqlite"))
+    with FitCache(path) as cache:
+        first = cachedFits(df, fit, cache, max_threshold=5000)
+    with FitCache(path) as cache:
+        second = cachedFits(pd.concat([df, df_other_run]), fit, cache, max_threshold=5000)
+
+    # identical ratescans share one entry, no second fit needed
+    assert n_fitted == [1]
+    assert len(second) == 2
+    assert sorted(second["run_id"]) == [182, 183]
+    assert np.allclose(second["setThreshold"], first["setThreshold"][0])
+
+
+def test_run_fit_cache_key(tmpdir, monkeypatch):
+    import ratescan.executables.extractFeaturesPerRun as extract
+    from ratescan.cache import FitCache
+
+    run_db_table = pd.DataFrame(
+        {"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]}
+    )
+    fit_cache = str(tmpdir.join("fits.sqlite"))
+    key_dict = dict(extract.default_key_dict, run_db_table=run_db_table, fit_cache=fit_cache, fit_engine="batched")
+
+    n_fitted = []
+    fit = extract.fitRatescansBatched
+
+    def counting_fit(df, **kwargs):
+        n_fitted.append(1)
+        return fit(df, **kwargs)
+
+    monkeypatch.setattr(extract, "fitRatescansBatched", counting_fit)
+
+    first = extract.run("test/test.hdf5", key_dict=key_dict)
+    extract.run("test/test.hdf5", key_dict=key_dict)
+    assert len(n_fitted) == 1
+
+    # a new version of the fit code or other fit arguments do not use the
+    # cached fits
+    monkeypatch.setattr(extract, "fit_version", extract.fit_version + 1)
+    extract.run("test/test.hdf5", key_dict=key_dict)
+    extract.run("test/test.hdf5", key_dict=dict(key_dict, fit_method="weighted"))
+    assert len(n_fitted) == 3
+
+    with FitCache(fit_cache) as cache:
+        assert len(cache) == 3
+    assert round(first["setThreshold"].values[0], 1) == 500.9
@@ -0,0 +1,75 @@
+from fact.io import read_data
+import pandas as pd
+
+
+def test_Ratescan_from_dataframe():
+    from ratescan.container import Ratescan
+
+    df = read_data("test/test.hdf5", key="ratescan")
+
+    ratescan = Ratescan.from_dataframe(df)
+
+    assert ratescan.counts.shape == (474, 1000)
+    assert ratescan.counts.dtype == "uint16"
+    assert ratescan.nbytes < df.memory_usage().sum()
+
+    df_long = ratescan.to_dataframe()
+    df_long = df_long[df_long["ratescan_trigger_counts"] > 0]
+    df_merged = pd.merge(
+        df[df["ratescan_trigger_counts"] > 0], df_long,
+        on=["night", "run_id", "event_num", "ratescan_trigger_thresholds"],
+    )
+    assert len(df_merged) == len(df_long)
+    assert (df_merged["ratescan_trigger_counts_x"] == df_merged["ratescan_trigger_counts_y"]).all()
+
+
+def test_readJsonLtoRatescan():
+    from ratescan.io import readJsonLtoRatescan
+    from ratescan.utils import sumupCountsOfRun
+    from ratescan.features import maxPossibleThreshold2Keep
+
+    ratescan = readJsonLtoRatescan("test/test.json.gz")
+    df = read_data("test/test.hdf5", key="ratescan")
+
+    assert len(ratescan) == 474
+    pd.testing.assert_frame_equal(maxPossibleThreshold2Keep(ratescan), maxPossibleThreshold2Keep(df))
+    pd.testing.assert_frame_equal(sumupCountsOfRun(ratescan), sumupCountsOfRun(df))
+
+
+def test_Ratescan_ragged():
+    from ratescan.container import Ratescan
+    from ratescan.utils import sumupCountsOfRun
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    # the scans of run 183 stop at a lower threshold than those of run 182
+    df = pd.concat([df, df[df.ratescan_trigger_thresholds < 100].assign(run_id=183)], ignore_index=True)
+
+    ratescan = Ratescan.from_dataframe(df)
+    assert ratescan.present is not None
+
+    df_long = ratescan.to_dataframe()
+    assert len(df_long) == len(df)
+
+    df_summed = sumupCountsOfRun(ratescan)
+    pd.testing.assert_frame_equal(df_summed, sumupCountsOfRun(df))
+    assert (df_summed[df_summed.run_id == 183].ratescan_trigger_thresholds < 100).all()
+
+    df_selected = sumupCountsOfRun(ratescan.select(ratescan.events["run_id"] == 183))
+    pd.testing.assert_frame_equal(df_selected, df_summed[df_summed.run_id == 183].reset_index(drop=True))
+
+
+def test_Ratescan_nan_counts():
+    import numpy as np
+    import warnings
+    from ratescan.container import Ratescan
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df["ratescan_trigger_counts"] = df["ratescan_trigger_counts"].astype(float)
+    df.loc[0, "ratescan_trigger_counts"] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        ratescan = Ratescan.from_dataframe(df)
+
+    assert ratescan.counts.dtype == "uint16"
+    assert ratescan.counts.sum() == df["ratescan_trigger_counts"].sum()
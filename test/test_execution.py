@@ -0,0 +1,8 @@
+def test_process_jobs_pool():
+    from ratescan.execution import Job, process_jobs
+
+    jobs = [Job(pow, [2, n], name="{}_pow".format(n), size=n) for n in range(5)]
+
+    outputs = process_jobs(jobs, backend="pool", max_workers=2)
+
+    assert sorted(outputs) == [1, 2, 4, 8, 16]
@@ -1,12 +1,101 @@
-# from fact.io import read_data
-# 
-# def test_run():
-#     from ratescan.executables.extractFeaturesPerRun import run, default_key_dict
-# 
-#     infile_path = "test/test.hdf5"
-#     outkey="ratescan"
-# 
-#     df = run(
-#             infile_path, 
-#             key_dict=default_key_dict, 
-#             )
+from fact.io import read_data
+import pandas as pd
+
+
+def test_run(tmpdir):
+    from ratescan.executables.extractFeaturesPerRun import run, default_key_dict
+    from ratescan.rundb import RunInfoCache
+
+    snapshot = str(tmpdir.join("run_db.sqlite"))
+    with RunInfoCache(snapshot) as run_db:
+        run_db.insert(pd.DataFrame(
+            {"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]}
+        ))
+
+    infile_path = "test/test.hdf5"
+
+    df = run(
+            infile_path, 
+            key_dict=dict(default_key_dict, run_db_snapshot=snapshot, run_db_offline=True), 
+            )
+
+    assert len(df) == 1
+    assert df["ratescan_trigger_thresholds"].values == 490
+    assert round(df["setThreshold"].values[0], 1) == 500.9
+
+
+def test_main_run_db_prefetch(tmpdir):
+    from click.testing import CliRunner
+    from ratescan.executables.extractFeaturesPerRun import main
+    from ratescan.rundb import RunInfoCache
+
+    snapshot = str(tmpdir.join("run_db.sqlite"))
+    with RunInfoCache(snapshot) as run_db:
+        run_db.insert(pd.DataFrame(
+            {"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]}
+        ))
+
+    outfile = str(tmpdir.join("features.hdf5"))
+    result = CliRunner().invoke(main, [
+        "test/test.hdf5", outfile,
+        "--backend", "pool", "--max_workers", "1",
+        "--run_db_snapshot", snapshot, "--run_db_offline", "--run_db_prefetch",
+    ])
+    assert result.exit_code == 0, result.output
+
+    df = read_data(outfile, key="ratescan")
+    assert len(df) == 1
+    assert round(df["setThreshold"].values[0], 1) == 500.9
+
+
+def test_run_column_store(tmpdir):
+    from ratescan.executables.extractFeaturesPerRun import run, default_key_dict
+    from ratescan.io import writeColumnStore
+    from ratescan.rundb import RunInfoTable
+
+    infile_path = str(tmpdir.join("test.columns"))
+    writeColumnStore(read_data("test/test.hdf5", key="ratescan"), infile_path)
+    run_db_table = pd.DataFrame(
+        {"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]}
+    )
+
+    df = run(infile_path, key_dict=dict(default_key_dict, run_db_table=run_db_table))
+
+    assert len(df) == 1
+    assert round(df["setThreshold"].values[0], 1) == 500.9
+
+def test_extractRatescansPerRun_chunk_rows():
+    from ratescan.executables.extractRatescansPerRun import run, default_key_dict
+    from ratescan.io import nRows
+
+    assert nRows("test/test.hdf5", key="ratescan") == 88375
+
+    run_db_table = pd.DataFrame(
+        {"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]}
+    )
+    key_dict = dict(default_key_dict, run_db_table=run_db_table)
+
+    for infile_path in ["test/test.hdf5", "test/test.json.gz"]:
+        df = run(infile_path, key_dict=key_dict)
+        df_chunked = run(infile_path, key_dict=dict(key_dict, chunk_rows=10000))
+
+        assert len(df_chunked) == 1000
+        pd.testing.assert_frame_equal(
+            df_chunked[df.columns].reset_index(drop=True), df.reset_index(drop=True), check_dtype=False
+        )
+
+
+def test_run_fit_method_weighted():
+    from ratescan.executables.extractFeaturesPerRun import run, default_key_dict
+
+    run_db_table = pd.DataFrame(
+        {"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]}
+    )
+    key_dict = dict(default_key_dict, run_db_table=run_db_table, fit_method="weighted")
+
+    df_batched = run("test/test.hdf5", key_dict=dict(key_dict, fit_engine="batched"))
+    df_serial = run("test/test.hdf5", key_dict=dict(key_dict, fit_engine="serial"))
+
+    assert len(df_batched) == 1
+    assert round(df_batched["setThreshold"].values[0], 1) == 435.3
+    assert round(df_serial["setThreshold"].values[0], 1) == 435.3
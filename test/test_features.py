@@ -11,6 +11,21 @@ def test_maxPossibleThreshold2Keep():
     assert df_thresholds["ratescan_trigger_thresholds"].values == 490
     assert len(df_thresholds["ratescan_trigger_thresholds"]) == 1
     # from IPython import embed; embed()
+
+
+def test_maxPossibleThreshold2Keep_n_primitives():
+    from ratescan.features import maxPossibleThreshold2Keep
+    
+    df = read_data("test/test.hdf5", key="ratescan")
+    
+    df_thresholds = maxPossibleThreshold2Keep(df, n_primitives=[1, 2])
+
+    assert len(df_thresholds) == 1
+    assert df_thresholds["max_possible_threshold_to_keep_1"].values == 490
+    assert (
+        df_thresholds["max_possible_threshold_to_keep_2"].values
+        == maxPossibleThreshold2Keep(df, n_primitives=2)["ratescan_trigger_thresholds"].values
+    )
     
     
 def test_findTriggerSetThreshold():
@@ -0,0 +1,102 @@
+from fact.io import read_data
+import numpy as np
+import pandas as pd
+
+
+def test_levenbergMarquardt():
+    from ratescan.fitting import levenbergMarquardt
+    from ratescan.models import nsbContribution, nsbContributionJacobian
+
+    x = np.tile(np.linspace(100, 600, 50), (3, 1))
+    p_true = np.array([[-2e-2, 700], [-1e-2, 650], [-3e-2, 720]])
+    y = nsbContribution(x, p_true[:, :1], p_true[:, 1:])
+    weights = np.ones_like(x)
+    weights[2, 40:] = 0
+
+    popt, pcov, ok = levenbergMarquardt(
+        nsbContribution, nsbContributionJacobian, x, y, weights, np.tile([-2.18757227e-2, 6.94879358e2], (3, 1))
+    )
+
+    assert ok.all()
+    assert np.allclose(popt, p_true)
+    assert pcov.shape == (3, 2, 2)
+
+
+def test_findTriggerSetThresholds():
+    from ratescan.features import findTriggerSetThreshold
+    from ratescan.fitting import findTriggerSetThresholds
+    from ratescan.utils import compileRatescanForRun
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df = compileRatescanForRun(df, ontime=160)
+
+    df_other_run = df.copy()
+    df_other_run["run_id"] += 1
+    df_other_run["ratescan_trigger_rate"] *= 2
+
+    df_fits = findTriggerSetThresholds(pd.concat([df, df_other_run]), max_threshold=5000)
+
+    assert len(df_fits) == 2
+    s_serial = findTriggerSetThreshold(df, max_threshold=5000)
+    s_batched = df_fits.iloc[0]
+    assert np.around(s_batched["setThreshold"], 1) == 500.9
+    for key in s_serial.index:
+        rtol = 1e-2 if "_cov_" in key else 1e-3
+        assert np.isclose(s_batched[key], s_serial[key], rtol=rtol), key
+
+
+def test_setThresholdRoots():
+    from scipy.optimize import brentq
+    from ratescan.fitting import setThresholdRoots, setThresholdsForScales, setThresholdScaleName
+    from ratescan.models import powerLaw, nsbContribution
+
+    full_opt = np.array([
+        [3e9, -3, 3.7e2, -2.2e-2, 690],
+        [1e9, -2.7, 1e2, -1.8e-2, 720],
+        [-1, -1, -1, -1, -1],
+    ])
+    scales = np.array([0.5, 1, 2])
+
+    roots = setThresholdRoots(full_opt, [370, 400, 370], scale=scales)
+
+    assert roots.shape == (3, 3)
+    assert np.isnan(roots[2]).all()
+    for i in range(2):
+        for j, scale in enumerate(scales):
+            f = lambda t: powerLaw(t, *full_opt[i, :3])/(np.e*scale) - nsbContribution(t, *full_opt[i, 3:])
+            assert np.isclose(roots[i, j], brentq(f, 100, 2000), rtol=1e-10)
+
+    df_scales = setThresholdsForScales(
+        pd.DataFrame({"full_par_{}".format(i): full_opt[:2, i] for i in range(5)}), [1, 2]
+    )
+    assert np.allclose(df_scales[setThresholdScaleName(2)], roots[:2, 2])
+
+
+def test_findTriggerSetThresholds_weighted():
+    from ratescan.features import findTriggerSetThreshold
+    from ratescan.fitting import findTriggerSetThresholds
+    from ratescan.utils import compileRatescanForRun
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df = compileRatescanForRun(df, ontime=160)
+
+    # same counts with twice the rate, the weights and the set threshold
+    # do not change
+    df_other_run = df.copy()
+    df_other_run["run_id"] += 1
+    df_other_run["ratescan_trigger_rate"] *= 2
+
+    df_fits = findTriggerSetThresholds(pd.concat([df, df_other_run]), method="weighted")
+
+    assert len(df_fits) == 2
+    assert "shower_par_0" not in df_fits.columns
+    assert np.allclose(df_fits["setThreshold"], df_fits["setThreshold"][0])
+    # the offset of the power law is at its bound
+    assert (df_fits["full_par_2"] >= 0).all()
+
+    s_serial = findTriggerSetThreshold(df, method="weighted")
+    assert np.around(s_serial["setThreshold"], 1) == 435.3
+    for i in range(5):
+        key = "full_par_{}".format(i)
+        assert np.isclose(df_fits[key][0], s_serial[key], rtol=1e-3, atol=1e-6), key
+    assert np.isclose(df_fits["setThreshold"][0], s_serial["setThreshold"], rtol=1e-6)
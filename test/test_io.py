@@ -0,0 +1,271 @@
+import pandas as pd
+
+keys = [
+    "event_num",
+    "run_id",
+    "night",
+    "ratescan_trigger_counts",
+    "ratescan_trigger_thresholds",
+]
+
+
+def test_readJsonLtoDf():
+    from ratescan.io import readJsonLtoDf
+
+    df = readJsonLtoDf("test/test.json.gz", default_keys_to_store=keys)
+
+    assert list(df.columns) == keys
+    assert len(df) == 88375
+    assert df.event_num.nunique() == 474
+    assert df.run_id.unique() == 182
+
+
+def test_iterJsonLBatches():
+    from ratescan.io import readJsonLtoDf, iterJsonLBatches
+
+    batches = list(iterJsonLBatches("test/test.json.gz", default_keys_to_store=keys, batch_size=10000))
+
+    assert all(len(df) == 10000 for df in batches[:-1])
+    df = pd.concat(batches, ignore_index=True)
+    assert df.equals(readJsonLtoDf("test/test.json.gz", default_keys_to_store=keys))
+
+
+def test_readJsonLtoDf_workers():
+    from ratescan.io import readJsonLtoDf
+
+    df = readJsonLtoDf("test/test.json.gz", default_keys_to_store=keys)
+    df_parallel = readJsonLtoDf("test/test.json.gz", default_keys_to_store=keys, workers=2)
+
+    assert df_parallel.equals(df)
+
+
+def test_HDF5Writer(tmpdir):
+    from ratescan.io import readJsonLtoDf, HDF5Writer
+    from fact.io import read_data
+
+    df = readJsonLtoDf("test/test.json.gz", default_keys_to_store=keys)
+    outfile = str(tmpdir.join("writer.hdf5"))
+
+    with HDF5Writer(outfile, key="ratescan", capacity=1000) as writer:
+        for start in range(0, len(df), 30000):
+            writer.append(df.iloc[start:start + 30000])
+
+    df_written = read_data(outfile, key="ratescan")
+
+    assert len(df_written) == len(df)
+    for key in keys:
+        assert (df_written[key].values == df[key].values).all()
+
+
+def test_HDF5Writer_promote(tmpdir):
+    import numpy as np
+    import pytest
+    from ratescan.io import HDF5Writer
+    from fact.io import read_data
+
+    outfile = str(tmpdir.join("promote.hdf5"))
+    with HDF5Writer(outfile, key="data") as writer:
+        writer.append(pd.DataFrame(dict(a=[1, 2], b=[1.0, 2.0])))
+        writer.append(pd.DataFrame(dict(a=[1.5, np.nan], b=[3, 4])))
+        with pytest.raises(TypeError):
+            writer.append(pd.DataFrame(dict(a=["x"], b=[5.0])))
+
+    df = read_data(outfile, key="data")
+    assert df["a"].dtype == np.float64
+    assert np.array_equal(df["a"].values, [1, 2, 1.5, np.nan], equal_nan=True)
+    assert np.array_equal(df["b"].values, [1, 2, 3, 4])
+
+
+def test_HDF5Writer_empty(tmpdir):
+    from ratescan.io import HDF5Writer
+    from fact.io import read_data
+
+    outfile = str(tmpdir.join("capacity.hdf5"))
+    with HDF5Writer(outfile, key="data", capacity=0) as writer:
+        writer.append(pd.DataFrame(dict(a=[1, 2, 3, 4, 5])))
+    assert read_data(outfile, key="data")["a"].tolist() == [1, 2, 3, 4, 5]
+
+    # only empty data frames give empty datasets
+    outfile = str(tmpdir.join("empty.hdf5"))
+    with HDF5Writer(outfile, key="data", capacity=0) as writer:
+        writer.append(pd.DataFrame(dict(a=[], b=[])))
+    df = read_data(outfile, key="data")
+    assert len(df) == 0
+    assert sorted(df.columns) == ["a", "b"]
+
+
+def test_readRunKeys():
+    from ratescan.io import readRunKeys
+
+    for path in ["test/test.json.gz", "test/test.hdf5"]:
+        df = readRunKeys(path)
+        assert list(df.columns) == ["night", "run_id"]
+        assert df.values.tolist() == [[20150901, 182]]
+
+
+def test_columnStore(tmpdir):
+    from fact.io import read_data
+    from ratescan.io import isColumnStore, writeColumnStore, loadColumnStore, readColumnStore, readRunKeys
+    import numpy as np
+    import os
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df["infile_path"] = "test/test.hdf5"
+    path = str(tmpdir.join("test.columns"))
+    assert not isColumnStore(path)
+
+    writeColumnStore(df, path)
+    assert isColumnStore(path)
+
+    columns = loadColumnStore(path, ["run_id", "ratescan_trigger_thresholds"])
+    assert isinstance(columns["run_id"], np.memmap)
+    assert (columns["ratescan_trigger_thresholds"] == df["ratescan_trigger_thresholds"].values).all()
+
+    df_read = readColumnStore(path)
+    assert list(df_read.columns) == list(df.columns)
+    for key in keys + ["infile_path"]:
+        assert (df_read[key].values == df[key].values).all()
+
+    assert readRunKeys(path).values.tolist() == [[20150901, 182]]
+
+    # overwriting with fewer columns leaves no stale column files
+    writeColumnStore(df[["night", "run_id"]], path)
+    assert sorted(os.listdir(path)) == ["000.npy", "001.npy", "manifest.json"]
+    assert list(readColumnStore(path).columns) == ["night", "run_id"]
+
+
+def test_compressionProfiles(tmpdir):
+    from fact.io import read_data
+    from ratescan.io import HDF5Writer, compressionProfiles, compressionOptions
+    import h5py
+    import pytest
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df["infile_path"] = "test/test.hdf5"
+
+    for profile in compressionProfiles():
+        path = str(tmpdir.join("{}.hdf5".format(profile)))
+        with HDF5Writer(path, key="ratescan", chunk_rows=1000, **compressionOptions(profile)) as writer:
+            writer.append(df)
+
+        with h5py.File(path, "r") as f:
+            assert f["ratescan/run_id"].chunks == (1000,)
+            compression = compressionOptions(profile).get("compression")
+            # filters of hdf5plugin are given by their id
+            if not isinstance(compression, int):
+                assert f["ratescan/run_id"].compression == compression
+            assert f["ratescan/run_id"].shuffle == compressionOptions(profile).get("shuffle", False)
+
+        df_read = read_data(path, key="ratescan")
+        for key in keys + ["infile_path"]:
+            assert (df_read[key].values == df[key].values).all()
+
+    with pytest.raises(ValueError):
+        compressionOptions("gzip10")
+
+
+def test_benchmarkCompression(tmpdir):
+    from click.testing import CliRunner
+    from ratescan.executables.benchmarkCompression import main
+
+    outfile = str(tmpdir.join("benchmark.csv"))
+    result = CliRunner().invoke(main, [
+        "test/test.hdf5", "--profile", "none", "--profile", "gzip1", "--repeat", "1", "--outfile", outfile,
+    ])
+    assert result.exit_code == 0, result.output
+
+    df = pd.read_csv(outfile)
+    assert df["profile"].tolist() == ["none", "gzip1"]
+    assert df["size"][1] < df["size"][0]
+
+
+def test_readInput(tmpdir):
+    from fact.io import read_data
+    from ratescan.io import readInput, writeColumnStore, nRows
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    store = str(tmpdir.join("test.columns"))
+    writeColumnStore(df, store)
+    pandas_fixed = str(tmpdir.join("fixed.hdf5"))
+    df.to_hdf(pandas_fixed, key="ratescan")
+    pandas_table = str(tmpdir.join("table.hdf5"))
+    df.to_hdf(pandas_table, key="ratescan", format="table")
+
+    for path in ["test/test.hdf5", store, pandas_fixed, pandas_table]:
+        df_read = readInput(path, columns=["run_id", "ratescan_trigger_counts"])
+        assert list(df_read.columns) == ["run_id", "ratescan_trigger_counts"]
+        assert list(readInput(path, columns=["run_id", "not_in_file"]).columns) == ["run_id"]
+        assert nRows(path) == len(df)
+        assert (df_read["ratescan_trigger_counts"].values == df["ratescan_trigger_counts"].values).all()
+
+        df_range = readInput(path, columns=["event_num"], first=100, last=200)
+        assert (df_range["event_num"].values == df["event_num"].values[100:200]).all()
+
+        assert len(readInput(path, columns=["event_num"], runs=[(20150901, 182)])) == len(df)
+        assert len(readInput(path, columns=["event_num"], runs=[(20150901, 183)])) == 0
+
+    df_json = readInput("test/test.json.gz", columns=keys, runs=[(20150901, 182)])
+    assert list(df_json.columns) == keys
+    assert len(df_json) == len(df)
+
+
+def test_runIndex(tmpdir):
+    import h5py
+    from fact.io import read_data, write_data
+    from ratescan.io import readInput, readRunIndex, readRunKeys, writeColumnStore, writeRunIndex
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    # run 182 is split into two ranges
+    df_season = pd.concat([
+        df.iloc[:1000], df.assign(run_id=183), df.iloc[1000:], df.assign(night=20150902, run_id=5),
+    ], ignore_index=True)
+
+    path = str(tmpdir.join("season.hdf5"))
+    write_data(df_season, path, key="ratescan", mode="w")
+    store = str(tmpdir.join("season.columns"))
+    writeColumnStore(df_season, store)
+
+    for p in [path, store]:
+        assert readRunIndex(p) is None
+        expected = readInput(p, columns=keys, runs=[(20150901, 182), (20150902, 5)])
+
+        ranges = writeRunIndex(p)
+        assert ranges[["first", "last"]].values.tolist() == [
+            [0, 1000], [1000, 1000 + len(df)], [1000 + len(df), 2 * len(df)], [2 * len(df), 3 * len(df)],
+        ]
+        assert readRunIndex(p) is not None
+        if p == path:
+            with h5py.File(p, "r") as f:
+                assert list(f.keys()) == ["ratescan"]
+        assert readRunKeys(p).values.tolist() == [[20150901, 182], [20150901, 183], [20150902, 5]]
+
+        df_read = readInput(p, columns=keys, runs=[(20150901, 182), (20150902, 5)])
+        assert df_read.equals(expected)
+        assert len(df_read) == 2 * len(df)
+        assert len(readInput(p, columns=keys, runs=[(20150903, 1)])) == 0
+
+    # appending makes the index outdated
+    write_data(df, path, key="ratescan", mode="a")
+    assert readRunIndex(path) is None
+
+
+def test_readJsonLtoDf_missing_key(tmpdir):
+    import json
+    import numpy as np
+    from ratescan.io import readJsonLtoDf, iterJsonLBatches
+
+    path = str(tmpdir.join("missing.jsonl"))
+    with open(path, "w") as f:
+        f.write(json.dumps(dict(event_num=1, pedestal=[1.5, 2.5], ratescan_trigger_counts=[3, 1])) + "\n")
+        f.write(json.dumps(dict(event_num=2, ratescan_trigger_counts=[2, 0])) + "\n")
+
+    columns = ["event_num", "pedestal", "ratescan_trigger_counts", "not_in_file"]
+    expected = pd.DataFrame(dict(
+        event_num=[1, 1, 2, 2], pedestal=[1.5, 2.5, np.nan, np.nan], ratescan_trigger_counts=[3, 1, 2, 0]
+    ))
+
+    pd.testing.assert_frame_equal(readJsonLtoDf(path, default_keys_to_store=columns), expected)
+    pd.testing.assert_frame_equal(readJsonLtoDf(path, default_keys_to_store=columns, workers=2), expected)
+    pd.testing.assert_frame_equal(
+        pd.concat(iterJsonLBatches(path, default_keys_to_store=columns, batch_size=3), ignore_index=True), expected
+    )
@@ -0,0 +1,31 @@
+import numpy as np
+
+
+def test_jacobians():
+    from ratescan.models import ratescan_func, ratescan_funcJacobian
+
+    t = np.linspace(100, 600, 20)
+    p = np.array([3e5, -1.5, 1.0, -2e-2, 700])
+
+    jac = ratescan_funcJacobian(t, *p)
+    for i in range(len(p)):
+        h = np.zeros_like(p)
+        h[i] = 1e-6 * abs(p[i])
+        numeric = (ratescan_func(t, *(p + h)) - ratescan_func(t, *(p - h))) / (2 * h[i])
+        assert np.allclose(jac[:, i], numeric, rtol=1e-5)
+
+
+def test_initial_guesses():
+    from ratescan.models import (
+        powerLaw, nsbContribution, powerLawInitialGuess, nsbContributionInitialGuess
+    )
+
+    t = np.linspace(100, 600, 50)
+
+    assert np.allclose(nsbContributionInitialGuess(t, nsbContribution(t, -2e-2, 700)), [-2e-2, 700])
+    assert np.allclose(powerLawInitialGuess(t, powerLaw(t, 3e5, -1.5, 0)), [3e5, -1.5, 0], atol=1e-6)
+
+    weights = np.ones((2, len(t)))
+    weights[1, 10:] = 0
+    p0 = nsbContributionInitialGuess(np.tile(t, (2, 1)), nsbContribution(t, -2e-2, 700), weights)
+    assert np.allclose(p0, [[-2e-2, 700], [-2e-2, 700]])
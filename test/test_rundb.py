@@ -0,0 +1,55 @@
+import pandas as pd
+import numpy as np
+
+
+def test_RunInfoCache_offline(tmpdir):
+    from ratescan.rundb import RunInfoCache
+
+    df_runs = pd.DataFrame({
+        "night": [20150901, 20150901, 20150902],
+        "run_id": [182, 183, 5],
+        "ontime": [160.0, 290.5, np.nan],
+        "current_at_start": [5.1, 5.2, 30.0],
+    })
+
+    with RunInfoCache(str(tmpdir.join("run_db.sqlite")), offline=True) as run_db:
+        run_db.insert(df_runs)
+        assert run_db.staleNights([20150901, 20150903]) == [20150903]
+
+        df = run_db.lookup([20150901, 20150901, 20150902, 20150903], [182, 182, 5, 1])
+
+    assert len(df) == 2
+    assert list(df["ontime"].fillna(-1)) == [160.0, -1]
+    assert list(df["current_at_start"]) == [5.1, 30.0]
+
+
+def test_joinOnTimesFromRunDB_snapshot(tmpdir):
+    from fact.io import read_data
+    from ratescan.rundb import RunInfoCache
+    from ratescan.utils import sumUpAndConvertToRates
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df_runs = pd.DataFrame({"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]})
+
+    with RunInfoCache(str(tmpdir.join("run_db.sqlite")), offline=True) as run_db:
+        run_db.insert(df_runs)
+        df_rates = sumUpAndConvertToRates(df, run_db_cache=run_db)
+
+    assert df_rates["ontime"].unique() == 160.0
+    assert df_rates["ratescan_trigger_rates"].max() == 474.0
+
+
+def test_prefetchRunInfo(tmpdir):
+    from ratescan.rundb import RunInfoCache, prefetchRunInfo
+
+    snapshot = str(tmpdir.join("run_db.sqlite"))
+    with RunInfoCache(snapshot) as run_db:
+        run_db.insert(pd.DataFrame(
+            {"night": [20150901, 20150902], "run_id": [182, 182], "ontime": [160.0, 150.0], "current_at_start": [5.1, 5.2]}
+        ))
+
+    key_dict = dict(run_db_snapshot=snapshot, run_db_offline=True)
+    assert prefetchRunInfo([], key_dict) is None
+
+    df = prefetchRunInfo(["test/test.hdf5", "test/test.json.gz"], key_dict)
+    assert df[["night", "run_id", "ontime"]].values.tolist() == [[20150901, 182, 160.0]]
@@ -0,0 +1,59 @@
+from fact.io import read_data, write_data
+import os
+import pandas as pd
+
+
+def test_SeasonStore(tmpdir):
+    from ratescan.season import SeasonStore
+
+    store = SeasonStore(str(tmpdir.join("season")))
+    df = pd.DataFrame({"night": [20150901, 20150901, 20150902], "run_id": [1, 2, 1], "value": [1.0, 2.0, 3.0]})
+    store.write(dict(features=df, ratescans=df.assign(rate=5.0)))
+    assert store.nights() == [20150901, 20150902]
+
+    # run 2 of the first night is replaced in both tables, run 3 is new
+    mtime = os.path.getmtime(store.partitionPath(20150902))
+    df_new = pd.DataFrame({"night": [20150901, 20150901], "run_id": [2, 3], "value": [4.0, 5.0]})
+    store.write(dict(features=df_new.iloc[:1], ratescans=df_new.assign(rate=6.0)))
+    assert os.path.getmtime(store.partitionPath(20150902)) == mtime
+
+    df_features = store.read("features", first_night=20150901, last_night=20150901)
+    assert df_features[["run_id", "value"]].values.tolist() == [[1, 1.0], [2, 4.0]]
+    df_ratescans = store.read("ratescans", columns=["night", "run_id", "rate"])
+    assert df_ratescans.values.tolist() == [[20150901, 1, 5.0], [20150901, 2, 6.0], [20150901, 3, 6.0], [20150902, 1, 5.0]]
+    assert len(store.read("features", first_night=20150903)) == 0
+
+
+def test_ingestSeason(tmpdir):
+    from click.testing import CliRunner
+    from ratescan.executables.ingestSeason import main
+    from ratescan.rundb import RunInfoCache
+    from ratescan.season import SeasonStore
+
+    snapshot = str(tmpdir.join("run_db.sqlite"))
+    with RunInfoCache(snapshot) as run_db:
+        run_db.insert(pd.DataFrame({
+            "night": [20150901, 20150902], "run_id": [182, 182],
+            "ontime": [160.0, 160.0], "current_at_start": [5.1, 5.1],
+        }))
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    infiles = [str(tmpdir.join("a.hdf5")), str(tmpdir.join("b.hdf5"))]
+    write_data(df, infiles[0], key="ratescan", mode="w")
+    write_data(df.assign(night=20150902), infiles[1], key="ratescan", mode="w")
+
+    store = str(tmpdir.join("season"))
+    for files in [infiles[:1], infiles]:
+        result = CliRunner().invoke(main, [
+            *files, store, "--backend", "pool", "--max_workers", "1",
+            "--run_db_snapshot", snapshot, "--run_db_offline",
+        ])
+        assert result.exit_code == 0, result.output
+
+    season_store = SeasonStore(store)
+    assert season_store.nights() == [20150901, 20150902]
+    df_features = season_store.read("features")
+    assert df_features[["night", "run_id"]].values.tolist() == [[20150901, 182], [20150902, 182]]
+    assert (df_features["ratescan_trigger_thresholds"] == 490).all()
+    assert round(df_features["setThreshold"].values[0], 1) == 500.9
+    assert len(season_store.read("ratescans", first_night=20150902)) == 1000
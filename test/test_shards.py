@@ -0,0 +1,85 @@
+from fact.io import read_data, write_data
+import os
+import pandas as pd
+
+
+def make_inputs(tmpdir):
+    df = read_data("test/test.hdf5", key="ratescan")
+    infiles = [str(tmpdir.join("a.hdf5")), str(tmpdir.join("b.hdf5"))]
+    write_data(df, infiles[0], key="ratescan", mode="w")
+    write_data(df.assign(run_id=183), infiles[1], key="ratescan", mode="w")
+    return infiles
+
+
+def test_ShardSet(tmpdir):
+    from ratescan.execution import Job, process_jobs
+    from ratescan.executables.concatRatescans import run
+    from ratescan.shards import ShardSet
+
+    infiles = make_inputs(tmpdir)
+    shard_dir = str(tmpdir.join("shards"))
+
+    def process(shards):
+        jobs = [shards.wrap(Job(run, [f, "ratescan", ["night", "run_id", "event_num"]]), f) for f in shards.pending()]
+        return list(process_jobs(jobs, backend="pool", max_workers=1))
+
+    shards = ShardSet(shard_dir, infiles[:1], config=dict(a=1))
+    assert shards.pending() == infiles[:1]
+    assert process(shards) == [88375]
+    assert shards.pending() == []
+
+    # a new input file and a changed input file are processed again
+    shards = ShardSet(shard_dir, infiles, config=dict(a=1))
+    assert shards.pending() == infiles[1:]
+    process(shards)
+    write_data(read_data(infiles[0], key="ratescan").iloc[:100], infiles[0], key="ratescan", mode="w")
+    shards = ShardSet(shard_dir, infiles, config=dict(a=1))
+    assert shards.pending() == infiles[:1]
+    assert process(shards) == [100]
+
+    # a different configuration invalidates all shards
+    assert ShardSet(shard_dir, infiles, config=dict(a=2)).pending() == infiles
+
+    outfile = str(tmpdir.join("merged.hdf5"))
+    shards.merge(outfile)
+    df = read_data(outfile, key="ratescan")
+    assert len(df) == 88375 + 100
+    assert df["run_id"].unique().tolist() == [182, 183]
+
+
+def test_concatRatescans_shards(tmpdir):
+    from click.testing import CliRunner
+    from ratescan.executables.concatRatescans import main
+
+    infiles = make_inputs(tmpdir)
+    shard_dir = str(tmpdir.join("shards"))
+
+    outfiles = []
+    for i in range(2):
+        outfile = str(tmpdir.join("concat_{}.hdf5".format(i)))
+        result = CliRunner().invoke(main, [
+            *infiles, outfile, "--backend", "pool", "--max_workers", "1", "--shard_dir", shard_dir,
+        ])
+        assert result.exit_code == 0, result.output
+        outfiles.append(outfile)
+        if i == 0:
+            mtimes = {f: os.path.getmtime(os.path.join(shard_dir, f)) for f in os.listdir(shard_dir)}
+
+    # the second run only merges the existing shards
+    assert {f: os.path.getmtime(os.path.join(shard_dir, f)) for f in os.listdir(shard_dir)} == mtimes
+
+    df = read_data(outfiles[1], key="ratescan")
+    assert len(df) == 2 * 88375
+    assert df.equals(read_data(outfiles[0], key="ratescan"))
+
+
+def test_concatRatescans_all_columns(tmpdir):
+    from ratescan.executables.concatRatescans import run
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    infile = str(tmpdir.join("pedestal.hdf5"))
+    write_data(df.assign(pedestal=1.5), infile, key="ratescan", mode="w")
+
+    # hdf5 inputs keep the columns that are not in the key list
+    df_concat = run(infile)
+    assert set(df_concat.columns) == set(df.columns) | {"pedestal", "infile_path"}
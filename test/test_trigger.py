@@ -0,0 +1,165 @@
+from fact.io import read_data
+import numpy as np
+import pandas as pd
+
+
+def test_softwareTriggerDecisions():
+    from ratescan.trigger import maxTriggeringThresholdPerEvent, softwareTriggerDecisions
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df["current_at_start"] = 5.1
+    group_keys = ["night", "run_id", "event_num"]
+    threshold_curve_par = [dict(a=a, k=k) for a in [20, 63.2, 150, 400] for k in [0.3, 0.551]]
+
+    df_events = maxTriggeringThresholdPerEvent(df, group_keys=group_keys)
+    df_trigger = softwareTriggerDecisions(
+        df_events["max_triggering_threshold"].values,
+        df_events["current_at_start"].values,
+        threshold_curve_par,
+    )
+    assert len(df_trigger) == 474
+
+    # row wise reference
+    for p in threshold_curve_par:
+        threshold = p["a"] * pow(5.1, p["k"])
+        above = df[(df["ratescan_trigger_thresholds"] >= threshold) & (df["ratescan_trigger_counts"] > 0)]
+        expected = df_events["event_num"].isin(above["event_num"]).values
+        assert (df_trigger["SetSWThreshold_{}_{}".format(p["a"], p["k"])].values == expected).all()
+    assert 0 < df_trigger.values.sum() < df_trigger.size
+
+
+def test_event_summary(tmpdir):
+    from click.testing import CliRunner
+    from ratescan.executables import buildEventSummary, determine_sw_trigger_event_list
+    from ratescan.features import maxPossibleThreshold2Keep, maxPossibleThreshold2KeepFromSummary
+    from ratescan.rundb import RunInfoCache
+
+    snapshot = str(tmpdir.join("run_db.sqlite"))
+    with RunInfoCache(snapshot) as run_db:
+        run_db.insert(pd.DataFrame(
+            {"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]}
+        ))
+
+    summary = str(tmpdir.join("summary.hdf5"))
+    result = CliRunner().invoke(buildEventSummary.main, [
+        "test/test.hdf5", summary, "--backend", "pool", "--max_workers", "1",
+        "--run_db_snapshot", snapshot, "--run_db_offline", "--n_primitives", "1", "--n_primitives", "2",
+    ])
+    assert result.exit_code == 0, result.output
+
+    df_summary = read_data(summary, key="event_summary")
+    assert len(df_summary) == 474
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    pd.testing.assert_frame_equal(maxPossibleThreshold2KeepFromSummary(df_summary), maxPossibleThreshold2Keep(df))
+    assert maxPossibleThreshold2KeepFromSummary(df_summary)["ratescan_trigger_thresholds"].values == 490
+    assert np.array_equal(
+        maxPossibleThreshold2KeepFromSummary(df_summary, n_primitives=[1, 2]).values,
+        maxPossibleThreshold2Keep(df, n_primitives=[1, 2]).values,
+    )
+
+    key_dict = dict(
+        determine_sw_trigger_event_list.default_key_dict,
+        threshold_curve_par=[dict(a=63.2, k=0.551), dict(a=150, k=0.551)],
+    )
+    df_from_summary = determine_sw_trigger_event_list.run(summary, key_dict=dict(key_dict, from_summary=True))
+    df_from_raw = determine_sw_trigger_event_list.run(
+        "test/test.hdf5",
+        key_dict=dict(key_dict, run_db_table=pd.DataFrame(
+            {"night": [20150901], "run_id": [182], "ontime": [160.0], "current_at_start": [5.1]}
+        )),
+    )
+    assert df_from_summary.equals(df_from_raw)
+
+
+def test_AcceptedEvents(tmpdir):
+    from ratescan.trigger import AcceptedEvents
+
+    df_accepted = pd.DataFrame({"night": [20150901, 20150901, 20150902], "run_id": [182, 5, 1], "event_num": [1, 2, 70000]})
+    accepted = AcceptedEvents.from_dataframe(df_accepted, ["event_num", "run_id", "night"])
+
+    path = str(tmpdir.join("accepted.npz"))
+    accepted.save(path)
+    accepted = AcceptedEvents.load(path)
+
+    df = pd.DataFrame({
+        "night": [20150901, 20150901, 20150901, 20150902, 20150903, 20150831],
+        "run_id": [182, 182, 5, 1, 1, 182],
+        "event_num": [1, 2, 2, 70000, 1, 1],
+    })
+    assert accepted.contains(df).tolist() == [True, False, True, True, False, False]
+
+
+def test_AcceptedEvents_nan_ids():
+    from ratescan.trigger import AcceptedEvents
+
+    df_accepted = pd.DataFrame({"run_id": [182.0, np.nan, 5.0], "event_num": [1, 2, 3]})
+    accepted = AcceptedEvents.from_dataframe(df_accepted, ["event_num", "run_id"])
+    assert len(accepted.keys) == 2
+
+    df = pd.DataFrame({"run_id": [182.0, np.nan, 5.0, np.nan], "event_num": [1, 2, 3, 1]})
+    assert accepted.contains(df).tolist() == [True, False, True, False]
+
+
+def test_applyTrigger(tmpdir):
+    from click.testing import CliRunner
+    from fact.io import write_data
+    from ratescan.executables.applyTrigger import main
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df_events = df.groupby(["night", "run_id", "event_num"]).size().rename("n_rows").reset_index()
+
+    dataset = str(tmpdir.join("dataset.hdf5"))
+    write_data(df_events[df_events.event_num < 300], dataset, key="events_a", mode="w")
+    write_data(df_events[df_events.event_num >= 300], dataset, key="events_b", mode="a")
+
+    df_trigger = df_events[["night", "run_id", "event_num"]].copy()
+    df_trigger["SetSWThreshold_41.2_0.551"] = df_trigger.event_num % 3 == 0
+    trigger = str(tmpdir.join("trigger.hdf5"))
+    write_data(df_trigger, trigger, key="ratescan")
+
+    output = str(tmpdir.join("output.hdf5"))
+    result = CliRunner().invoke(main, [
+        dataset, trigger, output, "--backend", "pool", "--max_workers", "1", "--chunk_rows", "50",
+    ])
+    assert result.exit_code == 0, result.output
+
+    for key in ["events_a", "events_b"]:
+        df_data = read_data(dataset, key=key)
+        expected = pd.merge(df_data, df_trigger[df_trigger["SetSWThreshold_41.2_0.551"]], on=["event_num", "run_id", "night"])
+        assert read_data(output, key=key).equals(expected[df_data.columns])
+
+
+def test_applyTrigger_selection_only(tmpdir):
+    from click.testing import CliRunner
+    from fact.io import write_data
+    from ratescan.executables.applyTrigger import main
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df_events = df.groupby(["night", "run_id", "event_num"]).size().rename("n_rows").reset_index()
+    df_events["n_rows"] = df_events["n_rows"].astype(np.int16)
+
+    dataset = str(tmpdir.join("dataset.hdf5"))
+    write_data(df_events[df_events.event_num < 300], dataset, key="events_a", mode="w")
+    write_data(df_events[df_events.event_num >= 300], dataset, key="events_b", mode="a")
+
+    df_trigger = df_events[["night", "run_id", "event_num"]].copy()
+    df_trigger["SetSWThreshold_41.2_0.551"] = df_trigger.event_num % 3 == 0
+    trigger = str(tmpdir.join("trigger.hdf5"))
+    write_data(df_trigger, trigger, key="ratescan")
+
+    outputs = []
+    for mode in [[], ["--selection_only"]]:
+        output = str(tmpdir.join("output_{}.hdf5".format(len(mode))))
+        result = CliRunner().invoke(main, [
+            dataset, trigger, output, "--backend", "pool", "--max_workers", "1", "--chunk_rows", "50", *mode
+        ])
+        assert result.exit_code == 0, result.output
+        outputs.append(output)
+
+    for key in ["events_a", "events_b"]:
+        df_pandas = read_data(outputs[0], key=key)
+        df_selected = read_data(outputs[1], key=key)
+        assert len(df_selected) > 0
+        assert df_selected.reset_index(drop=True).equals(df_pandas)
+        assert df_selected["n_rows"].dtype == np.int16
@@ -10,6 +10,48 @@ def test_sumupCountsOfRun():
     assert df_summed.run_id.unique() == 182
     assert len(df_summed.ratescan_trigger_thresholds) == 1000
 
+def test_RatescanAccumulator():
+    from ratescan.utils import sumupCountsOfRun, RatescanAccumulator
+    import numpy as np
+    import pandas as pd
+
+    df = read_data("test/test.hdf5", key="ratescan")
+    df = pd.concat([df, df.assign(run_id=183)], ignore_index=True)
+
+    accumulator = RatescanAccumulator()
+    for chunk in np.array_split(np.arange(len(df)), 7):
+        accumulator.add(df.iloc[chunk])
+
+    df_summed = accumulator.result()
+
+    # the groupby implementation of sumupCountsOfRun
+    group_keys = ["night", "run_id"]
+    df_expected = df[["ratescan_trigger_counts", "ratescan_trigger_thresholds", *group_keys]]
+    df_expected = df_expected.groupby(group_keys + ["ratescan_trigger_thresholds"]).sum().reset_index()
+    df_size = df[df.ratescan_trigger_thresholds == 0].groupby(group_keys).size()
+    df_size = df_size.to_frame(name="n_events_per_run").reset_index()
+    df_expected = pd.merge(df_expected, df_size, how="left", on=group_keys)
+
+    pd.testing.assert_frame_equal(df_summed, df_expected, check_dtype=False)
+    pd.testing.assert_frame_equal(sumupCountsOfRun(df), df_summed)
+    assert len(df_summed) == 2000
+    assert (df_summed.n_events_per_run == 474).all()
+
+    # rows with a NaN run key are left out like in the groupby
+    df_nan = pd.concat([df, df.iloc[:5000].assign(run_id=np.nan)], ignore_index=True)
+    df_summed_nan = sumupCountsOfRun(df_nan)
+    assert df_summed_nan.run_id.notna().all()
+    pd.testing.assert_frame_equal(df_summed_nan, df_summed, check_dtype=False)
+
+    # NaN counts, e.g. of missing json keys, count as zero like in the groupby
+    df_nan_count = df.copy()
+    df_nan_count["ratescan_trigger_counts"] = df_nan_count["ratescan_trigger_counts"].astype(float)
+    df_nan_count.loc[0, "ratescan_trigger_counts"] = np.nan
+    df_summed_nan_count = sumupCountsOfRun(df_nan_count)
+    df_expected_nan_count = df_nan_count.groupby(group_keys + ["ratescan_trigger_thresholds"])["ratescan_trigger_counts"].sum()
+    assert (df_summed_nan_count.ratescan_trigger_counts.values == df_expected_nan_count.values).all()
+    assert df_summed_nan_count.ratescan_trigger_counts.min() >= 0
+
 def test_compileRatescanForRun():
     from ratescan.utils import compileRatescanForRun
     